@@ -2,3 +2,4 @@ from .fpeg import fpeg_compress, fpeg_decompress
 from .jpeg import jpeg2000_compress, jpeg2000_decompress
 from .config import Config
 from .base import Pipe
+from .executor import Executor
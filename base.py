@@ -1,4 +1,6 @@
+from contextlib import contextmanager
 from inspect import signature, Parameter
+from multiprocessing import Pool, resource_tracker
 from pprint import PrettyPrinter
 
 from .config import read_config
@@ -35,11 +37,14 @@ class Pipe:
       Formatter for generating log messages.
     pprinter: fpeg.printer.Pprinter
       Pretty printer for printing pipes.
+    executor: fpeg.executor.Executor or None
+      Subprocess pool shared by the pipes of a pipeline, injected by the pipeline.
     """
     self.logs = []
     self.formatter = Formatter(fmt=time_format)
     self.pprinter = PrettyPrinter(**pprint_option)
     self.monitor = Monitor()
+    self.executor = None
 
   def recv_send(self, X, **params):
     """
@@ -110,6 +115,23 @@ class Pipe:
 
       self.accelerated = self.accelerated or bool(self.task_number < self.min_task_number)
 
+  @contextmanager
+  def pool(self, processes):
+    """
+    Subprocess pool for parallel computation.
+
+    The executor injected by the pipeline is used if there is one, otherwise a pool of processes workers is opened and closed with the context.
+    """
+    if self.executor is not None:
+      self.logs[-1] += self.formatter.message("Using shared executor.")
+      yield self.executor
+    else:
+      # forked workers share the resource tracker of the parent only if it runs before the fork,
+      # otherwise each worker tracks the shared memory blocks it attaches to and warns about them at exit
+      resource_tracker.ensure_running()
+      with Pool(processes) as p:
+        yield p
+
   def set_params(self, **params):
     if not params:
       return self
@@ -140,8 +162,8 @@ class Pipe:
       return
 
     params = {}
-    # make self, name, mode, flag, monitor, formatter, pprinter unchanged every time receive and send data.
-    excluded_names = ["self", "name", "mode", "flag", "monitor", "formatter", "pprinter"]
+    # make self, name, mode, flag, monitor, formatter, pprinter, executor unchanged every time receive and send data.
+    excluded_names = ["self", "name", "mode", "flag", "monitor", "formatter", "pprinter", "executor"]
     init_signature = signature(init)
     for key, val in init_signature.parameters.items():
       if key not in excluded_names and val.default is not Parameter.empty:
@@ -159,10 +181,10 @@ class Pipe:
     parameters = [p for p in init_signature.parameters.values()
                   if p.name != 'self' and p.kind != p.VAR_KEYWORD]
 
-    # Make monitor, formatter, pprinter visible to pipeline.
+    # Make monitor, formatter, pprinter, executor visible to pipeline.
     # These attributes are initialized by the Pipe base class,
     # and is invisible to pipeline in subclasses if not do so.
-    included_names = ["monitor", "formatter", "pprinter"]
+    included_names = ["monitor", "formatter", "pprinter", "executor"]
     names = [p.name for p in parameters]
     names.extend(included_names)
     names = sorted(list(set(names)))
@@ -173,7 +195,7 @@ class Pipe:
     """
     Pretty print the pipe.
     """
-    excluded_names = ["name", "monitor", "formatter", "pprinter"]
+    excluded_names = ["name", "monitor", "formatter", "pprinter", "executor"]
     params = self.get_params()
     new_params = {}
     for key in params:
@@ -1,7 +1,9 @@
 __all__ = [
   "HuffmanCodec",
-  "EBCOTCodec"
+  "EBCOTCodec",
+  "HTCodec"
 ]
 
 from .huffman_codec import HuffmanCodec
 from .ebcot_codec import EBCOTCodec
+from .ht_codec import HTCodec
@@ -3,23 +3,69 @@ __all__ = [
 ]
 
 from copy import deepcopy
-from multiprocessing import Pool
+import math
+import struct
 import numpy as np
 
 from fpeg.base import Codec
 from fpeg.config import read_config
-from fpeg.funcs import parse_marker, cat_arrays_2d
+from fpeg.funcs import parse_marker, quantization_steps, synthesis_norms, cat_arrays_2d, ArraySpec, SharedArrays, call_shared
+from fpeg.funcs import shared_starmap, write_into
+from fpeg.funcs import window_tiles, tile_window, band_windows, window_blocks
+from .mq_coder import MQEncoder, MQBatchEncoder, MQDecoder
+from . import ebcot_jit
 
 config = read_config()
 
 D = config.get("jpeg2000", "D")
 G = config.get("jpeg2000", "G")
 QCD = config.get("jpeg2000", "QCD")
+tile_shape = config.get("jpeg2000", "tile_shape")
 mq_table = config.get("jpeg2000", "mq_table")
 
 min_task_number = config.get("accelerate", "codec_min_task_number")
 max_pool_size = config.get("accelerate", "codec_max_pool_size")
 
+# Packed state of a coefficient used by the coding passes. The low byte holds
+# the significance of the 8 neighbours, the next bits hold the significance
+# (S1), refinement (S2) and coded-in-this-plane (S3) flags of the coefficient.
+_NB_N, _NB_S, _NB_W, _NB_E = 1, 2, 4, 8
+_NB_NW, _NB_NE, _NB_SW, _NB_SE = 16, 32, 64, 128
+_NEIGHBOURS = 255
+_SIG = 256
+_REFINED = 512
+_CODED = 1024
+
+# estimated bytes added by the termination of an MQ codeword, see _block_estimate. The code length of the adaptive model
+# already covers most of the bits the termination flushes, this is the mean of the rest over the blocks of real images
+_FLUSH_BYTES = 0.5
+
+# wavelet of DWTransformer, the synthesis norms of its bands weight the distortions in _rate_control
+_WAVELET = "bior2.2"
+
+# largest number of code blocks coded in one lockstep batch, see _lockstep_encode
+_LOCKSTEP_BATCH = 256
+
+# row of the zero coding table used by each band orientation
+_BAND_INDEX = {"LL": 0, "LH": 0, "HL": 1, "HH": 2}
+
+# Layout of the codestream of a tile, all integers are little-endian.
+# tile  := TILE_HEADER band_index band * (n_channels * (3 * D + 1))
+# band  := BAND_HEADER block_index block * (ceil(height / h) * ceil(width / w)), or BAND_HEADER alone if the band is empty
+# block := BLOCK_HEADER stream, the stream may be truncated after any coding pass, or nothing if the block is empty
+# An empty code block has no coding passes, it is all zero or truncated to nothing, and has length 0 in block_index.
+# An empty band has only empty code blocks and is flagged in its BAND_HEADER.
+# A stream of more than one coding segment (see _segments) is segment_index segment * n_segments,
+# segment_index holds the uint32 length of every segment, which is kept when the stream is truncated.
+# band_index and block_index hold one (offset, length) entry of uint32 for
+# every band and code block, offsets are counted from the start of the tile,
+# so any band or code block can be located without scanning the codestream.
+# Context labels are not stored, the decoder derives them from the states it has decoded.
+_TILE_HEADER = struct.Struct("<BBBB")  # D, number of channels, number of planes before bypass (0 for no bypass), terminate
+_BAND_HEADER = struct.Struct("<IIHHB")  # height and width of band, height h and width w of code block, empty
+_BLOCK_HEADER = struct.Struct("<BB")  # number of bit-planes, number of coding passes in stream
+_INDEX_DTYPE = np.dtype("<u4")
+
 
 class EBCOTCodec(Codec):
 	"""
@@ -32,6 +78,23 @@ class EBCOTCodec(Codec):
 							 D=D,
 							 G=G,
 							 QCD=QCD,
+							 mq_coder="fast",
+							 target_bytes=None,
+							 target_bpp=None,
+							 irreversible=False,
+							 reduce=0,
+							 window=None,
+							 tile_shape=tile_shape,
+							 block_shape=(),
+							 code_block=(64, 64),
+							 auto_code_block=False,
+							 max_planes=None,
+							 drop_lsb_planes=0,
+							 bypass=None,
+							 terminate=False,
+							 fused=True,
+							 lockstep=False,
+							 backend="python",
 							 accelerated=False
 							 ):
 		"""
@@ -42,15 +105,49 @@ class EBCOTCodec(Codec):
 		name: str, optional
 			Name of the codec.
 		mode: str, optional
-			Mode of the codec, must in ["encode", "decode"].
+			Mode of the codec, must in ["encode", "decode", "estimate"]. "estimate" sends the predicted sizes of the codestreams of the received tiles instead of coding them, see estimate.
 		G: integer, optional
 			a parameter for calculate Kmax
 		D: integer, optional
 			Depth of graphic.
 		epsilon_b:integer, must
 			a parameter for calculate Kmax
+		mq_coder: str, optional
+			MQ coder used by code blocks, must in ["fast", "reference"]. "fast" uses MQEncoder and MQDecoder, "reference" uses the original _MQencode and _MQ_decode functions. Both give the same codestream.
+		target_bytes: int, optional
+			Size of the codestreams of all received tiles in bytes. Code blocks are truncated by post-compression rate-distortion optimization to meet it, None for no truncation.
+		target_bpp: float, optional
+			Same as target_bytes but in bits per pixel. Pixels are counted as the coefficients of one channel, which are a few percent more than the pixels of a tile because of the boundary extension of the wavelet transform.
+		irreversible: bool, optional
+			Whether the coefficients were quantized by the irreversible path of Quantizer with the steps of QCD. Rate control weights the distortion of every band by the square of its step only then, and by the squared synthesis norm of the band always.
+		reduce: int, optional
+			Number of the finest resolution levels skipped in decoding, decoded tiles keep the LL band and the first D - reduce levels.
+		window: tuple of int, optional
+			Region (y0, x0, y1, x1) of the image to decode, y1 and x1 excluded, None for the whole image. Only the tiles overlapping window are decoded and returned in raster order, and only their code blocks that the pixels of window are synthesized from, the other code blocks are left 0. The pixels of window are decoded exactly as if the whole image were.
+		tile_shape: tuple of int, optional
+			Shape of the tiles the image was split into, used with window.
+		block_shape: tuple of int, optional
+			Number of rows and columns of tiles of the image, used with window.
+		code_block: tuple of int, optional
+			Height and width of the code blocks bands are split into. Code blocks on the bottom and right edges of a band are cut to it and coded at their real size. The decoder reads the shape of the code blocks of every band from the codestream.
+		auto_code_block: bool, optional
+			Whether the code block shape is chosen per band, at most code_block, so that the band is split into as few code blocks of about equal size. Avoids thin code blocks on the edges of bands slightly larger than code_block.
+		max_planes: int or sequence of int, optional
+			Number of the most significant bit-planes coded of every code block, None for all. The encoder stops coding a block at its budget, the decoder reads the number of coded passes from the codestream and leaves the planes below 0. A sequence gives one budget per item of a tile, the LL band first and then the levels from the coarsest, for a coarser budget of the fine levels. Meant for fast previews, the encoding time drops with the planes skipped.
+		drop_lsb_planes: int or sequence of int, optional
+			Number of the least significant bit-planes of every code block skipped by the encoder, as max_planes. Both can be combined, the tighter one applies.
+		bypass: int, optional
+			Number of the most significant bit-planes of a code block that are fully MQ coded before the raw bypass, None for no bypass. Needs the fast MQ coder.
+		terminate: bool, optional
+			Whether to terminate the MQ coder after every coding pass and store the length of every pass in the code block. Each pass can then be cut off exactly, so truncation and quality layers need no re-coding and a block can be decoded pass by pass as its passes arrive, at the cost of a few bytes per pass. The decoder reads it from the codestream, it is only supported by the fast MQ coder.
+		fused: bool, optional
+			Whether the coding passes code each symbol straight into the fast MQ coder instead of collecting the symbols first.
+		lockstep: bool, optional
+			Whether code blocks are coded in vectorized lockstep batches, with the same codestream. Needs the fast MQ coder.
+		backend: str, optional
+			Implementation of the coding passes and the MQ coder of code blocks, must in ["python", "jit"]. "jit" codes and decodes every code block by one call of a kernel of ebcot_jit.py compiled by numba, with the same codestream as "python". The compiled kernels are cached on disk, so only the first run pays the compilation. Falls back to "python" if numba is not installed, needs the fast MQ coder. Lockstep encoding uses its own engine.
 		accelerated: bool, optional
-			Whether the process would be accelerated by subprocess pool.
+			Whether the process would be accelerated by subprocess pool. Code blocks are scheduled as independent tasks, tiles and codestreams are passed to the pool through shared memory.
 
 		"""
 		super().__init__()
@@ -61,6 +158,23 @@ class EBCOTCodec(Codec):
 		self.D = D
 		self.G = G
 		self.QCD = QCD
+		self.mq_coder = mq_coder
+		self.target_bytes = target_bytes
+		self.target_bpp = target_bpp
+		self.irreversible = irreversible
+		self.reduce = reduce
+		self.window = window
+		self.tile_shape = tile_shape
+		self.block_shape = block_shape
+		self.code_block = code_block
+		self.auto_code_block = auto_code_block
+		self.max_planes = max_planes
+		self.drop_lsb_planes = drop_lsb_planes
+		self.bypass = bypass
+		self.terminate = terminate
+		self.fused = fused
+		self.lockstep = lockstep
+		self.backend = backend
 		self.accelerated = accelerated
 
 		self.epsilon_b, _ = parse_marker(self.QCD)
@@ -68,6 +182,18 @@ class EBCOTCodec(Codec):
 		self.min_task_number = min_task_number
 		self.max_pool_size = max_pool_size
 
+	def recv(self, X, **params):
+		if self.mode != "estimate":
+			return super().recv(X, **params)
+
+		self.logs.append("")
+		self.logs[-1] += self.formatter.message("Receiving data.")
+		self.received_ = X
+		self.accelerate(**params)
+		self.sended_ = self.estimate(X, **params)
+
+		return self
+
 	def encode(self, X, **params):
 		self.logs[-1] += self.formatter.message("Trying to encode received data.")
 		try:
@@ -75,58 +201,221 @@ class EBCOTCodec(Codec):
 		except KeyError:
 			pass
 
-
-		if self.accelerated:
-			self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate EBCOT encoding.")
-			inputs = [[x, self.D] for x in X]
-			with Pool(min(self.task_number, self.max_pool_size)) as p:
-				bitcodes = p.starmap(_EBCOT_encode, inputs)
+		self._check_mq_coder(**params)
+		self._check_target(**params)
+		self._check_segments(**params)
+		self._check_backend(**params)
+		self._check_code_block(**params)
+		self._check_budget(**params)
+		h, w = self.code_block
+		truncation = self.target_bytes is not None or self.target_bpp is not None
+		budget = None if self.max_planes is None and not np.any(self.drop_lsb_planes) else (self.max_planes, self.drop_lsb_planes)
+
+		if self.lockstep:
+			self.logs[-1] += self.formatter.message("Coding code blocks in lockstep batches.")
+			if self.accelerated:
+				with self.pool(self.max_pool_size) as p:
+					tiles = _lockstep_code(X, self.D, h, w, truncation, self.bypass, self.terminate, p, self.max_pool_size, self.auto_code_block, budget)
+			else:
+				tiles = _lockstep_code(X, self.D, h, w, truncation, self.bypass, self.terminate, auto=self.auto_code_block, budget=budget)
+		elif self.accelerated:
+			self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate EBCOT encoding of code blocks.")
+			with self.pool(self.max_pool_size) as p:
+				tiles = _parallel_encode(X, self.D, self.mq_coder, p, h, w, truncation, self.bypass, self.terminate, self.fused, self.backend, self.auto_code_block, budget)
 		else:
-			bitcodes = [_EBCOT_encode(x, self.D) for x in X]
+			tiles = [(self.D, x[0].shape[2], _tile_code(x, self.D, h, w, self.mq_coder, truncation, self.bypass, self.terminate, self.fused, self.backend, self.auto_code_block, budget)) for x in X]
+
+		if truncation:
+			if self.target_bytes is not None:
+				target = self.target_bytes
+			else:
+				target = self.target_bpp * sum(_tile_pixels(bands, D) for D, _, bands in tiles) / 8
+			self.logs[-1] += self.formatter.message("Truncating code blocks to {:.0f} bytes.".format(target))
+			_rate_control(tiles, target, quantization_steps(self.QCD, self.D) if self.irreversible else None)
+
+		bitcodes = [_tile_pack(*tile, bypass=self.bypass, terminate=self.terminate) for tile in tiles]
 
 		return bitcodes
 
 	def decode(self, bitcodes, **params):
 		self.logs[-1] += self.formatter.message("Trying to decode received data.")
+		self._check_mq_coder(**params)
+		self._check_reduce(**params)
+		self._check_window(**params)
+		self._check_backend(**params)
+
+		windows = [None] * len(bitcodes)
+		if self.window is not None:
+			rows, cols = window_tiles(self.window, self.tile_shape, self.block_shape)
+			self.logs[-1] += self.formatter.message("Decoding {} tiles overlapping window {}.".format(len(rows) * len(cols), self.window))
+			bitcodes = [bitcodes[i * self.block_shape[1] + j] for i in rows for j in cols]
+			windows = [tile_window(self.window, self.tile_shape, i, j) for i in rows for j in cols]
 
 		if self.accelerated:
-			inputs = [[bitcode, self.D] for bitcode in bitcodes]
-			with Pool(min(self.task_number, self.max_pool_size)) as p:
-				X = p.starmap(_tile_decode, inputs)
+			self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate EBCOT decoding of code blocks.")
+			with self.pool(self.max_pool_size) as p:
+				X = _parallel_decode(bitcodes, self.mq_coder, p, self.reduce, windows, self.backend)
 		else:
-			X = [_tile_decode(bitcode, self.D) for bitcode in bitcodes]
+			X = [_tile_decode(bitcode, self.mq_coder, self.reduce, window, self.backend) for bitcode, window in zip(bitcodes, windows)]
 
 		return X
 
+	def estimate(self, X, **params):
+		"""
+		Predict the size of the codestreams of tiles without coding them.
 
-def _EBCOT_encode(tile, D):
-	"""
-	EBCOT encode and decode part
-	encode part:
-	| _EBCOT_encode
-		| _tile_encode
-			| _band_encode
-				| _embeddedBlockEncoder _MQencode
-					 | 三个通道过程
-
-	｜ _EBCOT_decode
-		| _tile_decode
-			| _band_decode
-				| _block_decode
-					| three decode passes and MQdecode
-						|signdecode and runlengthdecode
-	"""
+		Neither the coding passes nor the MQ coder are run. The symbols of every context are counted plane by plane for whole bands at once, see _context_statistics, and their code length is predicted by the entropy of an adaptive binary model, see _block_estimate. Takes the tiles and parameters of encode but rate control and costs a small fraction of it with the python backend, for the search of QCD, tile shape or D of an image. The symbols are counted exactly, the error is in their predicted code length: on tiles of a photograph with quantization steps of 1 to 16, code blocks of 16 to 64 and with and without bypass and terminate, the estimates were 3% below to 4% above the real sizes, see test/estimate_test.py. Used by the "estimate" mode, which sends the estimates.
+
+		Returns
+		-------
+		estimates: list of tuple
+			(bytes of the codestream of a tile, bytes of each of its bands in codestream order) of every tile.
+		"""
+		self.logs[-1] += self.formatter.message("Trying to estimate the coded size of received data.")
+		self._check_segments(**params)
+		self._check_code_block(**params)
+		self._check_budget(**params)
+		h, w = self.code_block
+		budget = None if self.max_planes is None and not np.any(self.drop_lsb_planes) else (self.max_planes, self.drop_lsb_planes)
+		args = (self.D, h, w, self.bypass, self.terminate, self.auto_code_block, budget)
+
+		if self.accelerated:
+			self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate estimation of tiles.")
+			structures = [ArraySpec((1 + x[0].shape[2] * (3 * self.D + 1),), "<i8") for x in X]
+			with self.pool(self.max_pool_size) as p:
+				estimates = shared_starmap(p, write_into, X, structures, _packed_tile_estimate, *args)
+			estimates = [(int(estimate[0]), estimate[1:].tolist()) for estimate in estimates]
+		else:
+			estimates = [_tile_estimate(x, *args) for x in X]
+
+		return estimates
+
+	def _check_mq_coder(self, **params):
+		try:
+			self.mq_coder = params["mq_coder"]
+			self.logs[-1] += self.formatter.message("\"mq_coder\" is specified as {}.".format(self.mq_coder))
+		except KeyError:
+			self.logs[-1] += self.formatter.warning("\"mq_coder\" is not specified, now set to {}.".format(self.mq_coder))
+
+		if self.mq_coder not in ["fast", "reference"]:
+			msg = "Invalid attribute %s for codec %s. EBCOTCodec.mq_coder should be set to \"fast\" or \"reference\"." % (self.mq_coder, self)
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
+
+	def _check_reduce(self, **params):
+		try:
+			self.reduce = params["reduce"]
+			self.logs[-1] += self.formatter.message("\"reduce\" is specified as {}.".format(self.reduce))
+		except KeyError:
+			pass
+
+		if not 0 <= self.reduce <= self.D:
+			msg = "Invalid attribute %s for codec %s. EBCOTCodec.reduce should be in [0, D]." % (self.reduce, self)
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
+
+	def _check_window(self, **params):
+		for key in ["window", "tile_shape", "block_shape"]:
+			try:
+				setattr(self, key, params[key])
+				self.logs[-1] += self.formatter.message("\"{}\" is specified as {}.".format(key, params[key]))
+			except KeyError:
+				pass
+
+		if self.window is None:
+			return
+
+		y0, x0, y1, x1 = self.window
+		if not (0 <= y0 < y1 and 0 <= x0 < x1 and len(self.block_shape) == 2):
+			msg = "Invalid attribute %s for codec %s. EBCOTCodec.window should be a non-empty (y0, x0, y1, x1) region and EBCOTCodec.block_shape should be set." % (self.window, self)
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
+
+	def _check_segments(self, **params):
+		for key in ["bypass", "terminate", "fused", "lockstep"]:
+			try:
+				setattr(self, key, params[key])
+				self.logs[-1] += self.formatter.message("\"{}\" is specified as {}.".format(key, params[key]))
+			except KeyError:
+				pass
+
+		if self.bypass is not None and not 1 <= self.bypass <= 255:
+			msg = "Invalid attribute %s for codec %s. EBCOTCodec.bypass should be None or in [1, 255]." % (self.bypass, self)
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
+
+		if (self.bypass is not None or self.terminate or self.lockstep) and self.mq_coder != "fast":
+			msg = "Invalid attribute %s for codec %s. EBCOTCodec.bypass, EBCOTCodec.terminate and EBCOTCodec.lockstep need the fast MQ coder." % (self.mq_coder, self)
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
+
+	def _check_backend(self, **params):
+		try:
+			self.backend = params["backend"]
+			self.logs[-1] += self.formatter.message("\"backend\" is specified as {}.".format(self.backend))
+		except KeyError:
+			pass
+
+		if self.backend not in ["python", "jit"]:
+			msg = "Invalid attribute %s for codec %s. EBCOTCodec.backend should be set to \"python\" or \"jit\"." % (self.backend, self)
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
+
+		if self.backend == "jit" and self.mq_coder != "fast":
+			msg = "Invalid attribute %s for codec %s. EBCOTCodec.backend \"jit\" needs the fast MQ coder." % (self.mq_coder, self)
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
 
-	bitcode = list(_tile_encode(tile, D))
+		if self.backend == "jit" and not ebcot_jit.available:
+			self.backend = "python"
+			self.logs[-1] += self.formatter.warning("numba is not installed, \"backend\" is now set to python.")
 
-	# with open('test.bin', 'wb') as f:
-	#   f.write(struct.pack(str(l)+'i', *bitcode))
-	# streamonly = [int(i) for i in streamonly]
-	# l = len(streamonly)
-	# with open('streamonly.bin', 'wb') as f:
-	#   f.write(struct.pack(str(l)+'i', *streamonly))
+		if self.backend == "jit":
+			ebcot_jit.warm_up()
+
+	def _check_code_block(self, **params):
+		for key in ["code_block", "auto_code_block"]:
+			try:
+				setattr(self, key, params[key])
+				self.logs[-1] += self.formatter.message("\"{}\" is specified as {}.".format(key, params[key]))
+			except KeyError:
+				pass
+
+		if len(self.code_block) != 2 or not all(1 <= n <= 0xFFFF for n in self.code_block):
+			msg = "Invalid attribute %s for codec %s. EBCOTCodec.code_block should be a (height, width) of two integers in [1, 65535]." % (self.code_block, self)
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
+
+	def _check_budget(self, **params):
+		for key in ["max_planes", "drop_lsb_planes"]:
+			try:
+				setattr(self, key, params[key])
+				self.logs[-1] += self.formatter.message("\"{}\" is specified as {}.".format(key, params[key]))
+			except KeyError:
+				pass
+
+		for key, minimum in [("max_planes", 1), ("drop_lsb_planes", 0)]:
+			value = getattr(self, key)
+			if value is None and key == "max_planes":
+				continue
+			values = [value] if np.ndim(value) == 0 else list(value)
+			if not values or not all(isinstance(n, (int, np.integer)) and n >= minimum for n in values) or (np.ndim(value) and len(values) != self.D + 1):
+				msg = "Invalid attribute %s for codec %s. EBCOTCodec.%s should be an integer of at least %d or a sequence of D + 1 of them, one per item of a tile." % (value, self, key, minimum)
+				self.logs[-1] += self.formatter.error(msg)
+				raise AttributeError(msg)
+
+	def _check_target(self, **params):
+		for key in ["target_bytes", "target_bpp", "irreversible"]:
+			try:
+				setattr(self, key, params[key])
+				self.logs[-1] += self.formatter.message("\"{}\" is specified as {}.".format(key, params[key]))
+			except KeyError:
+				pass
 
-	return bitcode
+		if self.target_bytes is not None and self.target_bpp is not None:
+			msg = "Invalid attributes for codec %s. Only one of EBCOTCodec.target_bytes and EBCOTCodec.target_bpp should be set." % self
+			self.logs[-1] += self.formatter.error(msg)
+			raise AttributeError(msg)
 
 
 def _MQencode(CX, D):
@@ -210,6 +499,16 @@ def _putbyte(encoder):
 
 def _MQ_decode(stream, CX):
 	PETTable, CXTable = deepcopy(mq_table)
+	encoder = _MQ_decode_start(stream)
+	decodeD = []
+	for i in range(len(CX)):
+		symbol = _MQ_decode_symbol(encoder, PETTable, CXTable, CX[i][0])
+		# print(i, symbol)
+		decodeD.append([symbol])
+	return decodeD
+
+
+def _MQ_decode_start(stream):
 	# MQ decode initializtion
 	encoder = EBCOTparam()
 	encoder.A = np.uint16(0)
@@ -224,41 +523,39 @@ def _MQ_decode(stream, CX):
 	encoder.C = encoder.C << 7
 	encoder.t = encoder.t - 7
 	encoder.A = np.uint16(2 ** 15)
+	return encoder
 
-	# MQ decode procedure
+
+def _MQ_decode_symbol(encoder, PETTable, CXTable, cxLabel):
+	# MQ decode procedure of one symbol, encoder and CXTable are updated in place
 	CActiveMask = np.uint32(16776960)  # 00000000111111111111111100000000
 	CActiveCmp = np.uint32(4278190335)  # 11111111000000000000000011111111
-	decodeD = []
-	for i in range(len(CX)):
-		cxLabel = CX[i][0]
-		expectedSymbol = CXTable[cxLabel][1]
-		p = PETTable[CXTable[cxLabel][0]][3]
-		encoder.A = encoder.A - np.uint16(p)
-		if encoder.A < np.uint16(p):
-			expectedSymbol = 1 - expectedSymbol
-		if ((encoder.C & CActiveMask) >> 8) < p:
-			symbol = 1 - expectedSymbol
-			encoder.A = np.uint16(p)
+	expectedSymbol = CXTable[cxLabel][1]
+	p = PETTable[CXTable[cxLabel][0]][3]
+	encoder.A = encoder.A - np.uint16(p)
+	if encoder.A < np.uint16(p):
+		expectedSymbol = 1 - expectedSymbol
+	if ((encoder.C & CActiveMask) >> 8) < p:
+		symbol = 1 - expectedSymbol
+		encoder.A = np.uint16(p)
+	else:
+		symbol = expectedSymbol
+		temp = ((encoder.C & CActiveMask) >> 8) - np.uint32(p)
+		encoder.C = encoder.C & CActiveCmp
+		encoder.C = encoder.C + np.uint32((np.uint32(temp << 8)) & CActiveMask)
+	if encoder.A < 2 ** 15:
+		if symbol == CXTable[cxLabel][1]:
+			CXTable[cxLabel][0] = PETTable[CXTable[cxLabel][0]][0]
 		else:
-			symbol = expectedSymbol
-			temp = ((encoder.C & CActiveMask) >> 8) - np.uint32(p)
-			encoder.C = encoder.C & CActiveCmp
-			encoder.C = encoder.C + np.uint32((np.uint32(temp << 8)) & CActiveMask)
-		if encoder.A < 2 ** 15:
-			if symbol == CXTable[cxLabel][1]:
-				CXTable[cxLabel][0] = PETTable[CXTable[cxLabel][0]][0]
-			else:
-				CXTable[cxLabel][1] = CXTable[cxLabel][1] ^ PETTable[CXTable[cxLabel][0]][2]
-				CXTable[cxLabel][0] = PETTable[CXTable[cxLabel][0]][1]
-			while encoder.A < 2 ** 15:
-				if encoder.t == 0:
-					encoder = _fill_lsb(encoder)
-				encoder.A = 2 * encoder.A
-				encoder.C = 2 * encoder.C
-				encoder.t = encoder.t - 1
-		# print(i, symbol)
-		decodeD.append([symbol])
-	return decodeD
+			CXTable[cxLabel][1] = CXTable[cxLabel][1] ^ PETTable[CXTable[cxLabel][0]][2]
+			CXTable[cxLabel][0] = PETTable[CXTable[cxLabel][0]][1]
+		while encoder.A < 2 ** 15:
+			if encoder.t == 0:
+				encoder = _fill_lsb(encoder)
+			encoder.A = 2 * encoder.A
+			encoder.C = 2 * encoder.C
+			encoder.t = encoder.t - 1
+	return symbol
 
 
 def _fill_lsb(encoder):
@@ -275,93 +572,1063 @@ def _fill_lsb(encoder):
 	return encoder
 
 
-def _tile_encode(tile, D, h=64, w=64):
-	_depthOfDwt = D
-
-	tile_cA = tile[0][:, :, 0]
-	newBit, newStream = _band_encode(tile_cA, 'LL', h, w)
-	bitcode = newBit
-	streamOnly = newStream
-	for i in range(1, _depthOfDwt+1):
-		newBit, newStream = _band_encode(tile[i][0][:, :, 0], 'LH', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-		newBit, newStream = _band_encode(tile[i][1][:, :, 0], 'HL', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-		newBit, newStream = _band_encode(tile[i][2][:, :, 0], 'HH', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-
-	tile_cA = tile[0][:, :, 1]
-	newBit, newStream = _band_encode(tile_cA, 'LL', h, w)
-	bitcode = np.hstack((bitcode, newBit))
-	streamOnly = np.hstack((streamOnly, newStream))
-	for i in range(1, _depthOfDwt+1):
-		newBit, newStream = _band_encode(tile[i][0][:, :, 1], 'LH', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-		newBit, newStream = _band_encode(tile[i][1][:, :, 1], 'HL', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-		newBit, newStream = _band_encode(tile[i][2][:, :, 1], 'HH', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-
-	tile_cA = tile[0][:, :, 2]
-	newBit, newStream = _band_encode(tile_cA, 'LL', h, w)
-	bitcode = np.hstack((bitcode, newBit))
-	streamOnly = np.hstack((streamOnly, newStream))
-	for i in range(1, _depthOfDwt+1):
-		newBit, newStream = _band_encode(tile[i][0][:, :, 2], 'LH', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-		newBit, newStream = _band_encode(tile[i][1][:, :, 2], 'HL', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-		newBit, newStream = _band_encode(tile[i][2][:, :, 2], 'HH', h, w)
-		bitcode = np.hstack((bitcode, newBit))
-		streamOnly = np.hstack((streamOnly, newStream))
-	bitcode = np.hstack((bitcode, [2051]))
-	print("streamonly"+str(len(streamOnly)))
-	print("bitcode"+str(len(bitcode)))
-	return bitcode
-
-
-def _band_encode(tile, bandMark, h=64, w=64, num=8):
-	# 码流：[h, w, CX1, 2048, stream1, 2048, ..., CXn, streamn, 2048, 2049,CXn+1, streamn+1, 2048, ...,2050]
+def _tile_code(tile, D, h=64, w=64, mq_coder="fast", truncation=False, bypass=None, terminate=False, fused=True, backend="python", auto=False, budget=None):
+	# return (height, width, h, w, blocks) of every band of a tile in codestream order, see _band_encode
+	# budget: (max_planes, drop_lsb_planes) of EBCOTCodec, see _band_budget, None for no budget
+	return [_band_encode(band, bandMark, h, w, mq_coder=mq_coder, truncation=truncation, bypass=bypass, terminate=terminate, fused=fused, backend=backend, auto=auto, budget=_band_budget(budget, index)) for band, bandMark, index in _tile_bands(tile, D)]
+
+
+def _tile_estimate(tile, D, h=64, w=64, bypass=None, terminate=False, auto=False, budget=None):
+	# return the predicted bytes of the codestream of a tile and of each of its bands, as packed by _tile_pack
+	bands = [_band_estimate(band, bandMark, h, w, bypass, terminate, auto, _band_budget(budget, index)) for band, bandMark, index in _tile_bands(tile, D)]
+	return _TILE_HEADER.size + 2 * _INDEX_DTYPE.itemsize * len(bands) + sum(bands), bands
+
+
+def _packed_tile_estimate(tile, *args):
+	# _tile_estimate as one array of the bytes of the tile and of each of its bands, for shared_starmap
+	total, bands = _tile_estimate(tile, *args)
+	return np.array([total] + bands, dtype=np.int64)
+
+
+def _band_estimate(tile, bandMark, h=64, w=64, bypass=None, terminate=False, auto=False, budget=None):
+	# return the predicted bytes of a band with its header and block index, see _block_estimate
+	if auto:
+		h, w = _auto_block_shape(*np.shape(tile), h, w)
+	h_cA, w_cA = np.shape(tile)
+	# stack of the code blocks of the band, padded to whole stripes, inside marks the coefficients of the band
+	stack = lambda band: np.pad(_code_blocks(np.pad(band, ((0, -h_cA % h), (0, -w_cA % w))), h, w).reshape(-1, h, w), ((0, 0), (0, -h % 4), (0, 0)))
+	coeffs = stack(np.asarray(tile, dtype=np.int64))
+	inside = stack(np.ones((h_cA, w_cA), dtype=bool))
+	nums = _plane_numbers(np.abs(coeffs))
+	planes = nums if budget is None else np.array([_coded_planes(num, budget) for num in nums.tolist()], dtype=np.int64)
+	counts, rawBytes, passes = _context_statistics(coeffs, inside, nums, planes, bandMark, bypass, terminate)
+	blocks = [_block_estimate(*block, bypass, terminate) for block in zip(counts, rawBytes.tolist(), passes, nums.tolist(), planes.tolist())]
+	if not any(blocks):
+		return _BAND_HEADER.size
+	return _BAND_HEADER.size + 2 * _INDEX_DTYPE.itemsize * len(blocks) + sum(blocks)
+
+
+def _tile_pack(D, n_channels, bands, bypass=None, terminate=False):
+	# bands: (height, width, h, w, blocks) of every band in codestream order, blocks are the coded code blocks in raster order
+	# bypass, terminate: coding segments of the code blocks, recorded in the tile header
+	# return the codestream of the tile with its band and block index
+	bands = [(h_cA, w_cA, h, w, [_block_payload(block) for block in blocks]) for h_cA, w_cA, h, w, blocks in bands]
+	bandIndex = np.zeros((len(bands), 2), dtype=_INDEX_DTYPE)
+	segments = [_TILE_HEADER.pack(D, n_channels, bypass or 0, terminate), None]
+	offset = _TILE_HEADER.size + bandIndex.nbytes
+	for k, (h_cA, w_cA, h, w, blocks) in enumerate(bands):
+		empty = not any(blocks)
+		start = offset
+		offset += _BAND_HEADER.size
+		segments.append(_BAND_HEADER.pack(h_cA, w_cA, h, w, empty))
+		if not empty:
+			blockIndex = np.zeros((len(blocks), 2), dtype=_INDEX_DTYPE)
+			offset += blockIndex.nbytes
+			for n, block in enumerate(blocks):
+				blockIndex[n] = offset, len(block)
+				offset += len(block)
+			segments.append(blockIndex.tobytes())
+			segments.extend(blocks)
+		bandIndex[k] = start, offset - start
+	segments[1] = bandIndex.tobytes()
+	return b"".join(segments)
+
+
+def _tile_bands(tile, D):
+	# bands of a tile in codestream order: channel by channel, LL first and then LH, HL, HH of each level
+	# yield every band with its bandMark and the index of its band array in the tile
+	for index, k, bandMark in _band_keys(D, tile[0].shape[2]):
+		yield _band_array(tile, index)[:, :, k], bandMark, index
+
+
+def _band_keys(D, n_channels):
+	# (index of the band array in the tile, channel, bandMark) of every band in codestream order
+	for k in range(n_channels):
+		yield (0,), k, 'LL'
+		for i in range(1, D + 1):
+			for n, bandMark in enumerate(['LH', 'HL', 'HH']):
+				yield (i, n), k, bandMark
+
+
+def _band_array(tile, index):
+	for i in index:
+		tile = tile[i]
+	return tile
+
+
+def _band_encode(tile, bandMark, h=64, w=64, num=8, mq_coder="fast", truncation=False, bypass=None, terminate=False, fused=True, backend="python", auto=False, budget=None):
+	# return height, width, h, w and the coded code blocks of a band in raster order, see _block_encode
+	# auto: whether h * w is only the largest code block shape, see _auto_block_shape
+	# budget: bit-plane budget of the band from _band_budget, or None
+	if auto:
+		h, w = _auto_block_shape(*np.shape(tile), h, w)
+	h_cA, w_cA, bitPlanes = _band_blocks(tile, h, w)
+	encoder = MQEncoder()
+	blocks = [_block_encode(bitPlane, signs, bandMark, *np.shape(signs), mq_coder, encoder, truncation, bypass, terminate, fused, backend, budget) for bitPlane, signs in bitPlanes]
+	return h_cA, w_cA, h, w, blocks
+
+
+def _band_blocks(tile, h=64, w=64):
+	# return height and width of a band and (bitPlane, signs) of its code blocks in raster order
+	# code blocks on the bottom and right edges are cut to the band, see _block_shape
 	h_cA, w_cA = np.shape(tile)
-	h_left_over = h_cA % h
-	w_left_over = w_cA % w
-	cA_extend = np.pad(tile, ((0, h - h_left_over), (0, w - w_left_over)), 'constant')
-	bitcode = [h_cA, w_cA]
-	streamOnly = []
-	for i in range(0, h_cA, h):
-		for j in range(0, w_cA, w):
-			codeBlock = cA_extend[i:i + h, j:j + w]
-			CX, D, bitplanelength= _embeddedBlockEncoder(codeBlock, bandMark, h, w, num)
-			encoder = _MQencode(CX, D)
-			bitcode = np.hstack((bitcode, CX.flatten(), [2048], encoder.stream, [2048], bitplanelength,[2048]))
-			streamOnly = np.hstack((streamOnly, encoder.stream))
-		bitcode = np.hstack((bitcode, [2049]))
-	bitcode = np.hstack((bitcode, [2050]))
-	return (bitcode, streamOnly)
-
-
-def _embeddedBlockEncoder(codeBlock, bandMark, h=64, w=64, num=8):
-	S1 = np.zeros((h, w))
-	S2 = np.zeros((h, w))
-	S3 = np.zeros((h, w))
-	MaxInCodeBlock = len(bin(int(np.max(abs(codeBlock)))))-2
-	signs = (- np.sign(codeBlock) + 1) // 2  # positive: 0, negative: 1
-	bitPlane = np.zeros((h,w,MaxInCodeBlock),dtype=np.uint8)
-	for i in range(h):
-		for j in range(w):
-			# number = bin(np.abs(codeBlock[i][j], dtype=np.int64))[2:]
-			number = bin(np.abs(codeBlock[i][j]))[2:]
-			temp = [0] * (MaxInCodeBlock-len(number)) + [int(num) for num in number]
-			bitPlane[i][j] = np.array(temp)
-	bitPlane = np.transpose(bitPlane, (2, 0, 1))
+	cA_extend = np.pad(tile, ((0, -h_cA % h), (0, -w_cA % w)), 'constant')
+	codeBlocks = _code_blocks(cA_extend, h, w)
+	h_num, w_num = codeBlocks.shape[:2]
+	# bit-planes of every code block are extracted by one vectorized call
+	bitPlanes, signs, planeNums = _bit_planes(codeBlocks)
+	planes = bitPlanes.shape[2]
+	blocks = []
+	for i in range(h_num):
+		for j in range(w_num):
+			rows, cols = _block_shape(h_cA, w_cA, h, w, i, j)
+			blocks.append((bitPlanes[i, j, planes - planeNums[i, j]:, :rows, :cols], signs[i, j, :rows, :cols]))
+	return h_cA, w_cA, blocks
+
+
+def _block_shape(h_cA, w_cA, h, w, i, j):
+	# shape of the code block (i, j) of a band of h_cA * w_cA split into h * w code blocks, edge blocks are cut to the band
+	return min(h, h_cA - i * h), min(w, w_cA - j * w)
+
+
+def _auto_block_shape(h_cA, w_cA, h=64, w=64):
+	# code block shape of at most h * w that splits a band of h_cA * w_cA into as few code blocks of about equal size,
+	# so that no thin code blocks are left over on the edges. Heights are rounded up to whole stripes of 4 rows
+	h_num, w_num = max(-(-h_cA // h), 1), max(-(-w_cA // w), 1)
+	return min(h, 4 * -(-h_cA // (4 * h_num))), -(-w_cA // w_num)
+
+
+def _block_encode(bitPlane, signs, bandMark, h=64, w=64, mq_coder="fast", encoder=None, truncation=False, bypass=None, terminate=False, fused=True, backend="python", budget=None):
+	# return the coded code block (number of bit-planes, number of coding passes, stream, rates, distortions)
+	# encoder: MQEncoder to reuse, a new one is created if it is None
+	# truncation: whether to record the truncation points, rates[n] is the length of stream needed to decode the first n
+	# coding passes and distortions[n] is the squared error of the block decoded from them, both are None otherwise
+	# bypass, terminate: coding segments of the block, see _segments
+	# fused: whether the passes code their symbols straight into the fast MQ coder, or collect them first
+	# backend: "jit" codes the block by the compiled kernel of ebcot_jit, see _jit_block_encode
+	# budget: (max_planes, drop_lsb_planes) of the band, only the planes within it are coded, see _coded_planes
+	num = len(bitPlane)
+	if not num:
+		return _empty_block(truncation)
+	if budget is not None:
+		planes = _coded_planes(num, budget)
+		if planes < num:
+			if not planes:
+				return _empty_block(truncation)
+			block = _block_encode(bitPlane[:planes], signs, bandMark, h, w, mq_coder, encoder, truncation, bypass, terminate, fused, backend)
+			return _budget_block(block, num, bypass, terminate)
+	if backend == "jit":
+		return _jit_block_encode(bitPlane, signs, bandMark, truncation, bypass, terminate)
+	points = [] if truncation else None
+	ends = [0]
+	if encoder is None:
+		encoder = MQEncoder()
+	if fused and mq_coder == "fast":
+		sink = _SegmentEncoder(_segments(num, bypass, terminate), encoder, truncation)
+		_embeddedBlockEncoder(bitPlane, signs, bandMark, h, w, points, ends, sink)
+		stream, rates = sink.stream()
+	else:
+		CX, D, _ = _embeddedBlockEncoder(bitPlane, signs, bandMark, h, w, points, ends)
+		segments = _segments(num, bypass, terminate)
+		if mq_coder == "reference":
+			# the reference MQ coder codes the block as one codeword, the rates come from the fast one
+			if len(segments) > 1:
+				raise ValueError("The reference MQ coder supports no bypass or terminate.")
+			stream = _MQencode(CX, D).stream.astype(np.uint8).tobytes()
+			rates = _segments_encode(CX, D, ends, segments, encoder, truncation)[1] if truncation else None
+		else:
+			stream, rates = _segments_encode(CX, D, ends, segments, encoder, truncation)
+	distortions = [distortion for _, distortion in points] if truncation else None
+	return num, 3 * num, stream, rates, distortions
+
+
+def _band_budget(budget, index):
+	# (max_planes, drop_lsb_planes) of the band at index of a tile from the budget of EBCOTCodec, None for no budget
+	# each of them is a number for all bands or a sequence of one number per item of the tile, LL first
+	if budget is None:
+		return None
+	return tuple(value if value is None or np.ndim(value) == 0 else value[index[0]] for value in budget)
+
+
+def _coded_planes(num, budget):
+	# number of the most significant bit-planes coded of a code block with num bit-planes, within the budget of its band:
+	# at most max_planes planes, None for no limit, and none of the drop_lsb_planes least significant planes
+	max_planes, drop_lsb_planes = budget
+	planes = max(num - drop_lsb_planes, 0)
+	if max_planes is not None:
+		planes = min(planes, max_planes)
+	return planes
+
+
+def _budget_block(block, num, bypass=None, terminate=False):
+	# coded block of num bit-planes from its most significant planes coded as a block of their own
+	# the block keeps num in its BLOCK_HEADER and has the coding passes of the coded planes only, so the decoder stops
+	# after them and leaves the planes below 0. The segment index is extended to the segments of num planes, the segments
+	# left are empty. Distortions are scaled to the magnitudes of num planes, without the error of the planes left
+	planes, passes, stream, rates, distortions = block
+	segments, coded = _segments(num, bypass, terminate), _segments(planes, bypass, terminate)
+	if len(segments) > 1:
+		if len(coded) > 1:
+			lengths = np.frombuffer(stream, dtype=_INDEX_DTYPE, count=len(coded))
+			stream = stream[lengths.nbytes:]
+		else:
+			lengths = np.array([len(stream)], dtype=_INDEX_DTYPE)
+		segmentIndex = np.zeros(len(segments), dtype=_INDEX_DTYPE)
+		segmentIndex[:len(lengths)] = lengths
+		if rates is not None:
+			extra = segmentIndex.nbytes - (lengths.nbytes if len(coded) > 1 else 0)
+			rates = rates[:1] + [rate + extra for rate in rates[1:]]
+		stream = segmentIndex.tobytes() + stream
+	if distortions is not None:
+		distortions = [distortion * 4 ** (num - planes) for distortion in distortions]
+	return num, passes, stream, rates, distortions
+
+
+def _context_statistics(coeffs, inside, nums, planes, bandMark, bypass=None, terminate=False):
+	"""
+	Count the symbols the coding passes would code in every context, plane by plane for a stack of code blocks at once.
+
+	coeffs is a (n, h, w) stack of code blocks with h a multiple of 4, inside marks their coefficients and the first planes[k] of the nums[k] bit-planes of block k are coded. The passes of a plane visit the coefficients in the scan order of the stripes, so a coefficient sees the significance of the coefficients before it in the scan as it is after the pass and of the others as it is before. The symbols and contexts are exactly the ones of _embeddedBlockEncoder, only their order is lost.
+
+	Returns
+	-------
+	counts: ndarray of int
+		Number of the MQ coded symbols of every block, context and value, with shape (n, contexts, 2).
+	rawBytes: ndarray of int
+		Bytes of the raw segments of every block, see _segments.
+	passes: ndarray of int
+		Number of the symbols of every block and coding pass, MQ coded or raw, with shape (n, 3 * max(nums)).
+	"""
+	n, h, w = np.shape(coeffs)
+	n_contexts = len(mq_table[1])
+	P = int(np.max(nums, initial=0))
+	magnitudes = np.abs(coeffs)
+	signs = (coeffs < 0).astype(np.uint8)
+	zeroContexts = _ZC_TABLE[_BAND_INDEX[bandMark]]
+	counts = np.zeros(n * 2 * n_contexts, dtype=np.int64)
+	rawBytes = np.zeros(n, dtype=np.int64)
+	passes = np.zeros((n, 3 * P), dtype=np.int64)
+	rows = np.arange(4).reshape(1, 1, 4, 1)
+	full = inside.reshape(n, h // 4, 4, w).all(axis=2)
+	for b in range(P - 1, -1, -1):
+		# only the blocks coded in this plane
+		live = np.flatnonzero((b < nums) & (b >= nums - planes))
+		if not len(live):
+			continue
+		m = len(live)
+		plane = nums[live] - 1 - b
+		keys = np.broadcast_to((live * 2 * n_contexts).reshape(-1, 1, 1), (m, h, w))
+		shifted = magnitudes[live] >> b
+		coded = inside[live]
+		significant = shifted > 1
+		bits = (shifted & 1).astype(np.uint8)
+		ones = bits > 0
+		nb = _neighbours(significant)
+		insignificant = coded & ~significant
+		# the significance propagation pass codes the coefficients with a significant neighbour when it visits them,
+		# the ones it makes significant before them included, which converges in as many rounds as the longest chain
+		propagation = insignificant & (nb > 0)
+		while True:
+			spNb = nb | _preceding_neighbours(propagation & ones)
+			grown = insignificant & (spNb > 0)
+			if np.array_equal(grown, propagation):
+				break
+			propagation = grown
+		nb |= _neighbours(propagation & ones)
+		refinement = coded & significant
+		cleanup = insignificant & ~propagation
+		cuNb = nb | _preceding_neighbours(cleanup & ones)
+		# run-length coding of the stripe columns of 4 rows left to the cleanup pass whose neighbourhood is insignificant
+		# when the pass reaches them, up to the first significant row
+		runNb = nb | _preceding_neighbours(cleanup & ones, column=False)
+		stripeBits = bits.reshape(m, h // 4, 4, w)
+		run = full[live] & (cleanup & (runNb == 0)).reshape(m, h // 4, 4, w).all(axis=2)
+		hit = run & stripeBits.any(axis=2)
+		first = np.argmax(stripeBits, axis=2)[:, :, np.newaxis, :]
+		skipped = (run[:, :, np.newaxis, :] & ~(hit[:, :, np.newaxis, :] & (rows > first))).reshape(m, h, w)
+		leading = (hit[:, :, np.newaxis, :] & (rows == first)).reshape(m, h, w)
+		cleanup &= ~skipped
+
+		passBits = [
+			np.count_nonzero(propagation, axis=(1, 2)) + np.count_nonzero(propagation & ones, axis=(1, 2)),
+			np.count_nonzero(refinement, axis=(1, 2)),
+			np.count_nonzero(cleanup, axis=(1, 2)) + np.count_nonzero(cleanup & ones, axis=(1, 2))
+			+ np.count_nonzero(run, axis=(1, 2)) + 3 * np.count_nonzero(hit, axis=(1, 2))]
+		for kind in range(3):
+			passes[live, 3 * plane + kind] = passBits[kind]
+		if bypass is not None:
+			# the significance propagation and refinement symbols of the planes below bypass are raw bits
+			raw = plane >= bypass
+			if terminate:
+				rawBytes[live] += np.where(raw, -(-passBits[0] // 8) - (-passBits[1] // 8), 0)
+			else:
+				rawBytes[live] += np.where(raw, -(-(passBits[0] + passBits[1]) // 8), 0)
+			refinement &= ~raw.reshape(-1, 1, 1)
+			propagation &= ~raw.reshape(-1, 1, 1)
+		blockSigns = signs[live]
+		# the refined flag of a significant coefficient is set once it went through a refinement pass
+		symbols = [
+			(refinement, _MR_TABLE[nb[refinement] | _REFINED * (shifted[refinement] > 3)], bits[refinement]),
+			(propagation, zeroContexts[spNb[propagation]], bits[propagation]),
+			(cleanup, zeroContexts[cuNb[cleanup]], bits[cleanup])]
+		for mask, maskNb in [(propagation & ones, spNb), ((cleanup & ones) | leading, cuNb)]:
+			symbols.append((mask, _SC_CONTEXT[maskNb[mask]], blockSigns[mask] ^ _SC_PREDICT[maskNb[mask]]))
+		for mask, contexts, values in symbols:
+			counts += np.bincount(keys[mask] + 2 * contexts.astype(np.int64) + values, minlength=len(counts))
+		# a run codes one symbol in context 17, and the position of its first significant row by 2 uniform symbols
+		counts += np.bincount(keys[:, :h // 4][run] + 2 * 17 + hit[run], minlength=len(counts))
+		position = first[:, :, 0, :][hit]
+		counts += np.bincount(np.concatenate([keys[:, :h // 4][hit]] * 2) + 2 * 18 + np.concatenate([position >> 1, position & 1]), minlength=len(counts))
+	return counts.reshape(n, n_contexts, 2), rawBytes, passes
+
+
+def _neighbours(significant):
+	# neighbour flags of a stack of code blocks from the significance of their coefficients, as in the packed states
+	padded = np.pad(significant, ((0, 0), (1, 1), (1, 1))).view(np.uint8)
+	return (_NB_N * padded[:, :-2, 1:-1] | _NB_S * padded[:, 2:, 1:-1] | _NB_W * padded[:, 1:-1, :-2] | _NB_E * padded[:, 1:-1, 2:]
+		| _NB_NW * padded[:, :-2, :-2] | _NB_NE * padded[:, :-2, 2:] | _NB_SW * padded[:, 2:, :-2] | _NB_SE * padded[:, 2:, 2:]).astype(np.uint8)
+
+
+def _preceding_neighbours(significant, column=True):
+	# neighbour flags of the significant coefficients that a pass visits before each coefficient of a stack of code blocks:
+	# the ones of the previous stripe column, the previous stripe and, if column, above it in its stripe column
+	padded = np.pad(significant, ((0, 0), (1, 1), (1, 1))).view(np.uint8)
+	top = (np.arange(significant.shape[1]) % 4 == 0).reshape(1, -1, 1)
+	bottom = (np.arange(significant.shape[1]) % 4 == 3).reshape(1, -1, 1)
+	above = padded[:, :-2, 1:-1] if column else padded[:, :-2, 1:-1] & top
+	return (_NB_N * above | _NB_W * padded[:, 1:-1, :-2] | _NB_NW * padded[:, :-2, :-2]
+		| _NB_NE * (padded[:, :-2, 2:] & top) | _NB_SW * (padded[:, 2:, :-2] & ~bottom)).astype(np.uint8)
+
+
+def _block_estimate(counts, rawBytes, passes, num, planes, bypass=None, terminate=False):
+	# return the predicted bytes of the payload of a code block, see _block_payload, from its counts, rawBytes and passes
+	# of _context_statistics. The code length of the MQ segments is the one of an adaptive binary model of every context,
+	# see _adaptive_bits, the MQ coder adapts to the same statistics but a little slower. Each MQ codeword adds its
+	# termination unless it codes no symbol, which is coded to nothing, and the block its segment index
+	if not planes:
+		return 0
+	segments = _segments(planes, bypass, terminate)
+	flushes = sum(1 for first, end, raw in segments if not raw and np.any(passes[first:end]))
+	length = _adaptive_bits(counts) / 8 + _FLUSH_BYTES * flushes + rawBytes
+	n_segments = len(_segments(num, bypass, terminate))
+	if n_segments > 1:
+		length += n_segments * _INDEX_DTYPE.itemsize
+	return _BLOCK_HEADER.size + int(round(length))
+
+
+def _adaptive_bits(counts):
+	# code length in bits of symbols counted per context in a (contexts, 2) array by an adaptive binary model of every
+	# context, the Krichevsky-Trofimov estimator, whose code length only depends on the counts. Symbols of the uniform
+	# context 18 take 1 bit each
+	bits = float(np.sum(counts[18]))
+	for n0, n1 in counts[:18].tolist():
+		bits += (math.lgamma(n0 + n1 + 1) + 2 * math.lgamma(0.5) - math.lgamma(n0 + 0.5) - math.lgamma(n1 + 0.5)) / math.log(2)
+	return bits
+
+
+def _jit_block_encode(bitPlane, signs, bandMark, truncation=False, bypass=None, terminate=False):
+	# _block_encode of a non-empty code block by ebcot_jit.encode_block
+	num = len(bitPlane)
+	segments = np.array(_segments(num, bypass, terminate), dtype=np.int64)
+	out, lengths, rates, distortions = ebcot_jit.encode_block(
+		np.ascontiguousarray(bitPlane), np.ascontiguousarray(signs), _ZC_TABLE[_BAND_INDEX[bandMark]], _SC_CONTEXT, _SC_PREDICT, _MR_TABLE, segments, truncation)
+	payloads = [payload.tobytes() for payload in np.split(out, np.cumsum(lengths)[:-1])]
+	rates = rates.tolist() if truncation else None
+	stream = _segments_stream(payloads, rates)
+	return num, 3 * num, stream, rates, distortions.tolist() if truncation else None
+
+
+def _empty_block(truncation=False):
+	# coded all-zero code block, it has no bit-planes and no coding passes
+	return 0, 0, b"", [0] if truncation else None, [0.0] if truncation else None
+
+
+def _segments(num, bypass=None, terminate=False):
+	# (first pass, end pass, raw) of the coding segments of a code block with num bit-planes
+	# without bypass all 3 * num passes are one MQ codeword. With bypass the passes of the first bypass planes are one MQ
+	# codeword, then the significance propagation and magnitude refinement passes of each plane are a raw segment and
+	# its cleanup pass is an MQ codeword. With terminate every pass is a segment of its own, raw or not as with bypass.
+	# MQ codewords are terminated and keep the context states of the previous ones.
+	if terminate:
+		return [(n, n + 1, bypass is not None and n // 3 >= bypass and n % 3 != 2) for n in range(3 * num)]
+	if bypass is None or num <= bypass:
+		return [(0, 3 * num, False)]
+	segments = [(0, 3 * bypass, False)]
+	for i in range(bypass, num):
+		segments.extend([(3 * i, 3 * i + 2, True), (3 * i + 2, 3 * i + 3, False)])
+	return segments
+
+
+def _segments_encode(CX, D, ends, segments, encoder, truncation=False):
+	# code the symbols of each segment, ends[n] is the number of symbols of the first n passes
+	# return the stream, with a segment index ahead of the segments if there are more than one, and the rates as _block_encode
+	encoder.reset()
+	payloads, rates = [], [0]
+	length = 0
+	for first, end, raw in segments:
+		start = ends[first]
+		if raw:
+			payload = np.packbits(D[start:ends[end], 0].astype(np.uint8)).tobytes()
+			if truncation:
+				for n in range(first, end):
+					rates.append(ebcot_jit.pass_rate(rates, n, length, True, ends[n + 1] - start, False, 0))
+		else:
+			encoder.restart()
+			if truncation:
+				for n in range(first, end):
+					encoder.encode_symbols(D[ends[n]:ends[n + 1], 0].tolist(), CX[ends[n]:ends[n + 1], 0].tolist())
+					rates.append(ebcot_jit.pass_rate(rates, n, length, False, 0, ends[n] == ends[n + 1], encoder.L))
+			else:
+				encoder.encode_symbols(D[start:ends[end], 0].tolist(), CX[start:ends[end], 0].tolist())
+			payload = encoder.flush()
+		payloads.append(payload)
+		length += len(payload)
+		if truncation:
+			ebcot_jit.close_segment(rates, first, end, length)
+
+	stream = _segments_stream(payloads, rates if truncation else None)
+	return stream, rates if truncation else None
+
+
+def _segments_stream(payloads, rates=None):
+	# join the payloads of the coding segments, with a segment index ahead of them if there are more than one
+	# rates are moved past the segment index in place
+	stream = b"".join(payloads)
+	if len(payloads) > 1:
+		segmentIndex = np.array([len(payload) for payload in payloads], dtype=_INDEX_DTYPE).tobytes()
+		stream = segmentIndex + stream
+		if rates is not None:
+			rates[1:] = [rate + len(segmentIndex) for rate in rates[1:]]
+	return stream
+
+
+class _SymbolArrays(object):
+	"""
+	Collects the symbols of the coding passes of a code block, returned as (n, 1) CX and D arrays by arrays.
+	"""
+
+	def __init__(self):
+		self.CX = []
+		self.D = []
+
+	def start_pass(self):
+		return self.encode
+
+	def end_pass(self, pointer):
+		pass
+
+	def encode(self, d, cx):
+		self.D.append(d)
+		self.CX.append(cx)
+
+	def arrays(self):
+		CX = np.array(self.CX, dtype=np.uint32).reshape(-1, 1)
+		D = np.array(self.D, dtype=np.uint32).reshape(-1, 1)
+		return CX, D
+
+
+class _SegmentEncoder(object):
+	"""
+	Codes the symbols of the coding passes of a code block into its coding segments as the passes produce them.
+
+	It gives the same stream and rates as _segments_encode without materializing the symbols, MQ segments are coded by encoder and raw segments collect their bits. Call start_pass before every pass with the returned function as the encode function of the pass, end_pass after it with the number of symbols so far, and stream after the last pass.
+	"""
+
+	def __init__(self, segments, encoder, truncation=False):
+		self.segments = segments
+		self.encoder = encoder
+		self.truncation = truncation
+		self.payloads = []
+		self.rates = [0]
+		self.length = 0
+		self.n = 0  # passes coded
+		self.k = 0  # segments completed
+		self.pointer = 0
+		self.bits = []
+		encoder.reset()
+
+	def start_pass(self):
+		first, _, raw = self.segments[self.k]
+		if raw:
+			if self.n == first:
+				self.bits = []
+			return self._raw
+		if self.n == first:
+			self.encoder.restart()
+		return self.encoder.encode
+
+	def end_pass(self, pointer):
+		first, end, raw = self.segments[self.k]
+		self.n += 1
+		if self.truncation:
+			self.rates.append(ebcot_jit.pass_rate(self.rates, self.n - 1, self.length, raw, len(self.bits), pointer == self.pointer, self.encoder.L))
+		self.pointer = pointer
+		if self.n == end:
+			self._end_segment(first, end, raw)
+
+	def stream(self):
+		# return the stream and the rates as _segments_encode, segments without passes are coded empty
+		while self.k < len(self.segments):
+			first, end, raw = self.segments[self.k]
+			if not raw:
+				self.encoder.restart()
+			self.bits = []
+			self._end_segment(first, end, raw)
+		stream = _segments_stream(self.payloads, self.rates if self.truncation else None)
+		return stream, self.rates if self.truncation else None
+
+	def _raw(self, d, cx):
+		self.bits.append(d)
+
+	def _end_segment(self, first, end, raw):
+		payload = np.packbits(np.array(self.bits, dtype=np.uint8)).tobytes() if raw else self.encoder.flush()
+		self.payloads.append(payload)
+		self.length += len(payload)
+		if self.truncation:
+			ebcot_jit.close_segment(self.rates, first, end, self.length)
+		self.k += 1
+
+
+def _block_payload(block):
+	# BLOCK_HEADER and stream of a coded code block, nothing if the block is empty
+	num, passes, stream, _, _ = block
+	if not passes:
+		return b""
+	return _BLOCK_HEADER.pack(num, passes) + stream
+
+
+def _tile_pixels(bands, D):
+	# number of coefficients of the first channel, which is close to the number of pixels of the tile
+	return sum(h_cA * w_cA for h_cA, w_cA, _, _, _ in bands[:3 * D + 1])
+
+
+def _rate_control(tiles, target, delta_bs=None):
+	"""
+	Post-compression rate-distortion optimization (PCRD-opt) of the coded tiles from _tile_code, in place.
+
+	Distortions of code blocks are weighted by their contribution to the squared error of the image, see _band_weights, delta_bs are the quantization steps of quantization_steps or None if the coefficients were not quantized. Every code block is cut at a truncation point on the convex hull of its rate-distortion curve: segments of all hulls are taken from the largest distortion decrease per byte down, until the codestreams of all tiles would exceed target bytes.
+	"""
+	overhead = 0
+	blocks, segments = [], []
+	weights = {}
+	for D, n_channels, bands in tiles:
+		if D not in weights:
+			weights[D] = _band_weights(D, delta_bs)
+		overhead += _TILE_HEADER.size + 2 * _INDEX_DTYPE.itemsize * len(bands)
+		for (index, _, _), (_, _, _, _, bandBlocks) in zip(_band_keys(D, n_channels), bands):
+			weight = weights[D][index]
+			overhead += _BAND_HEADER.size
+			if any(block[0] for block in bandBlocks):
+				overhead += 2 * _INDEX_DTYPE.itemsize * len(bandBlocks) + _BLOCK_HEADER.size * sum(1 for block in bandBlocks if block[0])
+			for n, block in enumerate(bandBlocks):
+				rates, distortions = block[3], block[4]
+				points, slopes = _hull(rates, [weight * d for d in distortions])
+				for previous, point, slope in zip([0] + points[:-1], points, slopes):
+					segments.append((slope, len(blocks), point, rates[point] - rates[previous]))
+				blocks.append((bandBlocks, n))
+
+	budget = target - overhead
+	cuts = [0] * len(blocks)
+	for slope, k, point, rate in sorted(segments, key=lambda segment: segment[0], reverse=True):
+		if rate > budget:
+			break
+		budget -= rate
+		cuts[k] = point
+
+	for (bandBlocks, n), cut in zip(blocks, cuts):
+		num, passes, stream, rates, _ = bandBlocks[n]
+		if cut < passes:
+			bandBlocks[n] = (num, cut, stream[:rates[cut]], None, None)
+
+
+def _band_weights(D, delta_bs=None):
+	# weight of the squared error of a coefficient of every band in the squared error of the image, by band index of _band_keys
+	# it is the squared synthesis norm of the band, times the squared quantization step of the band if delta_bs is given,
+	# the LL band is quantized with the step of the coarsest level as by Quantizer
+	norms = synthesis_norms(_WAVELET, D)
+	steps = [1.0] * D if delta_bs is None else delta_bs
+	weights = {(0,): (norms[0] * steps[0]) ** 2}
+	for i in range(1, D + 1):
+		for n in range(3):
+			weights[(i, n)] = (norms[i][n] * steps[i - 1]) ** 2
+	return weights
+
+
+def _hull(rates, distortions):
+	# truncation points on the lower convex hull of a rate-distortion curve starting from point 0,
+	# and the distortion decrease per byte of the hull segment ending at each of them
+	points, slopes = [0], [np.inf]
+	for k in range(1, len(rates)):
+		if distortions[k] >= distortions[points[-1]]:
+			continue
+		while True:
+			rate = rates[k] - rates[points[-1]]
+			slope = (distortions[points[-1]] - distortions[k]) / rate if rate > 0 else np.inf
+			if len(points) > 1 and slope >= slopes[-1]:
+				points.pop()
+				slopes.pop()
+			else:
+				break
+		points.append(k)
+		slopes.append(slope)
+	return points[1:], slopes[1:]
+
+
+def _schedule(func, tasks, costs, pool):
+	"""
+	Run func(*task) for every task in pool and return the results in the order of tasks.
+
+	Tasks are handed out one by one from the largest cost down, so that large code blocks start first and small ones fill the gaps at the end.
+	"""
+	order = sorted(range(len(tasks)), key=lambda k: costs[k], reverse=True)
+	results = [None] * len(tasks)
+	for k, result in zip(order, pool.starmap(func, [tasks[k] for k in order], chunksize=1)):
+		results[k] = result
+	return results
+
+
+def _parallel_encode(tiles, D, mq_coder, pool, h=64, w=64, truncation=False, bypass=None, terminate=False, fused=True, backend="python", auto=False, budget=None):
+	# code blocks of all tiles are coded as independent tasks of pool, return (D, n_channels, bands) of every tile as _tile_code
+	# tiles are passed to the workers through shared memory, each task only carries the location of its code block
+	with SharedArrays.copy(tiles) as shared:
+		bands, tasks, costs = [], [], []
+		for t, tile in enumerate(tiles):
+			for index, k, bandMark in _band_keys(D, tile[0].shape[2]):
+				band = _band_array(tile, index)[:, :, k]
+				h_cA, w_cA = np.shape(band)
+				bh, bw = _auto_block_shape(h_cA, w_cA, h, w) if auto else (h, w)
+				h_num, w_num = -(-h_cA // bh), -(-w_cA // bw)
+				band_extend = np.zeros((h_num * bh, w_num * bw), dtype=np.int64)
+				band_extend[:h_cA, :w_cA] = band
+				planeNums = _plane_numbers(np.abs(_code_blocks(band_extend, bh, bw)))
+				# empty code blocks are not sent to the pool
+				bands.append((h_cA, w_cA, bh, bw, planeNums.ravel().tolist()))
+				for i in range(h_num):
+					for j in range(w_num):
+						if planeNums[i, j]:
+							tasks.append([_shared_block_encode, shared.descriptor(t), None, index, k, i, j, bandMark, bh, bw, mq_coder, truncation, bypass, terminate, fused, backend, _band_budget(budget, index)])
+							costs.append(planeNums[i, j] * bh * bw)
+		coded = iter(_schedule(call_shared, tasks, costs, pool))
+
+	codedTiles = []
+	bands = iter(bands)
+	for tile in tiles:
+		n_channels = tile[0].shape[2]
+		tileBands = []
+		for _ in range(n_channels * (3 * D + 1)):
+			h_cA, w_cA, bh, bw, planeNums = next(bands)
+			tileBands.append((h_cA, w_cA, bh, bw, [next(coded) if num else _empty_block(truncation) for num in planeNums]))
+		codedTiles.append((D, n_channels, tileBands))
+	return codedTiles
+
+
+def _shared_block_encode(tile, _, index, k, i, j, bandMark, h=64, w=64, mq_coder="fast", truncation=False, bypass=None, terminate=False, fused=True, backend="python", budget=None):
+	# code the block (i, j) of channel k of the band tile[index] in shared memory, edge blocks are cut to the band
+	band = _band_array(tile, index)
+	coeffs = band[i * h:(i + 1) * h, j * w:(j + 1) * w, k]
+	bitPlane, signs, _ = _bit_planes(coeffs)
+	return _block_encode(bitPlane, signs, bandMark, *coeffs.shape, mq_coder, truncation=truncation, bypass=bypass, terminate=terminate, fused=fused, backend=backend, budget=budget)
+
+
+def _lockstep_code(tiles, D, h=64, w=64, truncation=False, bypass=None, terminate=False, pool=None, n_batches=1, auto=False, budget=None):
+	# return (D, n_channels, bands) of every tile as _tile_code, the code blocks of all tiles are coded in lockstep batches
+	# blocks of the same shape are sorted by their number of bit-planes so that a batch holds blocks of about the same depth
+	# pool: pool to code the batches in, or None. n_batches: number of batches wanted to keep the workers of pool busy
+	groups, bands = {}, []
+	n_blocks = 0
+	for tile in tiles:
+		tileBands = []
+		for band, bandMark, index in _tile_bands(tile, D):
+			h_cA, w_cA = np.shape(band)
+			bh, bw = _auto_block_shape(h_cA, w_cA, h, w) if auto else (h, w)
+			h_num, w_num = -(-h_cA // bh), -(-w_cA // bw)
+			bandBudget = _band_budget(budget, index)
+			for i in range(h_num):
+				for j in range(w_num):
+					block = band[i * bh:(i + 1) * bh, j * bw:(j + 1) * bw]
+					numbers, blocks, bandMarks, budgets = groups.setdefault(block.shape, ([], [], [], []))
+					numbers.append(n_blocks)
+					blocks.append(block)
+					bandMarks.append(bandMark)
+					budgets.append(bandBudget)
+					n_blocks += 1
+			tileBands.append((h_cA, w_cA, bh, bw, h_num * w_num))
+		bands.append(tileBands)
+
+	# batches below a quarter of _LOCKSTEP_BATCH blocks lose most of the gain of lockstep coding, even with idle workers
+	size = min(_LOCKSTEP_BATCH, max(-(-n_blocks // n_batches), _LOCKSTEP_BATCH // 4))
+	stacks, batches = [], []
+	for numbers, blocks, bandMarks, budgets in groups.values():
+		blocks = np.array(blocks, dtype=np.int64)
+		order = np.argsort(_plane_numbers(np.abs(blocks)), kind="stable").tolist()
+		stacks.append(blocks[order])
+		numbers = [numbers[k] for k in order]
+		bandMarks = [bandMarks[k] for k in order]
+		budgets = [budgets[k] for k in order] if budget is not None else None
+		for start in range(0, len(order), size):
+			end = min(start + size, len(order))
+			batches.append((len(stacks) - 1, start, end, numbers[start:end], bandMarks[start:end], budgets and budgets[start:end]))
+	if pool is None:
+		results = [_lockstep_encode(stacks[g][start:end], bandMarks, truncation, bypass, terminate, budgets) for g, start, end, _, bandMarks, budgets in batches]
+	else:
+		with SharedArrays.copy(stacks) as shared:
+			tasks = [[_shared_lockstep_encode, shared.descriptor(g), None, start, end, bandMarks, truncation, bypass, terminate, budgets] for g, start, end, _, bandMarks, budgets in batches]
+			results = _schedule(call_shared, tasks, [(end - start) * stacks[g][0].size for g, start, end, _, _, _ in batches], pool)
+	coded = [None] * n_blocks
+	for (_, _, _, numbers, _, _), result in zip(batches, results):
+		for k, block in zip(numbers, result):
+			coded[k] = block
+
+	codedTiles = []
+	coded = iter(coded)
+	for tile, tileBands in zip(tiles, bands):
+		codedTiles.append((D, tile[0].shape[2], [(h_cA, w_cA, bh, bw, [next(coded) for _ in range(n)]) for h_cA, w_cA, bh, bw, n in tileBands]))
+	return codedTiles
+
+
+def _shared_lockstep_encode(blocks, _, start, end, bandMarks, truncation=False, bypass=None, terminate=False, budgets=None):
+	# code blocks[start:end] in shared memory in lockstep
+	return _lockstep_encode(blocks[start:end], bandMarks, truncation, bypass, terminate, budgets)
+
+
+def _lockstep_encode(coeffs, bandMarks, truncation=False, bypass=None, terminate=False, budgets=None):
+	"""
+	Code a batch of code blocks in lockstep and return the coded blocks as _block_encode, with the same streams.
+
+	coeffs is a (n, h, w) stack of code blocks and bandMarks the band of each. The blocks go through their coding passes together, see _LockstepEncoder, so the interpreter overhead is paid once per coefficient position of the batch instead of once per coefficient of every block. This pays off from a few dozen dense blocks on. budgets is the bit-plane budget of the band of each block, see _block_encode, or None.
+	"""
+	if budgets is not None:
+		# the planes of a block within its budget are the planes of its magnitudes shifted by the planes left
+		magnitudes = np.abs(coeffs)
+		fullNums = _plane_numbers(magnitudes)
+		shifts = fullNums - [_coded_planes(num, budget) for num, budget in zip(fullNums.tolist(), budgets)]
+		magnitudes = magnitudes >> shifts.reshape(-1, 1, 1)
+		coeffs = np.where(coeffs < 0, -magnitudes, magnitudes)
+	bitPlanes, signs, nums = _bit_planes(coeffs)
+	coded = [_empty_block(truncation)] * len(coeffs)
+	ks = np.flatnonzero(nums)
+	if ks.size:
+		h, w = np.shape(coeffs)[1:]
+		engine = _LockstepEncoder(bitPlanes[ks], signs[ks], nums[ks], [bandMarks[k] for k in ks.tolist()], h, w, truncation, bypass, terminate)
+		for k, block in zip(ks.tolist(), engine.encode()):
+			coded[k] = block if budgets is None or not shifts[k] else _budget_block(block, fullNums[k], bypass, terminate)
+	return coded
+
+
+class _LockstepEncoder(object):
+	"""
+	Coding passes of a batch of code blocks run in lockstep.
+
+	The packed states and stripe column activities of all blocks are arrays with the block as first axis. The passes visit each coefficient position once for the whole batch: flags, contexts and decisions of the blocks that code a symbol there are gathered with array indexing, and the symbols go to an MQBatchEncoder, or to raw bit buffers in bypassed passes. A block of num bit-planes joins the batch at plane P - num, P being the largest number of planes, so that all blocks code the same bit at the same time.
+	"""
+
+	def __init__(self, bitPlanes, signs, nums, bandMarks, h=64, w=64, truncation=False, bypass=None, terminate=False):
+		n = len(nums)
+		self.planes = bitPlanes
+		self.signs = signs
+		self.nums = np.asarray(nums)
+		self.h, self.w = h, w
+		self.truncation = truncation
+		self.state = np.zeros((n, h + 2, w + 2), dtype=np.int32)
+		self.active = np.zeros((n, -(-h // 4), w + 2), dtype=bool)
+		self.zeroContexts = _ZC_TABLE[[_BAND_INDEX[bandMark] for bandMark in bandMarks]]
+		self.mq = MQBatchEncoder(n)
+		self.counts = np.zeros(n, dtype=np.int64)
+		# coding segments of every block, the current one and the bytes and rates coded so far
+		self.segments = [_segments(num, bypass, terminate) for num in self.nums.tolist()]
+		self.k = [0] * n
+		self.payloads = [[] for _ in range(n)]
+		self.lengths = [0] * n
+		self.pointers = [0] * n
+		self.rates = [[0] for _ in range(n)]
+		self.raw = np.zeros(n, dtype=bool)
+		self.rawPass = False
+		if bypass is not None:
+			# a raw segment has at most a significance, a sign and a refinement bit of each coefficient
+			self.bits = np.zeros((n, 3 * h * w), dtype=np.uint8)
+			self.nbits = np.zeros(n, dtype=np.int64)
+		if truncation:
+			self.magnitudes = np.zeros((n, h, w), dtype=np.int64)
+			for plane in range(bitPlanes.shape[1]):
+				self.magnitudes = (self.magnitudes << 1) | bitPlanes[:, plane]
+			self.distortions = [[distortion] for distortion in np.sum(np.square(self.magnitudes, dtype=np.float64), axis=(1, 2)).tolist()]
+
+	def encode(self):
+		# run all passes and return the coded blocks
+		P = self.planes.shape[1]
+		starts = P - self.nums
+		passes = [self._significance_pass, self._refinement_pass, self._cleanup_pass]
+		for g in range(P):
+			live = starts <= g
+			ks = np.flatnonzero(live)
+			for kind, codePass in enumerate(passes):
+				numbers = (3 * (g - starts[ks]) + kind).tolist()
+				self._start_pass(ks, numbers)
+				codePass(g, live)
+				self._end_pass(ks, numbers, P - 1 - g, kind)
+			self.state &= ~_CODED
+
+		coded = []
+		for b, num in enumerate(self.nums.tolist()):
+			rates = self.rates[b] if self.truncation else None
+			stream = _segments_stream(self.payloads[b], rates)
+			coded.append((num, 3 * num, stream, rates, self.distortions[b] if self.truncation else None))
+		return coded
+
+	def _start_pass(self, ks, numbers):
+		# switch the blocks ks to the segments of their passes numbers
+		restart, rawStart = [], []
+		for b, n in zip(ks.tolist(), numbers):
+			first, _, raw = self.segments[b][self.k[b]]
+			self.raw[b] = raw
+			if n == first:
+				(rawStart if raw else restart).append(b)
+		if restart:
+			self.mq.restart(np.array(restart))
+		if rawStart:
+			self.nbits[rawStart] = 0
+		self.rawPass = bool(self.raw[ks].any())
+
+	def _end_pass(self, ks, numbers, shift, kind):
+		# record the truncation points of the blocks ks after their passes numbers, and terminate the segments that end
+		if self.truncation:
+			magnitudes = self.magnitudes[ks]
+			error = magnitudes & ((1 << shift) - 1)
+			if kind < 2:
+				visited = self.state[ks, 1:-1, 1:-1] & (_CODED if kind == 0 else _CODED | _SIG)
+				error = np.where(visited != 0, error, magnitudes & ((2 << shift) - 1))
+			distortions = np.sum(np.square(error, dtype=np.float64), axis=(1, 2)).tolist()
+			L = self.mq.L[ks].tolist()
+		counts = self.counts[ks].tolist()
+		ended, mqEnded = [], []
+		for j, (b, n) in enumerate(zip(ks.tolist(), numbers)):
+			first, end, raw = self.segments[b][self.k[b]]
+			if self.truncation:
+				rates = self.rates[b]
+				rates.append(ebcot_jit.pass_rate(rates, n, self.lengths[b], raw, int(self.nbits[b]) if raw else 0, counts[j] == self.pointers[b], L[j]))
+				self.distortions[b].append(distortions[j])
+			self.pointers[b] = counts[j]
+			if n + 1 == end:
+				ended.append(b)
+				if not raw:
+					mqEnded.append(b)
+		if mqEnded:
+			mqPayloads = dict(zip(mqEnded, self.mq.flush(np.array(mqEnded))))
+		for b in ended:
+			first, end, raw = self.segments[b][self.k[b]]
+			payload = np.packbits(self.bits[b, :self.nbits[b]]).tobytes() if raw else mqPayloads[b]
+			self.payloads[b].append(payload)
+			self.lengths[b] += len(payload)
+			if self.truncation:
+				ebcot_jit.close_segment(self.rates[b], first, end, self.lengths[b])
+			self.k[b] += 1
+
+	def _emit(self, bs, symbols, cxs):
+		# code symbols[k] with context label cxs[k] in block bs[k]
+		self.counts[bs] += 1
+		if self.rawPass:
+			raw = self.raw[bs]
+			if raw.any():
+				rb = bs[raw]
+				self.bits[rb, self.nbits[rb]] = symbols[raw]
+				self.nbits[rb] += 1
+				bs, symbols, cxs = bs[~raw], symbols[~raw], cxs[~raw]
+		if bs.size:
+			self.mq.encode(bs, symbols, cxs)
+
+	def _sign(self, bs, nb, rows, col):
+		# code the signs of the coefficients [rows][col] of blocks bs that became significant, nb are their neighbour bits
+		if not bs.size:
+			return
+		self._emit(bs, self.signs[bs, rows, col] ^ _SC_PREDICT[nb], _SC_CONTEXT[nb])
+		r, c = rows + 1, col + 1
+		state = self.state
+		state[bs, r, c] |= _SIG
+		state[bs, r - 1, c - 1] |= _NB_SE
+		state[bs, r - 1, c] |= _NB_S
+		state[bs, r - 1, c + 1] |= _NB_SW
+		state[bs, r, c - 1] |= _NB_E
+		state[bs, r, c + 1] |= _NB_W
+		state[bs, r + 1, c - 1] |= _NB_NE
+		state[bs, r + 1, c] |= _NB_N
+		state[bs, r + 1, c + 1] |= _NB_NW
+		for dr in (-1, 0, 1):
+			stripes = np.broadcast_to((rows + dr) >> 2, bs.shape)
+			inside = (stripes >= 0) & (stripes < self.active.shape[1])
+			self.active[bs[inside], stripes[inside], col:col + 3] = True
+
+	def _significance_pass(self, g, live):
+		state, planes = self.state, self.planes
+		for i in range(self.active.shape[1]):
+			for col in range(self.w):
+				bsCol = np.flatnonzero(live & self.active[:, i, col + 1])
+				if not bsCol.size:
+					continue
+				for row in range(4 * i, min(4 * i + 4, self.h)):
+					flags = state[bsCol, row + 1, col + 1]
+					coded = ((flags & _SIG) == 0) & ((flags & _NEIGHBOURS) != 0)
+					if not coded.any():
+						continue
+					bs, nb = bsCol[coded], flags[coded] & _NEIGHBOURS
+					bits = planes[bs, g, row, col]
+					self._emit(bs, bits, self.zeroContexts[bs, nb])
+					state[bs, row + 1, col + 1] |= _CODED
+					one = bits == 1
+					self._sign(bs[one], nb[one], row, col)
+
+	def _refinement_pass(self, g, live):
+		state, planes = self.state, self.planes
+		for i in range(self.active.shape[1]):
+			for col in range(self.w):
+				bsCol = np.flatnonzero(live & self.active[:, i, col + 1])
+				if not bsCol.size:
+					continue
+				for row in range(4 * i, min(4 * i + 4, self.h)):
+					flags = state[bsCol, row + 1, col + 1]
+					refined = (flags & (_SIG | _CODED)) == _SIG
+					if not refined.any():
+						continue
+					bs, flags = bsCol[refined], flags[refined]
+					state[bs, row + 1, col + 1] |= _REFINED
+					self._emit(bs, planes[bs, g, row, col], _MR_TABLE[flags & (_REFINED | _NEIGHBOURS)])
+
+	def _cleanup_pass(self, g, live):
+		state, planes = self.state, self.planes
+		ks = np.flatnonzero(live)
+		for i in range(self.active.shape[1]):
+			stripeHeight = min(4, self.h - 4 * i)
+			for col in range(self.w):
+				# blocks code the rows of the stripe column from start on, after the run-length coding of inactive ones
+				start = np.zeros(ks.size, dtype=np.int64)
+				inactive = np.flatnonzero(~self.active[ks, i, col + 1])
+				if inactive.size and stripeHeight == 4:
+					bs = ks[inactive]
+					column = planes[bs, g, 4 * i:4 * i + 4, col]
+					hit = column.any(axis=1)
+					self._emit(bs, hit.astype(np.uint8), np.full(bs.size, 17))
+					start[inactive] = 4
+					if hit.any():
+						bs, position = bs[hit], column[hit].argmax(axis=1)
+						self._emit(bs, position >> 1, np.full(bs.size, 18))
+						self._emit(bs, position & 1, np.full(bs.size, 18))
+						rows = 4 * i + position
+						self._sign(bs, state[bs, rows + 1, col + 1] & _NEIGHBOURS, rows, col)
+						start[inactive[hit]] = position + 1
+				for ii in range(stripeHeight):
+					bsRow = ks[start <= ii]
+					if not bsRow.size:
+						continue
+					row = 4 * i + ii
+					flags = state[bsRow, row + 1, col + 1]
+					coded = (flags & (_SIG | _CODED)) == 0
+					if not coded.any():
+						continue
+					bs, nb = bsRow[coded], flags[coded] & _NEIGHBOURS
+					bits = planes[bs, g, row, col]
+					self._emit(bs, bits, self.zeroContexts[bs, nb])
+					one = bits == 1
+					self._sign(bs[one], nb[one], row, col)
+
+
+def _parallel_decode(bitcodes, mq_coder, pool, reduce=0, windows=None, backend="python"):
+	# code blocks of all tiles are decoded as independent tasks of pool, the finest reduce levels are skipped
+	# windows: window in pixels of each tile, only the code blocks it is synthesized from are decoded
+	# codestreams and decoded tiles are in shared memory, workers write their code blocks in place
+	if windows is None:
+		windows = [None] * len(bitcodes)
+	tasks, costs, structures = [], [], []
+	for t, (bitcode, window) in enumerate(zip(bitcodes, windows)):
+		codestream = memoryview(bitcode)
+		D, n_channels, bypass, terminate, bandIndex = _tile_index(codestream)
+		structure = [None] + [[None] * 3 for _ in range(D - reduce)]
+		for (index, k, bandMark), (offset, _) in zip(_band_keys(D, n_channels), bandIndex.tolist()):
+			if index[0] > D - reduce:
+				continue
+			h_cA, w_cA, h, w, blockIndex = _band_index(codestream, offset)
+			if len(index) == 1:
+				structure[0] = ArraySpec((h_cA, w_cA, n_channels), "<f8")
+			else:
+				structure[index[0]][index[1]] = ArraySpec((h_cA, w_cA, n_channels), "<f8")
+			rows, cols = _band_blocks_range(blockIndex, h, w, window, D, index)
+			for i in rows:
+				for j in cols:
+					offset, length = blockIndex[i, j].tolist()
+					if not length:
+						# empty code blocks stay 0
+						continue
+					num, _ = _BLOCK_HEADER.unpack_from(codestream, offset)
+					tasks.append([t, index, k, i, j, offset, length, bandMark, h, w, mq_coder, bypass, terminate, backend])
+					costs.append(num * h * w)
+		structures.append([structure[0]] + [tuple(details) for details in structure[1:]])
+
+	with SharedArrays.copy([np.frombuffer(bitcode, dtype=np.uint8) for bitcode in bitcodes]) as src, SharedArrays(structures) as dst:
+		tasks = [[_shared_block_decode, src.descriptor(task[0]), dst.descriptor(task[0])] + task[1:] for task in tasks]
+		_schedule(call_shared, tasks, costs, pool)
+		return dst.copy_out()
+
+
+def _shared_block_decode(codestream, tile, index, k, i, j, offset, length, bandMark, h=64, w=64, mq_coder="fast", bypass=None, terminate=False, backend="python"):
+	# decode a code block from the codestream in shared memory into the block (i, j) of channel k of tile[index]
+	band = _band_array(tile, index)
+	coeffs = band[i * h:(i + 1) * h, j * w:(j + 1) * w, k]
+	coeffs[...] = _block_decode(memoryview(codestream), offset, length, bandMark, *coeffs.shape, mq_coder, bypass=bypass, terminate=terminate, backend=backend)
+
+
+def _code_blocks(band, h=64, w=64):
+	"""
+	View a band whose shape is a multiple of (h, w) as a (h_num, w_num, h, w) stack of code blocks.
+	"""
+	h_band, w_band = np.shape(band)
+	return band.reshape(h_band // h, h, w_band // w, w).swapaxes(1, 2)
+
+
+def _bit_planes(coeffs):
+	"""
+	Decompose coefficients into magnitude bit-planes and signs in one vectorized call.
+
+	coeffs can be a single code block or a whole band of shape (h, w), or a stack of code blocks of shape (..., h, w).
+
+	Returns
+	-------
+	bitPlane: ndarray of uint8
+		Magnitude bits with shape (..., planes, h, w), ordered from the most significant plane down to bit 0. A stack shares the plane count of its largest block, so block k starts at bitPlane[k][planes - num[k]:].
+	signs: ndarray of uint8
+		Sign of each coefficient with shape (..., h, w), positive: 0, negative: 1.
+	num: int or ndarray of int
+		Number of bit-planes of each block, i.e. the bit length of its largest magnitude (0 for an all-zero block).
+	"""
+	coeffs = np.asarray(coeffs, dtype=np.int64)
+	magnitudes = np.abs(coeffs)
+	num = _plane_numbers(magnitudes)
+	shifts = np.arange(np.max(num) - 1, -1, -1, dtype=np.int64).reshape((-1, 1, 1))
+	bitPlane = ((magnitudes[..., np.newaxis, :, :] >> shifts) & 1).astype(np.uint8)
+	signs = (coeffs < 0).astype(np.uint8)
+	return bitPlane, signs, num
+
+
+def _plane_numbers(magnitudes):
+	# number of bit-planes of each (h, w) block, the bit length of its largest magnitude, 0 for an all-zero block
+	maxima = np.max(magnitudes, axis=(-2, -1))
+	num = np.zeros(np.shape(maxima), dtype=np.int64)
+	while np.any(maxima):
+		num += maxima > 0
+		maxima = maxima >> 1
+	if np.ndim(num) == 0:
+		return int(num)
+	return num
+
+
+def _embeddedBlockEncoder(bitPlane, signs, bandMark, h=64, w=64, points=None, ends=None, sink=None):
+	# input bitPlane: magnitude bits of the code block from _bit_planes, size MaxInCodeBlock*h*w
+	# input signs: positive: 0, negative: 1
+	# input points: list to record the truncation points in, or None. (number of symbols, squared error of the
+	# block decoded from them) is appended before the first coding pass and after each coding pass
+	# input ends: list to append the number of symbols after each coding pass to, or None
+	# input sink: _SegmentEncoder that codes the symbols as the passes produce them, CX and D are None then.
+	# If sink is None the symbols are returned in CX and D
+	state = _new_state(h, w)
+	active = _new_activity(h, w)
+	MaxInCodeBlock = len(bitPlane)
 	# For Test
 	"""
 	signs = np.zeros((8,8))
@@ -376,122 +1643,171 @@ def _embeddedBlockEncoder(codeBlock, bandMark, h=64, w=64, num=8):
 	bitPlane[1][5] = np.array([0,0,0,0,1,1,0,1])
 	bitPlane[1][6][6] = 1
 	"""
-	sizeofCXandD = h*w*MaxInCodeBlock *5
-	CX = np.zeros((sizeofCXandD, 1), dtype=np.uint32)
-	D = np.zeros((sizeofCXandD, 1), dtype=np.uint32)
+	symbols = _SymbolArrays() if sink is None else sink
 	pointer = 0
+	if points is not None:
+		magnitudes = np.zeros((h, w), dtype=np.int64)
+		for plane in bitPlane:
+			magnitudes = (magnitudes << 1) | plane
+		points.append((0, _distortion(magnitudes, MaxInCodeBlock)))
 	for i in range(MaxInCodeBlock ):
 		######
 		# three function need rename
-		D, CX, S1, S3, pointer = _SignifiancePropagationPass(D, CX, S1, S3, pointer, bitPlane[i], bandMark, signs, w, h)
-		D, CX, S2, pointer = _MagnitudeRefinementPass(D, CX, S1, S2, S3, pointer, bitPlane[i], w, h)
-		D, CX, pointer, S1 = _CLeanUpPass(D, CX, S1, S3, pointer, bitPlane[i], bandMark, signs, w, h)
-		S3 = np.zeros((h, w))
-	CX_final = CX[0:pointer]
-	D_final = D[0:pointer]
+		shift = MaxInCodeBlock - 1 - i
+		pointer = _SignifiancePropagationPass(symbols.start_pass(), state, active, pointer, bitPlane[i], bandMark, signs, w, h)
+		symbols.end_pass(pointer)
+		if points is not None:
+			points.append((pointer, _distortion(magnitudes, shift, state[1:-1, 1:-1] & _CODED)))
+		if ends is not None:
+			ends.append(pointer)
+		pointer = _MagnitudeRefinementPass(symbols.start_pass(), state, active, pointer, bitPlane[i], w, h)
+		symbols.end_pass(pointer)
+		if points is not None:
+			points.append((pointer, _distortion(magnitudes, shift, state[1:-1, 1:-1] & (_CODED | _SIG))))
+		if ends is not None:
+			ends.append(pointer)
+		pointer = _CLeanUpPass(symbols.start_pass(), state, active, pointer, bitPlane[i], bandMark, signs, w, h)
+		symbols.end_pass(pointer)
+		if points is not None:
+			points.append((pointer, _distortion(magnitudes, shift)))
+		if ends is not None:
+			ends.append(pointer)
+		state &= ~_CODED
+	if sink is not None:
+		return None, None, MaxInCodeBlock
+	CX_final, D_final = symbols.arrays()
 	return CX_final, D_final, MaxInCodeBlock
 
 
+def _distortion(magnitudes, shift, visited=None):
+	# squared error of magnitudes decoded down to bit shift where visited, and down to bit shift + 1 elsewhere
+	# visited is None if all coefficients are visited in the current bit-plane
+	error = magnitudes & ((1 << shift) - 1)
+	if visited is not None:
+		error = np.where(visited, error, magnitudes & ((2 << shift) - 1))
+	return float(np.sum(np.square(error, dtype=np.float64)))
+
+
+def _new_state(h=64, w=64):
+	# packed states of a code block, padded by one coefficient on each side
+	# so that the state of coefficient [row][col] is state[row + 1, col + 1]
+	return np.zeros((h + 2, w + 2), dtype=np.int32)
+
+
+def _new_activity(h=64, w=64):
+	# activity of the stripe columns of a code block, padded by one column on each side so that stripe column col of
+	# stripe i is active[i][col + 1]. A stripe column is active once any of its coefficients is significant or has a
+	# significant neighbour, until then the passes have nothing to code in it but a run-length symbol
+	return [bytearray(w + 2) for _ in range(-(-h // 4))]
+
+
+def _set_significant(state, active, row, col):
+	# mark coefficient [row][col] as significant and tell its 8 neighbours and their stripe columns in place
+	r, c = row + 1, col + 1
+	for i in {(row - 1) >> 2, row >> 2, (row + 1) >> 2}:
+		if 0 <= i < len(active):
+			active[i][col:col + 3] = b"\x01\x01\x01"
+	state[r, c] |= _SIG
+	state[r - 1, c - 1] |= _NB_SE
+	state[r - 1, c] |= _NB_S
+	state[r - 1, c + 1] |= _NB_SW
+	state[r, c - 1] |= _NB_E
+	state[r, c + 1] |= _NB_W
+	state[r + 1, c - 1] |= _NB_NE
+	state[r + 1, c] |= _NB_N
+	state[r + 1, c + 1] |= _NB_NW
+
+
 # three encode pass start here
 # in the sequence of significancePass,magnitudepass,_cleanuppass.
 
-def _SignifiancePropagationPass(D, CX, S1, S3, pointer, plane, bandMark, signs, w=64, h=64):
-	# input S1:  list of significance, size 64*64
-	# input CX: the list of context
+def _SignifiancePropagationPass(encode, state, active, pointer, plane, bandMark, signs, w=64, h=64):
+	# input encode: function called with (D, CX) of every symbol in coding order
+	# input state: packed states of the code block, updated in place
+	# input active: activity of the stripe columns from _new_activity, inactive stripe columns are skipped
 	# plane: the value of bits at this plane
 	# bandMark: LL, HL, HH, or LH
-	# pointer: the pointer of the CX
-	# S3: denote that the element has been coded
-	# output: D, CX, S1, S3, pointer
-	S1extend = np.pad(S1, ((1, 1), (1, 1)), 'constant')
-	rounds = h // 4
-	for i in range(rounds):
+	# pointer: the number of symbols coded before the pass
+	# output: pointer
+	zeroContexts = _ZC_TABLE[_BAND_INDEX[bandMark]]
+	for i in range(len(active)):
+		stripe = active[i]
+		# the last stripe of a code block whose height is not a multiple of 4 is shorter
+		rows = range(4 * i, min(4 * i + 4, h))
 		for col in range(w):
-			for ii in range(4):
-				row = 4 * i + ii
-				if S1[row][col] != 0:
+			if not stripe[col + 1]:
+				continue  # nothing is significant around the stripe column
+			for row in rows:
+				flags = state[row + 1, col + 1]
+				if flags & _SIG:
 					continue  # is significant
-				temp = S1extend[row][col] + S1extend[row + 1][col] + S1extend[row + 2][col] + S1extend[row][col + 1] + \
-							 S1extend[row + 2][col + 1] + S1extend[row][col + 2] + S1extend[row + 1][col + 2] + S1extend[row + 2][
-								 col + 2]
-				if temp == 0:
+				nb = flags & _NEIGHBOURS
+				if not nb:
 					continue  # is insignificant
-				tempCx = _ZeroCoding(S1extend[row:row + 3, col:col + 3], bandMark)
-				D[pointer][0] = plane[row][col]
-				CX[pointer][0] = tempCx
+				encode(plane[row][col], zeroContexts[nb])
 				pointer = pointer + 1
-				S3[row][col] = 1  # mark that plane[row][col] has been coded
+				state[row + 1, col + 1] |= _CODED  # mark that plane[row][col] has been coded
 				if plane[row][col] == 1:  # _signcoding
-					signComp, tempCx = _SignCoding(S1extend[row:row + 3, col:col + 3], signs[row][col])
-					D[pointer][0] = signComp
-					CX[pointer][0] = tempCx
+					encode(signs[row][col] ^ _SC_PREDICT[nb], _SC_CONTEXT[nb])
 					pointer = pointer + 1
-					S1[row][col] = 1  # mark as significant
-					S1extend = np.pad(S1, ((1, 1), (1, 1)), 'constant')
-	return D, CX, S1, S3, pointer
+					_set_significant(state, active, row, col)  # mark as significant
+	return pointer
 
 
-def _MagnitudeRefinementPass(D, CX, S1, S2, S3, pointer, plane, w=64, h=64):
-	S1extend = np.pad(S1, ((1, 1), (1, 1)), 'constant')
-	rounds = h // 4
-	for i in range(rounds):
+def _MagnitudeRefinementPass(encode, state, active, pointer, plane, w=64, h=64):
+	for i in range(len(active)):
+		stripe = active[i]
+		rows = range(4 * i, min(4 * i + 4, h))
 		for col in range(w):
-			for ii in range(4):
-				row = 4 * i + ii
-				if S1[row][col] != 1 or S3[row][col] != 0:
+			if not stripe[col + 1]:
+				continue
+			for row in rows:
+				flags = state[row + 1, col + 1]
+				if flags & (_SIG | _CODED) != _SIG:
 					continue
-				tempCx = _MagnitudeRefinementCoding(S1extend[row:row + 3, col:col + 3], S2[row][col])
-				S2[row][col] = 1  # Mark that the element has been refined
-				D[pointer][0] = plane[row][col]
-				CX[pointer][0] = tempCx
+				state[row + 1, col + 1] |= _REFINED  # Mark that the element has been refined
+				encode(plane[row][col], _MR_TABLE[flags & (_REFINED | _NEIGHBOURS)])
 				pointer = pointer + 1
-	return D, CX, S2, pointer
+	return pointer
 
 
-def _CLeanUpPass(D, CX, S1, S3, pointer, plane, bandMark, signs, w=64, h=64):
-	S1extend = np.pad(S1, ((1, 1), (1, 1)), 'constant')
-	rounds = h // 4
-	for i in range(rounds):
+def _CLeanUpPass(encode, state, active, pointer, plane, bandMark, signs, w=64, h=64):
+	zeroContexts = _ZC_TABLE[_BAND_INDEX[bandMark]]
+	for i in range(len(active)):
+		stripe = active[i]
+		# run-length coding is only used in stripes of 4 rows
+		stripeHeight = min(4, h - 4 * i)
 		for col in range(w):
 			ii = 0
 			row = 4 * i
-			tempSum = np.sum(S1extend[row:row + 6, col:col + 3]) + np.sum(S3[row:row + 4, col])
 			# 整一列未被编码，都为非重要，且领域非重要
-			if tempSum == 0:
+			# coefficients are only coded before the cleanup pass if they have a significant neighbour
+			if not stripe[col + 1] and stripeHeight == 4:
 				ii, tempD, tempCx = _RunLengthCoding(plane[row:row + 4, col])
-				if len(tempD) == 1:
-					D[pointer] = tempD
-					CX[pointer] = tempCx
-					pointer = pointer + 1
-				else:
-					D[pointer], D[pointer + 1], D[pointer + 2] = tempD[0], tempD[1], tempD[2]
-					CX[pointer], CX[pointer + 1], CX[pointer + 2] = tempCx[0], tempCx[1], tempCx[2]
-					pointer = pointer + 3
+				for d, cx in zip(tempD, tempCx):
+					encode(d, cx)
+				pointer = pointer + len(tempD)
+				if len(tempD) > 1:
 					# sign coding
 					row = i * 4 + ii - 1
-					signComp, tempCx = _SignCoding(S1extend[row:row + 3, col:col + 3], signs[row][col])
-					D[pointer] = signComp
-					CX[pointer] = tempCx
+					nb = state[row + 1, col + 1] & _NEIGHBOURS
+					encode(signs[row][col] ^ _SC_PREDICT[nb], _SC_CONTEXT[nb])
 					pointer = pointer + 1
-					S1[row][col] = 1
-					S1extend = np.pad(S1, ((1, 1), (1, 1)), 'constant')
-			while ii < 4:
+					_set_significant(state, active, row, col)
+			while ii < stripeHeight:
 				row = i * 4 + ii
 				ii = ii + 1
-				if S1[row][col] != 0 or S3[row][col] != 0:
+				flags = state[row + 1, col + 1]
+				if flags & (_SIG | _CODED):
 					continue
-				tempCx = _ZeroCoding(S1extend[row:row + 3, col:col + 3], bandMark)
-				D[pointer] = plane[row][col]
-				CX[pointer] = tempCx
+				nb = flags & _NEIGHBOURS
+				encode(plane[row][col], zeroContexts[nb])
 				pointer = pointer + 1
 				if plane[row][col] == 1:  # _signcoding
-					signComp, tempCx = _SignCoding(S1extend[row:row + 3, col:col + 3], signs[row][col])
-					D[pointer][0] = signComp
-					CX[pointer][0] = tempCx
+					encode(signs[row][col] ^ _SC_PREDICT[nb], _SC_CONTEXT[nb])
 					pointer = pointer + 1
-					S1[row][col] = 1  # mark as significant
-					S1extend = np.pad(S1, ((1, 1), (1, 1)), 'constant')
-	return D, CX, pointer, S1
+					_set_significant(state, active, row, col)  # mark as significant
+	return pointer
 
 
 # here is some function used by three passes
@@ -700,6 +2016,48 @@ def _MagnitudeRefinementCoding(neighbourS1, s2):
 	return cx
 
 
+def _neighbourhood(neighbours):
+	# 3*3 matrix of significance described by the neighbour bits of the packed state
+	bits = [[_NB_NW, _NB_N, _NB_NE],
+					[_NB_W, 0, _NB_E],
+					[_NB_SW, _NB_S, _NB_SE]]
+	return [[int(bool(neighbours & bit)) for bit in row] for row in bits]
+
+
+def _context_tables():
+	"""
+	Build lookup tables of context labels indexed by the neighbour bits of the packed state.
+
+	The labels come from _ZeroCoding, _SignCoding and _MagnitudeRefinementCoding, so a lookup is bit-identical to calling them on the 3*3 neighbourhood.
+
+	Returns
+	-------
+	ZC: ndarray of uint8, size 3*256
+		Zero coding contexts of LL/LH, HL and HH bands, see _BAND_INDEX.
+	SC: ndarray of uint8, size 256
+		Sign coding contexts.
+	SP: ndarray of uint8, size 256
+		Sign predictions, the coded symbol is sign ^ prediction.
+	MR: ndarray of uint8, size 1024
+		Magnitude refinement contexts indexed by state & (_REFINED | _NEIGHBOURS).
+	"""
+	ZC = np.zeros((3, _NEIGHBOURS + 1), dtype=np.uint8)
+	SC = np.zeros(_NEIGHBOURS + 1, dtype=np.uint8)
+	SP = np.zeros(_NEIGHBOURS + 1, dtype=np.uint8)
+	MR = np.zeros(2 * _REFINED, dtype=np.uint8)
+	for nb in range(_NEIGHBOURS + 1):
+		neighbourS1 = _neighbourhood(nb)
+		for bandMark, k in _BAND_INDEX.items():
+			ZC[k][nb] = _ZeroCoding(neighbourS1, bandMark)
+		SP[nb], SC[nb] = _SignCoding(neighbourS1, 0)
+		MR[nb] = _MagnitudeRefinementCoding(neighbourS1, 0)
+		MR[_REFINED | nb] = _MagnitudeRefinementCoding(neighbourS1, 1)
+	return ZC, SC, SP, MR
+
+
+_ZC_TABLE, _SC_CONTEXT, _SC_PREDICT, _MR_TABLE = _context_tables()
+
+
 def _encode_end(encoder):
 	nbits = 27 - 15 - encoder.t
 	encoder.C = encoder.C * np.uint32(2 ** encoder.t)
@@ -711,297 +2069,330 @@ def _encode_end(encoder):
 
 	return encoder
 
-def _tile_decode(codestream, D):
-	_depthOfDWT = D
-	temp = []
-	for i in range(0, 9 * _depthOfDWT + 3):
-		_index = codestream.index(2050)
-		deStream = codestream[0:_index + 1]
-		temp.append(_band_decode(deStream))
-		codestream = codestream[_index + 1:]
-					
-	start1 = _depthOfDWT*3+1
-	start2 = _depthOfDWT*6+2
-	tile = [cat_arrays_2d([temp[0],
-												temp[start1],
-												temp[start2]])]
-	
-	for i in range(_depthOfDWT):
-		
-		tile.append((cat_arrays_2d([temp[3 * i + 1],
-															 temp[3 * i + start1+1],
-															 temp[3 * i + start2+1]]),
-								 cat_arrays_2d([temp[3 * i + 2],
-															 temp[3 * i + start1+2],
-															 temp[3 * i + start2+2]]),
-								 cat_arrays_2d([temp[3 * i + 3],
-															 temp[3 * i + start1+3],
-															 temp[3 * i + start2+3]])))
-	
+def _tile_decode(codestream, mq_coder="fast", reduce=0, window=None, backend="python"):
+	# codestream: bytes-like codestream of a tile
+	# reduce: number of the finest levels that are skipped, the decoded tile has D - reduce levels
+	# window: (y0, x0, y1, x1) in pixels of the tile, only the code blocks it is synthesized from are decoded, None for all
+	codestream = memoryview(codestream)
+	D, n_channels, bypass, terminate, bandIndex = _tile_index(codestream)
+	channels = [[] for _ in range(n_channels)]
+	for (index, k, bandMark), (offset, _) in zip(_band_keys(D, n_channels), bandIndex.tolist()):
+		if index[0] <= D - reduce:
+			channels[k].append(_band_decode(codestream, bandMark, offset, mq_coder=mq_coder, window=window, D=D, index=index, bypass=bypass, terminate=terminate, backend=backend))
+
+	return _tile_assemble(channels, D - reduce)
+
+
+def _tile_assemble(channels, D):
+	# channels: decoded bands of every channel in codestream order
+	tile = [cat_arrays_2d([bands[0] for bands in channels])]
+	for i in range(D):
+		tile.append(tuple(cat_arrays_2d([bands[3 * i + k] for bands in channels]) for k in range(1, 4)))
+
 	return tile
 
 
-def _band_decode(codestream, h=64, w=64, num=32):
-	h_cA = codestream[0]
-	w_cA = codestream[1]
-	codestream = codestream[2:]
-	h_num = h_cA // h + 1
-	w_num = w_cA // w + 1
-	band_extend = np.zeros((h_num * h, w_num * w))
-	for i in range(0, h_num):
-		for j in range(0, w_num):
-			_index = codestream.index(2048)
-			deCX = codestream[0:_index]
-			deCX = np.resize(deCX, (_index + 1, 1))
-			codestream = codestream[_index + 1:]
-			_index = codestream.index(2048)
-			deStream = codestream[0:_index]
-			codestream = codestream[_index + 1:]
-			num = codestream[0]
-			codestream = codestream[2:]
-			decodeD = _MQ_decode(deStream, deCX)
-			band_extend[i * h:(i + 1) * h, j * w:(j + 1) * w] = _decode_block(decodeD, deCX, h, w, num)
-		if codestream[0] != 2049:
-			print("Error!")
-		codestream = codestream[1:]
-	if codestream[0] != 2050:
-		print("Error!")
-	# print("finish one band")
-	return band_extend[0:h_cA, 0:w_cA]
-
-
-def _decode_block(D, CX, h=64, w=64, num=32):
-	deS1 = np.uint32(np.zeros((h, w)))
-	deS2 = np.uint32(np.zeros((h, w)))
-	deS3 = np.uint32(np.zeros((h, w)))
-	signs = np.uint32(np.zeros((h, w)))
-	V = np.uint32(np.zeros((num, h, w)))
-	deCode = np.zeros((h, w))
-	pointer = 0
-	for i in range(num):
-		V[i, :, :], signs, deS1, deS3, pointer = _SignificancePassDecoding(V[i, :, :], D, CX, deS1, deS3, pointer, signs, w,
-																																			 h)
-		V[i, :, :], deS2, pointer = _MagnitudePassDecoding(V[i, :, :], D, deS1, deS2, deS3, pointer, w, h)
-		V[i, :, :], deS1, deS3, signs, pointer = _CleanPassDecoding(V[i, :, :], D, CX, deS1, deS3, pointer, signs, w, h)
-		deS3 = np.zeros((h, w))
-	V = np.transpose(V, (1, 2, 0))
-	tempV = np.zeros((h,w))
-	for i in range(h):
-		for j in range(w):
-			tempV[i][j] = sum([V[i][j][k]*2**(num-1-k) for k in range(num)])
-
-	for i in range(h):
-		for j in range(w):
-			deCode[i][j] = (1 - 2 * signs[i][j]) * tempV[i][j]
-	return deCode
-
-
-def _SignificancePassDecoding(V, D, CX, deS1, deS3, pointer, signs, w=64, h=64):
-	S1extend = np.pad(deS1, ((1, 1), (1, 1)), 'constant')
-	rounds = h // 4
-	for i in range(rounds):
-		for col in range(w):
-			for ii in range(4):
-				row = 4 * i + ii
-				temp = np.sum(S1extend[row:row + 3, col:col + 3]) - S1extend[row + 1][col + 1]
-				if deS1[row][col] != 0 or temp == 0:
-					continue
-				###
-				if pointer>=len(D):
-					continue
-				V[row][col] = D[pointer][0]
-				pointer = pointer + 1
-				deS3[row][col] = 1
-				if V[row][col] == 1:
-					signs[row][col] = _SignDecoding(D[pointer], CX[pointer], S1extend[row:row + 3, col:col + 3])
-					pointer = pointer + 1
-					deS1[row][col] = 1
-					S1extend = np.pad(deS1, ((1, 1), (1, 1)), 'constant')
-	return V, signs, deS1, deS3, pointer
+def _tile_index(codestream):
+	# return D, number of channels, bypass, terminate and the (offset, length) of every band in codestream order
+	D, n_channels, bypass, terminate = _TILE_HEADER.unpack_from(codestream, 0)
+	n_bands = n_channels * (3 * D + 1)
+	bandIndex = np.frombuffer(codestream, dtype=_INDEX_DTYPE, count=2 * n_bands, offset=_TILE_HEADER.size)
+	return D, n_channels, bypass or None, bool(terminate), bandIndex.reshape(n_bands, 2)
+
+
+def _band_index(codestream, offset):
+	# return height, width, h, w and the (offset, length) of every code block of the band starting at codestream[offset]
+	# the code blocks of an empty band all have length 0
+	h_cA, w_cA, h, w, empty = _BAND_HEADER.unpack_from(codestream, offset)
+	h_num, w_num = -(-h_cA // h), -(-w_cA // w)
+	if empty:
+		return h_cA, w_cA, h, w, np.zeros((h_num, w_num, 2), dtype=_INDEX_DTYPE)
+	blockIndex = np.frombuffer(codestream, dtype=_INDEX_DTYPE, count=2 * h_num * w_num, offset=offset + _BAND_HEADER.size)
+	return h_cA, w_cA, h, w, blockIndex.reshape(h_num, w_num, 2)
+
+
+def _band_decode(codestream, bandMark, offset=0, mq_coder="fast", window=None, D=None, index=None, bypass=None, terminate=False, backend="python"):
+	# decode the band starting at codestream[offset]
+	# window, D, index: window in pixels of the tile, number of levels and index of the band in the tile,
+	# code blocks the window is not synthesized from are left 0
+	h_cA, w_cA, h, w, blockIndex = _band_index(codestream, offset)
+	decoder = MQDecoder()
+	rows, cols = _band_blocks_range(blockIndex, h, w, window, D, index)
+	blocks = [None] * (blockIndex.shape[0] * blockIndex.shape[1])
+	for i in rows:
+		for j in cols:
+			offset, length = blockIndex[i, j].tolist()
+			if not length:
+				continue
+			blocks[i * blockIndex.shape[1] + j] = _block_decode(codestream, offset, length, bandMark, *_block_shape(h_cA, w_cA, h, w, i, j), mq_coder, decoder, bypass, terminate, backend)
+	return _band_assemble(blocks, h_cA, w_cA, h, w)
+
+
+def _band_blocks_range(blockIndex, h, w, window=None, D=None, index=None):
+	# rows and columns of the code blocks of the band at index of a tile with D levels that window is synthesized from
+	h_num, w_num = blockIndex.shape[:2]
+	if window is None:
+		return range(h_num), range(w_num)
+	return window_blocks(band_windows(window, D)[index[0]], h, w, h_num, w_num)
+
+
+def _band_assemble(blocks, h_cA, w_cA, h=64, w=64):
+	# blocks: decoded code blocks of a band in raster order, None for blocks left 0
+	# edge blocks can be cut to the band or padded to h * w
+	w_num = -(-w_cA // w)
+	band = np.zeros((h_cA, w_cA))
+	for n, block in enumerate(blocks):
+		if block is None:
+			continue
+		i, j = divmod(n, w_num)
+		coeffs = band[i * h:(i + 1) * h, j * w:(j + 1) * w]
+		coeffs[...] = block[:coeffs.shape[0], :coeffs.shape[1]]
+	return band
+
+
+def _block_decode(codestream, offset, length, bandMark, h=64, w=64, mq_coder="fast", decoder=None, bypass=None, terminate=False, backend="python"):
+	# decode the code block stored in codestream[offset:offset + length]
+	# decoder: MQDecoder to reuse, a new one is created if it is None
+	# bypass, terminate: coding segments of the tile, see _segments
+	# backend: "jit" decodes the block by the compiled kernel of ebcot_jit, see _jit_block_decode
+	if not length:
+		# an empty code block is all zero
+		return np.zeros((h, w))
+	num, passes = _BLOCK_HEADER.unpack_from(codestream, offset)
+	deStream = codestream[offset + _BLOCK_HEADER.size:offset + length]
+	segments = _segments(num, bypass, terminate)
+	if backend == "jit":
+		return _jit_block_decode(deStream, bandMark, num, passes, h, w, segments)
+	if passes and len(segments) > 1:
+		segments = _segments_split(deStream, segments)
+		deStream = segments[0][3]
+	else:
+		segments = None
+	if mq_coder == "reference":
+		decoder = _ReferenceMQDecoder(deStream)
+	elif decoder is None:
+		decoder = MQDecoder(deStream)
+	else:
+		decoder.reset(deStream)
+	return _decode_block(decoder, bandMark, num, h, w, passes, segments)
+
+
+def _jit_block_decode(stream, bandMark, num, passes, h, w, segments):
+	# _block_decode of the first passes of a code block by ebcot_jit.decode_block, segments are from _segments
+	stream = np.frombuffer(stream, dtype=np.uint8)
+	if passes and len(segments) > 1:
+		lengths = np.frombuffer(stream, dtype=_INDEX_DTYPE, count=len(segments)).astype(np.int64)
+		offsets = len(segments) * _INDEX_DTYPE.itemsize + np.cumsum(lengths) - lengths
+		# segments of a truncated stream are cut short
+		lengths = np.clip(np.minimum(lengths, len(stream) - offsets), 0, None)
+		segments = np.array([(first, raw, offset, length) for (first, _, raw), offset, length in zip(segments, offsets.tolist(), lengths.tolist())], dtype=np.int64)
+	else:
+		segments = np.array([(0, 0, 0, len(stream))], dtype=np.int64)
+	magnitudes, signs = ebcot_jit.decode_block(stream, segments, num, passes, h, w, _ZC_TABLE[_BAND_INDEX[bandMark]], _SC_CONTEXT, _SC_PREDICT, _MR_TABLE)
+	return _block_coefficients(magnitudes, signs)
+
+
+def _segments_split(stream, segments):
+	# (first pass, end pass, raw, stream) of the coding segments in stream, segments of a truncated stream are cut short
+	segmentIndex = np.frombuffer(stream, dtype=_INDEX_DTYPE, count=len(segments))
+	offset = segmentIndex.nbytes
+	split = []
+	for (first, end, raw), length in zip(segments, segmentIndex.tolist()):
+		split.append((first, end, raw, stream[offset:offset + length]))
+		offset += length
+	return split
+
+
+def _decode_block(decoder, bandMark, num, h=64, w=64, passes=None, segments=None):
+	# input decoder: MQ decoder of the code block, symbols are pulled from it by decoder.decode(cx)
+	# the context of every symbol is derived from the states decoded so far, in the same way as the encoder
+	# num: number of bit-planes of the code block, from its BLOCK_HEADER
+	# passes: number of coding passes to decode, all 3 * num passes if None, bits of the passes left are 0
+	# segments: coding segments from _segments_split if there are more than one, decoder is started on the first one
+	block = _BlockDecoder(decoder, bandMark, num, h, w)
+	block.decode(passes, segments)
+	return block.coefficients()
+
+
+class _BlockDecoder(object):
+	"""
+	Resumable decoder of the coding passes of a code block.
+
+	decode can be called again with a larger number of passes and goes on from the passes decoded before, e.g. when the next quality layer of the block arrives. It must go on at the start of a coding segment unless the segment was not truncated before, with terminated passes any pass is the start of a segment.
+	"""
+
+	def __init__(self, decoder, bandMark, num, h=64, w=64):
+		# decoder: MQ decoder started on the first coding segment, it keeps the context states between segments
+		# num: number of bit-planes coded in the block, the decoded bits of plane i are accumulated in magnitudes
+		# with the shift num - 1 - i
+		self.decoder = decoder
+		self.passDecoder = decoder
+		self.bandMark = bandMark
+		self.h, self.w, self.num = h, w, num
+		self.state = _new_state(h, w)
+		self.active = _new_activity(h, w)
+		self.signs = np.zeros((h, w), dtype=np.int64)
+		self.magnitudes = np.zeros((h, w), dtype=np.int64)
+		self.passes = 0
+
+	def decode(self, passes=None, segments=None):
+		# decode the passes from self.passes up to passes, all 3 * num passes if None
+		# segments: coding segments from _segments_split, a segment starting at a pass switches the decoder to it
+		if passes is None:
+			passes = 3 * self.num
+		starts = {} if segments is None else {first: (raw, stream) for first, _, raw, stream in segments if first}
+		decoder, state, active, signs, magnitudes = self.passDecoder, self.state, self.active, self.signs, self.magnitudes
+		h, w, bandMark = self.h, self.w, self.bandMark
+		for n in range(self.passes, passes):
+			if n in starts:
+				raw, stream = starts[n]
+				if raw:
+					decoder = _RawDecoder(stream)
+				else:
+					# an MQ codeword goes on with the context states of the previous ones
+					self.decoder.start(stream)
+					decoder = self.decoder
+			bit = 1 << (self.num - 1 - n // 3)
+			if n % 3 == 0:
+				_SignificancePassDecoding(magnitudes, bit, decoder, state, active, signs, bandMark, w, h)
+			elif n % 3 == 1:
+				_MagnitudePassDecoding(magnitudes, bit, decoder, state, active, w, h)
+			else:
+				_CleanPassDecoding(magnitudes, bit, decoder, state, active, signs, bandMark, w, h)
+				state &= ~_CODED
+		self.passDecoder = decoder
+		self.passes = max(self.passes, passes)
+
+	def coefficients(self):
+		# the block decoded from the passes so far, bits of the passes left are 0
+		return _block_coefficients(self.magnitudes, self.signs)
+
 
+def _block_coefficients(magnitudes, signs):
+	# signed coefficients of a block from its decoded magnitudes and signs
+	return np.where(signs, -magnitudes, magnitudes).astype(np.float64)
 
-def _MagnitudePassDecoding(V, D, deS1, deS2, deS3, pointer, w=64, h=64):
-	rounds = h // 4
-	for i in range(rounds):
+
+def _SignificancePassDecoding(magnitudes, bit, decoder, state, active, signs, bandMark, w=64, h=64):
+	# magnitudes and signs are updated in place, bit is the value of a decoded 1 of the current bit-plane
+	zeroContexts = _ZC_TABLE[_BAND_INDEX[bandMark]]
+	for i in range(len(active)):
+		stripe = active[i]
+		# the last stripe of a code block whose height is not a multiple of 4 is shorter
+		rows = range(4 * i, min(4 * i + 4, h))
 		for col in range(w):
-			for ii in range(4):
-				row = 4 * i + ii
-				if deS1[row][col] != 1 or deS3[row][col] != 0:
+			if not stripe[col + 1]:
+				continue  # nothing is significant around the stripe column
+			for row in rows:
+				flags = state[row + 1, col + 1]
+				if flags & _SIG:
 					continue
-				###
-				if pointer>=len(D):
+				nb = flags & _NEIGHBOURS
+				if not nb:
 					continue
-				V[row][col] = D[pointer][0]
-				pointer = pointer + 1
-				deS2[row][col] = 1
-	return V, deS2, pointer
-
-
-def _CleanPassDecoding(V, D, CX, deS1, deS3, pointer, signs, w=64, h=64):
-	a = pointer
-	S1extend = np.pad(deS1, ((1, 1), (1, 1)), 'constant')
-	rounds = h // 4
-	for i in range(rounds):
+				state[row + 1, col + 1] |= _CODED
+				if decoder.decode(zeroContexts[nb]):
+					magnitudes[row, col] |= bit
+					signs[row, col] = _SignDecoding(decoder, nb)
+					_set_significant(state, active, row, col)
+	return magnitudes, signs
+
+
+def _MagnitudePassDecoding(magnitudes, bit, decoder, state, active, w=64, h=64):
+	for i in range(len(active)):
+		stripe = active[i]
+		rows = range(4 * i, min(4 * i + 4, h))
+		for col in range(w):
+			if not stripe[col + 1]:
+				continue
+			for row in rows:
+				flags = state[row + 1, col + 1]
+				if flags & (_SIG | _CODED) != _SIG:
+					continue
+				if decoder.decode(_MR_TABLE[flags & (_REFINED | _NEIGHBOURS)]):
+					magnitudes[row, col] |= bit
+				state[row + 1, col + 1] |= _REFINED
+	return magnitudes
+
+
+def _CleanPassDecoding(magnitudes, bit, decoder, state, active, signs, bandMark, w=64, h=64):
+	zeroContexts = _ZC_TABLE[_BAND_INDEX[bandMark]]
+	for i in range(len(active)):
+		stripe = active[i]
+		# run-length coding is only used in stripes of 4 rows
+		stripeHeight = min(4, h - 4 * i)
 		for col in range(w):
 			ii = 0
 			row = 4 * i
-			tempSum = np.sum(S1extend[row:row + 6, col:col + 3]) + np.sum(deS3[row:row + 4, col])
 			# 整一列未被编码，都为非重要，且领域非重要
-			if tempSum == 0:
-				if CX.__len__() < pointer + 3:
-					CXextend = np.pad(CX, (0, 2), 'constant')
-					Dextend = np.pad(D, (0, 2), 'constant')
-					tempCx = CXextend[pointer:pointer + 3]
-					tempD = Dextend[pointer:pointer + 3]
-				else:
-					tempCx = CX[pointer:pointer + 3]
-					tempD = D[pointer:pointer + 3]
-				ii, tempV = _RunLengthDecoding(tempCx, tempD)
-				if tempV == [0, 0, 0, 0]:
-					V[row][col] = 0
-					V[row + 1][col] = 0
-					V[row + 2][col] = 0
-					V[row + 3][col] = 0
-					pointer = pointer + 1
-				else:
-					if tempV == [1]:
-						V[row][col] = 1
-						pointer = pointer + 3
-					elif tempV == [0, 1]:
-						V[row][col] = 0
-						V[row + 1][col] = 1
-						pointer = pointer + 3
-					elif tempV == [0, 0, 1]:
-						V[row][col] = 0
-						V[row + 1][col] = 0
-						V[row + 2][col] = 1
-						pointer = pointer + 3
-					elif tempV == [0, 0, 0, 1]:
-						V[row][col] = 0
-						V[row + 1][col] = 0
-						V[row + 2][col] = 0
-						V[row + 3][col] = 1
-						pointer = pointer + 3
+			# coefficients are only coded before the cleanup pass if they have a significant neighbour
+			if not stripe[col + 1] and stripeHeight == 4:
+				ii, tempV = _RunLengthDecoding(decoder)
+				if tempV[-1] == 1:
 					# sign coding
 					row = row + ii - 1
-					###
-					if pointer>=len(D):
-						continue
-					signs[row][col] = _SignDecoding(D[pointer], CX[pointer], S1extend[row:row + 3, col:col + 3])
-					pointer = pointer + 1
-					deS1[row][col] = 1
-					S1extend = np.pad(deS1, ((1, 1), (1, 1)), 'constant')
-			while ii < 4:
+					magnitudes[row, col] |= bit
+					signs[row, col] = _SignDecoding(decoder, state[row + 1, col + 1] & _NEIGHBOURS)
+					_set_significant(state, active, row, col)
+			while ii < stripeHeight:
 				row = i * 4 + ii
 				ii = ii + 1
-				if deS1[row][col] != 0 or deS3[row][col] != 0:
+				flags = state[row + 1, col + 1]
+				if flags & (_SIG | _CODED):
 					continue
-				###
-				if pointer>=len(D):
-					continue
-				V[row][col] = D[pointer][0]
-				pointer = pointer + 1
-				deS3[row][col] = 1
-				if V[row][col] == 1:
-					signs[row][col] = _SignDecoding(D[pointer], CX[pointer], S1extend[row:row + 3, col:col + 3])
-					pointer = pointer + 1
-					deS1[row][col] = 1
-					S1extend = np.pad(deS1, ((1, 1), (1, 1)), 'constant')
-	return V, deS1, deS3, signs, pointer
-
-
-def _RunLengthDecoding(CX, D):
-	n = CX.__len__()
-	wrong = 1
-	if CX[0][0] == 17 and D[0][0] == 0 or CX[0][0] == 17 and CX[1][0] == 18 and CX[2][0] == 18 and D[0][0] == 1:
-		wrong = 0
-	if wrong == 0:
-		if D[0][0] == 0:
-			deLen = 4
-			V = [0, 0, 0, 0]
-		elif D[0][0] == 1 and D[1][0] == 0 and D[2][0] == 0:
-			deLen = 1
-			V = [1]
-		elif D[0][0] == 1 and D[1][0] == 0 and D[2][0] == 1:
-			deLen = 2
-			V = [0, 1]
-		elif D[0][0] == 1 and D[1][0] == 1 and D[2][0] == 0:
-			deLen = 3
-			V = [0, 0, 1]
-		elif D[0][0] == 1 and D[1][0] == 1 and D[2][0] == 1:
-			deLen = 4
-			V = [0, 0, 0, 1]
-		else:
-			# self.logs[-1] += self.formatter.warning('_RunLengthDecoding: D not valid')
-			deLen = -1
-			V = [-1]
-			"""
-			try:
-				raise ValidationError('_RunLengthDecoding: D not valid')
-			except ValidationError as e:
-				print(e.args)
-				deLen = -1
-				V = [-1]
-			"""
-	else:
-		# self.logs[-1] += self.formatter.warning('_RunLengthDecoding: CX not valid')
-		deLen = -1
-		V = [-1]
-		"""
-		try:
-			raise ValidationError('_RunLengthDecoding: CX not valid')
-		except ValidationError as e:
-			print(e.args)
-			deLen = -1
-			V = [-1]
-		"""
-	return deLen, V
+				nb = flags & _NEIGHBOURS
+				if decoder.decode(zeroContexts[nb]):
+					magnitudes[row, col] |= bit
+					signs[row, col] = _SignDecoding(decoder, nb)
+					_set_significant(state, active, row, col)
+	return magnitudes, signs
 
 
-def _SignDecoding(D, CX, neighbourS1):
-	if neighbourS1.__len__() == 3 and neighbourS1[0].__len__() == 3:
-		hstr = str(int(neighbourS1[1][0])) + str(int(neighbourS1[1][2]))
-		vstr = str(int(neighbourS1[0][1])) + str(int(neighbourS1[2][1]))
-		dict = {
-			'00': 0, '1-1': 0, '-11': 0, '01': 1, '10': 1, '11': 1,
-			'0-1': -1, '-10': -1, '-1-1': -1
-		}
-		h = dict[hstr]
-		v = dict[vstr]
-		hAndv = str(h) + str(v)
-		hv2Sign = {
-			'11': 0, '10': 0, '1-1': 0, '01': 0, '00': 0,
-			'0-1': 1, '-11': 1, '-10': 1, '-1-1': 1
-		}
-		hv2Context = {
-			'11': 13, '10': 12, '1-1': 11, '01': 10, '00': 9,
-			'0-1': 10, '-11': 11, '-10': 12, '-1-1': 13
-		}
-		temp = hv2Sign[hAndv]
-		deCX = hv2Context[hAndv]
-		if deCX == CX:
-			deSign = D[0] ^ temp
-		else:
-			# self.logs[-1] += self.formatter.warning('_SignDecoding: Context does not match. Error occurs.')
-			deSign = -1
-			"""
-			try:
-				raise ValidationError('_SignDecoding: Context does not match. Error occurs.')
-			except ValidationError as e:
-				print(e.args)
-				deSign = -1
-			"""
-	else:
-		# self.logs[-1] += self.formatter.warning('_SignDecoding: Size of neighbourS1 not valid')
-		deSign = -1
-		"""
-		try:
-			raise ValidationError('_SignDecoding: Size of neighbourS1 not valid')
-		except ValidationError as e:
-			print(e.args)
-			deSign = -1
-		"""
-	return deSign
+def _RunLengthDecoding(decoder):
+	# counterpart of _RunLengthCoding
+	# output deLen: number of decoded coefficients, V: their bits
+	if decoder.decode(17) == 0:
+		return 4, [0, 0, 0, 0]
+	position = decoder.decode(18) << 1
+	position = position | decoder.decode(18)
+	return position + 1, [0] * position + [1]
+
+
+def _SignDecoding(decoder, neighbours):
+	# input neighbours: neighbour bits of the packed state
+	return decoder.decode(_SC_CONTEXT[neighbours]) ^ _SC_PREDICT[neighbours]
+
+
+class _ReferenceMQDecoder(object):
+	"""
+	Per-symbol interface of the reference MQ decoder, it is used by _decode_block like MQDecoder.
+	"""
+
+	def __init__(self, stream):
+		self.PETTable, self.CXTable = deepcopy(mq_table)
+		self.start(stream)
+
+	def start(self, stream):
+		# start decoding a new codeword, the context states are kept
+		self.encoder = _MQ_decode_start(stream)
+
+	def decode(self, cx):
+		return _MQ_decode_symbol(self.encoder, self.PETTable, self.CXTable, cx)
+
+
+class _RawDecoder(object):
+	"""
+	Decoder of a raw coding segment, it returns the bits of the segment one by one with the interface of MQDecoder. Bits past the end of the segment are 0.
+	"""
+
+	def __init__(self, stream):
+		self.bits = np.unpackbits(np.frombuffer(stream, dtype=np.uint8)).tolist()
+		self.n = 0
+
+	def decode(self, cx):
+		n = self.n
+		self.n = n + 1
+		return self.bits[n] if n < len(self.bits) else 0
 
 
 class EBCOTparam(object):
@@ -1039,7 +2430,8 @@ class EBCOTparam(object):
 # 			testblock[i][j] = i*4
 # 	#(bitcode, _) = _band_encode(testblock, "LL", h=64, w=64, num=8)
 # 	#decodeblock = _band_decode(list(bitcode), h=64, w=64, num=32)
-# 	CX, D, bitplanelength = _embeddedBlockEncoder(testblock, "LL", h, w, num=8)
+# 	bitPlane, signs, num = _bit_planes(testblock)
+# 	CX, D, bitplanelength = _embeddedBlockEncoder(bitPlane, signs, "LL", h, w)
 # 	encoder = _MQencode(CX, D)
 # 	decodeD = _MQ_decode(encoder.stream, CX)
 # 	decodeblock = _decode_block(D, CX, h, w, num=8)
@@ -0,0 +1,547 @@
+"""
+Compiled coding passes and MQ coder of EBCOTCodec, used by its "jit" backend.
+
+The kernels code and decode a whole code block in one call, with the same passes, contexts and MQ coder as the python backend, so both give the same codestream. They are compiled by numba when it is installed, the compiled code is cached on disk next to this module so that worker processes load it instead of compiling it again. Without numba the kernels are plain python functions, correct but slower than the python backend, and EBCOTCodec falls back to the python backend.
+"""
+
+import numpy as np
+
+from .mq_coder import _NMPS_ARRAY, _NLPS_ARRAY, _SWITCH_ARRAY, _QE_ARRAY, _INITIAL_INDEX, _INITIAL_MPS
+
+try:
+	from numba import njit
+except ImportError:
+	njit = None
+
+available = njit is not None
+
+
+def warm_up():
+	"""
+	Load the compiled kernels, from the disk cache if they were compiled before.
+
+	Call it before forking a pool, so that the workers share the loaded kernels instead of each loading them on its first code block.
+	"""
+	if not available:
+		return
+	zeros = np.zeros(256, dtype=np.uint8)
+	mrTable = np.zeros(1024, dtype=np.uint8)
+	out, _, _, _ = encode_block(np.ones((1, 4, 4), dtype=np.uint8), np.zeros((4, 4), dtype=np.uint8), zeros, zeros, zeros, mrTable, np.array([[0, 3, 0]], dtype=np.int64), True)
+	# the decoder reads streams from read-only buffers
+	stream = np.frombuffer(out.tobytes(), dtype=np.uint8)
+	decode_block(stream, np.array([[0, 0, 0, len(stream)]], dtype=np.int64), 1, 3, 4, 4, zeros, zeros, zeros, mrTable)
+
+
+def _jit(func):
+	# compile func with numba if it is installed, the compiled code is cached on disk
+	if njit is None:
+		return func
+	return njit(cache=True, nogil=True)(func)
+
+
+# packed state of a coefficient, the same as in ebcot_codec.py
+_NB_N, _NB_S, _NB_W, _NB_E = 1, 2, 4, 8
+_NB_NW, _NB_NE, _NB_SW, _NB_SE = 16, 32, 64, 128
+_NEIGHBOURS = 255
+_SIG = 256
+_REFINED = 512
+_CODED = 1024
+
+# bytes after the last complete byte of the MQ encoder that a truncated stream keeps,
+# enough for the decoder to decode every symbol coded so far
+_TRUNCATION_MARGIN = 5
+
+_INDEX0 = np.frombuffer(_INITIAL_INDEX, dtype=np.uint8).copy()
+_MPS0 = np.frombuffer(_INITIAL_MPS, dtype=np.uint8).copy()
+
+# registers of the coders in an int64 array, shared by the kernels
+# MQ encoder: A, C, t, T, L; start of the current segment in the output; bits of the current raw segment; raw
+_A, _C, _t, _T, _L, _BASE, _NBITS, _RAW = range(8)
+# MQ decoder: A, C, t, T, L as above; start and end of the current segment in the stream; next bit of a raw segment
+_START, _END, _BIT = 5, 6, 7
+
+
+@_jit
+def _set_significant(state, active, row, col):
+	# mark coefficient [row][col] as significant and tell its 8 neighbours and their stripe columns in place
+	r, c = row + 1, col + 1
+	for i in range((row - 1) >> 2, ((row + 1) >> 2) + 1):
+		if 0 <= i < active.shape[0]:
+			active[i, col] = 1
+			active[i, col + 1] = 1
+			active[i, col + 2] = 1
+	state[r, c] |= _SIG
+	state[r - 1, c - 1] |= _NB_SE
+	state[r - 1, c] |= _NB_S
+	state[r - 1, c + 1] |= _NB_SW
+	state[r, c - 1] |= _NB_E
+	state[r, c + 1] |= _NB_W
+	state[r + 1, c - 1] |= _NB_NE
+	state[r + 1, c] |= _NB_N
+	state[r + 1, c + 1] |= _NB_NW
+
+
+@_jit
+def _mq_restart(reg):
+	reg[_A] = 0x8000
+	reg[_C] = 0
+	reg[_t] = 12
+	reg[_T] = 0
+	reg[_L] = -1
+
+
+@_jit
+def _putbyte(reg, out):
+	# the first call only primes T, following calls write T to out
+	if reg[_L] >= 0:
+		out[reg[_BASE] + reg[_L]] = reg[_T]
+	reg[_L] += 1
+
+
+@_jit
+def _transferbyte(reg, out):
+	C, T = reg[_C], reg[_T]
+	if T == 0xFF:
+		_putbyte(reg, out)
+		reg[_T] = (C >> 20) & 0xFF
+		reg[_C] = C & 0xFFFFF
+		reg[_t] = 7
+	else:
+		T += (C >> 27) & 1
+		C ^= 0x8000000
+		reg[_T] = T
+		_putbyte(reg, out)
+		if T == 0xFF:
+			reg[_T] = (C >> 20) & 0xFF
+			reg[_C] = C & 0xFFFFF
+			reg[_t] = 7
+		else:
+			reg[_T] = (C >> 19) & 0xFF
+			reg[_C] = C & 0x807FFFF
+			reg[_t] = 8
+
+
+@_jit
+def _mq_flush(reg, out):
+	# terminate the codeword, it is out[base:base + L]
+	nbits = 27 - 15 - reg[_t]
+	reg[_C] <<= reg[_t]
+	while nbits > 0:
+		_transferbyte(reg, out)
+		nbits -= reg[_t]
+		reg[_C] <<= reg[_t]
+	_transferbyte(reg, out)
+	return reg[_L]
+
+
+@_jit
+def _encode(reg, index, mps, out, symbol, cx):
+	# code one symbol, as a raw bit in a raw segment
+	if reg[_RAW]:
+		n = reg[_NBITS]
+		out[reg[_BASE] + (n >> 3)] |= symbol << (7 - (n & 7))
+		reg[_NBITS] = n + 1
+		return
+	i = index[cx]
+	p = _QE_ARRAY[i]
+	A = reg[_A] - p
+	C = reg[_C]
+	if symbol == mps[cx]:
+		if A >= 0x8000:
+			reg[_A] = A
+			reg[_C] = C + p
+			return
+		if A < p:
+			A = p
+		else:
+			C += p
+		index[cx] = _NMPS_ARRAY[i]
+	else:
+		if A < p:
+			C += p
+		else:
+			A = p
+		mps[cx] ^= _SWITCH_ARRAY[i]
+		index[cx] = _NLPS_ARRAY[i]
+	while A < 0x8000:
+		A <<= 1
+		C <<= 1
+		reg[_t] -= 1
+		if reg[_t] == 0:
+			reg[_C] = C
+			_transferbyte(reg, out)
+			C = reg[_C]
+	reg[_A] = A
+	reg[_C] = C
+
+
+@_jit
+def _significance_pass(reg, index, mps, out, state, active, plane, signs, zeroContexts, scContext, scPredict):
+	h, w = plane.shape
+	count = 0
+	for i in range(active.shape[0]):
+		for col in range(w):
+			if not active[i, col + 1]:
+				continue
+			for row in range(4 * i, min(4 * i + 4, h)):
+				flags = state[row + 1, col + 1]
+				if flags & _SIG:
+					continue
+				nb = flags & _NEIGHBOURS
+				if not nb:
+					continue
+				_encode(reg, index, mps, out, plane[row, col], zeroContexts[nb])
+				count += 1
+				state[row + 1, col + 1] |= _CODED
+				if plane[row, col]:
+					_encode(reg, index, mps, out, signs[row, col] ^ scPredict[nb], scContext[nb])
+					count += 1
+					_set_significant(state, active, row, col)
+	return count
+
+
+@_jit
+def _refinement_pass(reg, index, mps, out, state, active, plane, mrTable):
+	h, w = plane.shape
+	count = 0
+	for i in range(active.shape[0]):
+		for col in range(w):
+			if not active[i, col + 1]:
+				continue
+			for row in range(4 * i, min(4 * i + 4, h)):
+				flags = state[row + 1, col + 1]
+				if flags & (_SIG | _CODED) != _SIG:
+					continue
+				state[row + 1, col + 1] |= _REFINED
+				_encode(reg, index, mps, out, plane[row, col], mrTable[flags & (_REFINED | _NEIGHBOURS)])
+				count += 1
+	return count
+
+
+@_jit
+def _cleanup_pass(reg, index, mps, out, state, active, plane, signs, zeroContexts, scContext, scPredict):
+	h, w = plane.shape
+	count = 0
+	for i in range(active.shape[0]):
+		for col in range(w):
+			start = 4 * i
+			if not active[i, col + 1] and 4 * i + 4 <= h:
+				# run-length coding of an inactive stripe column, only in stripes of 4 rows
+				position = 4
+				for ii in range(4):
+					if plane[4 * i + ii, col]:
+						position = ii
+						break
+				_encode(reg, index, mps, out, 1 if position < 4 else 0, 17)
+				count += 1
+				start = 4 * i + 4
+				if position < 4:
+					_encode(reg, index, mps, out, position >> 1, 18)
+					_encode(reg, index, mps, out, position & 1, 18)
+					row = 4 * i + position
+					nb = state[row + 1, col + 1] & _NEIGHBOURS
+					_encode(reg, index, mps, out, signs[row, col] ^ scPredict[nb], scContext[nb])
+					count += 3
+					_set_significant(state, active, row, col)
+					start = row + 1
+			for row in range(start, min(4 * i + 4, h)):
+				flags = state[row + 1, col + 1]
+				if flags & (_SIG | _CODED):
+					continue
+				nb = flags & _NEIGHBOURS
+				_encode(reg, index, mps, out, plane[row, col], zeroContexts[nb])
+				count += 1
+				if plane[row, col]:
+					_encode(reg, index, mps, out, signs[row, col] ^ scPredict[nb], scContext[nb])
+					count += 1
+					_set_significant(state, active, row, col)
+	return count
+
+
+@_jit
+def _distortion(magnitudes, state, shift, visited):
+	# squared error of magnitudes decoded down to bit shift where state & visited, and down to bit shift + 1 elsewhere
+	# visited is 0 if all coefficients are visited, the squares are summed exactly as integers
+	h, w = magnitudes.shape
+	total = 0
+	for row in range(h):
+		for col in range(w):
+			if visited == 0 or state[row + 1, col + 1] & visited:
+				error = magnitudes[row, col] & ((1 << shift) - 1)
+			else:
+				error = magnitudes[row, col] & ((2 << shift) - 1)
+			total += error * error
+	return float(total)
+
+
+def pass_rate(rates, n, length, raw, nbits, empty, L):
+	"""
+	Rate of the truncation point after pass n of a code block, rates[n] is the rate before the pass.
+
+	length is the bytes of the segments completed before the pass, raw whether the pass is in a raw segment with nbits bits so far, empty whether the pass coded no symbol and L the complete bytes of the MQ encoder after it. Every encoder of ebcot_codec.py and encode_block record their rates by it, rates may be a list or an array.
+	"""
+	if raw:
+		return length + -(-nbits // 8)
+	if empty:
+		# a pass without symbols needs no more bytes
+		return rates[n]
+	return length + max(L, 0) + _TRUNCATION_MARGIN
+
+
+def close_segment(rates, first, end, length):
+	"""
+	Close the rates of the segment of passes first to end, which ends the stream at length bytes.
+	"""
+	# a segment is complete at its end, the passes in it need no more than all of it
+	for m in range(first + 1, end):
+		rates[m] = min(rates[m], length)
+	rates[end] = length
+
+
+_pass_rate = _jit(pass_rate)
+_close_segment = _jit(close_segment)
+
+
+@_jit
+def encode_block(bitPlane, signs, zeroContexts, scContext, scPredict, mrTable, segments, truncation):
+	"""
+	Code the bit-planes of a code block into its coding segments.
+
+	segments is a (n, 3) array of the (first pass, end pass, raw) of every segment from _segments. Returns the coded bytes of all segments, the length of each segment, and the rates and distortions of the truncation points as _block_encode before the segment index is added, both empty without truncation.
+	"""
+	num, h, w = bitPlane.shape
+	state = np.zeros((h + 2, w + 2), dtype=np.int32)
+	active = np.zeros((-(-h // 4), w + 2), dtype=np.uint8)
+	index = _INDEX0.copy()
+	mps = _MPS0.copy()
+	reg = np.zeros(8, dtype=np.int64)
+	# an MQ symbol renormalizes by at most 15 bits and every coefficient codes at most 3 symbols per plane,
+	# with the run-length symbols, so 8 bytes per coefficient and plane hold any codeword
+	out = np.zeros(8 * num * h * w + 8 * len(segments), dtype=np.uint8)
+	lengths = np.zeros(len(segments), dtype=np.int64)
+	rates = np.zeros(3 * num + 1 if truncation else 0, dtype=np.int64)
+	distortions = np.zeros(3 * num + 1 if truncation else 0, dtype=np.float64)
+	magnitudes = np.zeros((h, w), dtype=np.int64)
+	if truncation:
+		for plane in range(num):
+			for row in range(h):
+				for col in range(w):
+					magnitudes[row, col] = (magnitudes[row, col] << 1) | bitPlane[plane, row, col]
+		distortions[0] = _distortion(magnitudes, state, num, 0)
+
+	k = 0
+	length = 0
+	for n in range(3 * num):
+		first, end, raw = segments[k, 0], segments[k, 1], segments[k, 2]
+		if n == first:
+			reg[_RAW] = raw
+			if raw:
+				reg[_NBITS] = 0
+			else:
+				_mq_restart(reg)
+		plane = bitPlane[n // 3]
+		shift = num - 1 - n // 3
+		if n % 3 == 0:
+			count = _significance_pass(reg, index, mps, out, state, active, plane, signs, zeroContexts, scContext, scPredict)
+		elif n % 3 == 1:
+			count = _refinement_pass(reg, index, mps, out, state, active, plane, mrTable)
+		else:
+			count = _cleanup_pass(reg, index, mps, out, state, active, plane, signs, zeroContexts, scContext, scPredict)
+		if truncation:
+			rates[n + 1] = _pass_rate(rates, n, length, raw, reg[_NBITS], count == 0, reg[_L])
+			visited = _CODED if n % 3 == 0 else (_CODED | _SIG if n % 3 == 1 else 0)
+			distortions[n + 1] = _distortion(magnitudes, state, shift, visited)
+		if n % 3 == 2:
+			for row in range(h + 2):
+				for col in range(w + 2):
+					state[row, col] &= ~_CODED
+		if n + 1 == end:
+			size = -(-reg[_NBITS] // 8) if raw else _mq_flush(reg, out)
+			lengths[k] = size
+			length += size
+			reg[_BASE] += size
+			if truncation:
+				_close_segment(rates, first, end, length)
+			k += 1
+	return out[:length], lengths, rates, distortions
+
+
+@_jit
+def _fill_lsb(reg, stream):
+	# bytes past the end of the segment or after a marker are read as 0xFF
+	reg[_t] = 8
+	L = reg[_L]
+	if L == reg[_END] or (reg[_T] == 0xFF and stream[L] > 0x8F):
+		reg[_C] += 0xFF
+	else:
+		if reg[_T] == 0xFF:
+			reg[_t] = 7
+		reg[_T] = stream[L]
+		reg[_L] = L + 1
+		reg[_C] += reg[_T] << (8 - reg[_t])
+
+
+@_jit
+def _mq_start(reg, stream, start, end):
+	# start decoding the codeword stream[start:end], the context states are kept
+	reg[_START], reg[_END] = start, end
+	reg[_A] = 0
+	reg[_C] = 0
+	reg[_t] = 0
+	reg[_T] = 0
+	reg[_L] = start
+	_fill_lsb(reg, stream)
+	reg[_C] <<= reg[_t]
+	_fill_lsb(reg, stream)
+	reg[_C] <<= 7
+	reg[_t] -= 7
+	reg[_A] = 0x8000
+
+
+@_jit
+def _decode(reg, index, mps, stream, raw, cx):
+	# decode one symbol, a raw bit in a raw segment, bits past its end are 0
+	if raw:
+		n = reg[_BIT]
+		reg[_BIT] = n + 1
+		if reg[_START] + (n >> 3) >= reg[_END]:
+			return 0
+		return (stream[reg[_START] + (n >> 3)] >> (7 - (n & 7))) & 1
+	i = index[cx]
+	p = _QE_ARRAY[i]
+	m = mps[cx]
+	A = reg[_A] - p
+	C = reg[_C]
+	expected = m if A >= p else 1 - m
+	active = (C >> 8) & 0xFFFF
+	if active < p:
+		symbol = 1 - expected
+		A = p
+	else:
+		symbol = expected
+		C = (C & 0xFF) | ((active - p) << 8)
+	if A < 0x8000:
+		if symbol == m:
+			index[cx] = _NMPS_ARRAY[i]
+		else:
+			mps[cx] = m ^ _SWITCH_ARRAY[i]
+			index[cx] = _NLPS_ARRAY[i]
+		while A < 0x8000:
+			if reg[_t] == 0:
+				reg[_C] = C
+				_fill_lsb(reg, stream)
+				C = reg[_C]
+			A <<= 1
+			C = (C << 1) & 0xFFFFFF
+			reg[_t] -= 1
+	reg[_A] = A
+	reg[_C] = C
+	return symbol
+
+
+@_jit
+def _sign_decode(reg, index, mps, stream, raw, nb, scContext, scPredict):
+	return _decode(reg, index, mps, stream, raw, scContext[nb]) ^ scPredict[nb]
+
+
+@_jit
+def _significance_decode(reg, index, mps, stream, raw, magnitudes, bit, state, active, signs, zeroContexts, scContext, scPredict):
+	h, w = magnitudes.shape
+	for i in range(active.shape[0]):
+		for col in range(w):
+			if not active[i, col + 1]:
+				continue
+			for row in range(4 * i, min(4 * i + 4, h)):
+				flags = state[row + 1, col + 1]
+				if flags & _SIG:
+					continue
+				nb = flags & _NEIGHBOURS
+				if not nb:
+					continue
+				state[row + 1, col + 1] |= _CODED
+				if _decode(reg, index, mps, stream, raw, zeroContexts[nb]):
+					magnitudes[row, col] |= bit
+					signs[row, col] = _sign_decode(reg, index, mps, stream, raw, nb, scContext, scPredict)
+					_set_significant(state, active, row, col)
+
+
+@_jit
+def _refinement_decode(reg, index, mps, stream, raw, magnitudes, bit, state, active, mrTable):
+	h, w = magnitudes.shape
+	for i in range(active.shape[0]):
+		for col in range(w):
+			if not active[i, col + 1]:
+				continue
+			for row in range(4 * i, min(4 * i + 4, h)):
+				flags = state[row + 1, col + 1]
+				if flags & (_SIG | _CODED) != _SIG:
+					continue
+				if _decode(reg, index, mps, stream, raw, mrTable[flags & (_REFINED | _NEIGHBOURS)]):
+					magnitudes[row, col] |= bit
+				state[row + 1, col + 1] |= _REFINED
+
+
+@_jit
+def _cleanup_decode(reg, index, mps, stream, raw, magnitudes, bit, state, active, signs, zeroContexts, scContext, scPredict):
+	h, w = magnitudes.shape
+	for i in range(active.shape[0]):
+		for col in range(w):
+			start = 4 * i
+			if not active[i, col + 1] and 4 * i + 4 <= h:
+				start = 4 * i + 4
+				if _decode(reg, index, mps, stream, raw, 17):
+					position = _decode(reg, index, mps, stream, raw, 18) << 1
+					position |= _decode(reg, index, mps, stream, raw, 18)
+					row = 4 * i + position
+					magnitudes[row, col] |= bit
+					signs[row, col] = _sign_decode(reg, index, mps, stream, raw, state[row + 1, col + 1] & _NEIGHBOURS, scContext, scPredict)
+					_set_significant(state, active, row, col)
+					start = row + 1
+			for row in range(start, min(4 * i + 4, h)):
+				flags = state[row + 1, col + 1]
+				if flags & (_SIG | _CODED):
+					continue
+				nb = flags & _NEIGHBOURS
+				if _decode(reg, index, mps, stream, raw, zeroContexts[nb]):
+					magnitudes[row, col] |= bit
+					signs[row, col] = _sign_decode(reg, index, mps, stream, raw, nb, scContext, scPredict)
+					_set_significant(state, active, row, col)
+
+
+@_jit
+def decode_block(stream, segments, num, passes, h, w, zeroContexts, scContext, scPredict, mrTable):
+	"""
+	Decode the first passes coding passes of a code block with num bit-planes.
+
+	segments is a (n, 4) array of the (first pass, raw, offset, length) in stream of every coding segment, the first one starts at pass 0. Returns the decoded magnitudes and signs of the block, bits of the passes left are 0.
+	"""
+	state = np.zeros((h + 2, w + 2), dtype=np.int32)
+	active = np.zeros((-(-h // 4), w + 2), dtype=np.uint8)
+	index = _INDEX0.copy()
+	mps = _MPS0.copy()
+	reg = np.zeros(8, dtype=np.int64)
+	magnitudes = np.zeros((h, w), dtype=np.int64)
+	signs = np.zeros((h, w), dtype=np.int64)
+	k = 0
+	raw = 0
+	for n in range(passes):
+		if k < len(segments) and segments[k, 0] == n:
+			raw = segments[k, 1]
+			start, end = segments[k, 2], segments[k, 2] + segments[k, 3]
+			if raw:
+				reg[_START], reg[_END], reg[_BIT] = start, end, 0
+			else:
+				# an MQ codeword goes on with the context states of the previous ones
+				_mq_start(reg, stream, start, end)
+			k += 1
+		bit = 1 << (num - 1 - n // 3)
+		if n % 3 == 0:
+			_significance_decode(reg, index, mps, stream, raw, magnitudes, bit, state, active, signs, zeroContexts, scContext, scPredict)
+		elif n % 3 == 1:
+			_refinement_decode(reg, index, mps, stream, raw, magnitudes, bit, state, active, mrTable)
+		else:
+			_cleanup_decode(reg, index, mps, stream, raw, magnitudes, bit, state, active, signs, zeroContexts, scContext, scPredict)
+			for row in range(h + 2):
+				for col in range(w + 2):
+					state[row, col] &= ~_CODED
+	return magnitudes, signs
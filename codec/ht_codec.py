@@ -0,0 +1,441 @@
+__all__ = [
+  "HTCodec"
+]
+
+import struct
+
+import numpy as np
+
+from ..base import Codec
+from ..config import read_config
+from ..funcs import ArraySpec, SharedArrays, call_shared, shared_starmap, write_into
+from .ebcot_codec import _band_keys, _band_array, _block_shape, _band_assemble, _tile_assemble
+
+
+config = read_config()
+
+min_task_number = config.get("accelerate", "codec_min_task_number")
+max_pool_size = config.get("accelerate", "codec_max_pool_size")
+
+# Layout of the codestream of a tile, the same as EBCOTCodec except for the code blocks.
+# tile  := TILE_HEADER band_index band * (n_channels * (3 * D + 1))
+# band  := BAND_HEADER block_index block * (ceil(height / h) * ceil(width / w))
+# block := BLOCK_HEADER mel vlc magsgn
+_TILE_HEADER = struct.Struct("<BB")  # D, number of channels
+_BAND_HEADER = struct.Struct("<IIHH")  # height and width of band, height h and width w of code block
+_BLOCK_HEADER = struct.Struct("<HH")  # bytes of the MEL and VLC streams, the MagSgn stream takes the rest
+_INDEX_DTYPE = np.dtype("<u4")
+
+# Exponents of the run lengths of the MEL coder, its state goes up after a run of 2 ** E zeros and down after a one.
+_MEL_E = (0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 4, 5)
+
+
+def _vlc_codes():
+  # prefix codes (code, length) of the significance pattern rho of a quad, grouped by the number of significant samples
+  # T0 codes quads without significant neighbours, which the MEL has already coded as significant, T1 all other quads
+  groups = {n: [rho for rho in range(16) if bin(rho).count("1") == n] for n in range(5)}
+  T0 = {}
+  T1 = {0: (0b0, 1)}
+  for prefix, length, bits, n in [(0b0, 1, 2, 1), (0b10, 2, 0, 4), (0b110, 3, 3, 2), (0b111, 3, 2, 3)]:
+    for i, rho in enumerate(groups[n]):
+      T0[rho] = (prefix << bits | i, length + bits)
+  for prefix, length, bits, n in [(0b10, 2, 2, 1), (0b110, 3, 0, 4), (0b1110, 4, 3, 2), (0b1111, 4, 2, 3)]:
+    for i, rho in enumerate(groups[n]):
+      T1[rho] = (prefix << bits | i, length + bits)
+  return T0, T1
+
+
+def _vlc_lookup(codes, size=7):
+  # (rho, length) of the code that starts each of the 2 ** size possible next size bits
+  lookup = [None] * (1 << size)
+  for rho, (code, length) in codes.items():
+    start = code << (size - length)
+    for n in range(start, start + (1 << (size - length))):
+      lookup[n] = (rho, length)
+  return lookup
+
+
+_VLC_T0, _VLC_T1 = _vlc_codes()
+_VLC_LOOKUP_T0, _VLC_LOOKUP_T1 = _vlc_lookup(_VLC_T0), _vlc_lookup(_VLC_T1)
+_VLC_PEEK = 7
+_POPCOUNT = tuple(bin(rho).count("1") for rho in range(16))
+
+
+class HTCodec(Codec):
+  """
+  High-throughput block codec.
+
+  HTCodec codes the quantized subband pyramids from Quantizer like EBCOTCodec, but each code block is coded in a single pass in the style of the FBCOT block coder of HTJ2K instead of bit-plane by bit-plane with an MQ coder. Samples are grouped in 2 x 2 quads:
+
+  - whether a quad without significant neighbours is significant is coded by the adaptive run-length MEL coder,
+  - the significance pattern of the quad and the offset of its exponent bound from a prediction by the quads above are coded with variable length codes (VLC),
+  - magnitudes and signs of the significant samples are written as raw bits (MagSgn), as many as the exponent bound of their quad.
+
+  Only the VLC and MEL symbols are coded one by one, and there is about one of them per quad, so encoding and decoding are far faster than EBCOT, at the cost of a larger codestream. Code blocks are not embedded and can not be truncated.
+  """
+
+  def __init__(self,
+               name="HT codec",
+               mode="encode",
+               accelerated=False
+               ):
+    """
+    Init and set attributes of a high-throughput block codec.
+
+    Explicit Attributes
+    -------------------
+    name: str, optional
+      Name of the codec.
+    mode: str, optional
+      Mode of the codec, must in ["encode", "decode"].
+    accelerated: bool, optional
+      Whether the process would be accelerated by subprocess pool.
+
+    Implicit Attributes
+    -------------------
+    min_task_number: int
+      Minimun task number to start a pool.
+    max_pool_size: int
+      Maximun size of pool.
+    """
+    super().__init__()
+
+    self.name = name
+    self.mode = mode
+    self.accelerated = accelerated
+
+    self.min_task_number = min_task_number
+    self.max_pool_size = max_pool_size
+
+  def encode(self, X, **params):
+    self.logs[-1] += self.formatter.message("Trying to encode received data.")
+    if self.accelerated:
+      self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate HT encoding.")
+      with self.pool(self.max_pool_size) as p, SharedArrays.copy(X) as shared:
+        bitcodes = p.starmap(call_shared, [[_shared_tile_encode, shared.descriptor(k), None] for k in range(len(X))])
+    else:
+      bitcodes = [_tile_encode(x) for x in X]
+
+    return bitcodes
+
+  def decode(self, bitcodes, **params):
+    self.logs[-1] += self.formatter.message("Trying to decode received data.")
+    if self.accelerated:
+      self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate HT decoding.")
+      codestreams = [np.frombuffer(bitcode, dtype=np.uint8) for bitcode in bitcodes]
+      with self.pool(self.max_pool_size) as p:
+        X = shared_starmap(p, write_into, codestreams, [_tile_structure(bitcode) for bitcode in bitcodes], _tile_decode)
+    else:
+      X = [_tile_decode(bitcode) for bitcode in bitcodes]
+
+    return X
+
+
+def _tile_encode(tile, h=64, w=64):
+  # return the codestream of a tile as bytes, D is the number of levels of the tile
+  D, n_channels = len(tile) - 1, tile[0].shape[2]
+  bandIndex = np.zeros((n_channels * (3 * D + 1), 2), dtype=_INDEX_DTYPE)
+  segments = [_TILE_HEADER.pack(D, n_channels), None]
+  offset = _TILE_HEADER.size + bandIndex.nbytes
+  for n, (index, k, _) in enumerate(_band_keys(D, n_channels)):
+    band = np.asarray(_band_array(tile, index)[:, :, k], dtype=np.int64)
+    h_cA, w_cA = band.shape
+    h_num, w_num = -(-h_cA // h), -(-w_cA // w)
+    # code blocks on the bottom and right edges are cut to the band as in EBCOTCodec, and padded to whole quads
+    blocks = []
+    for i in range(h_num):
+      for j in range(w_num):
+        block = band[i * h:(i + 1) * h, j * w:(j + 1) * w]
+        blocks.append(_block_encode(np.pad(block, ((0, block.shape[0] % 2), (0, block.shape[1] % 2)))))
+    blockIndex = np.zeros((len(blocks), 2), dtype=_INDEX_DTYPE)
+    start = offset
+    offset += _BAND_HEADER.size + blockIndex.nbytes
+    for m, block in enumerate(blocks):
+      blockIndex[m] = offset, len(block)
+      offset += len(block)
+    bandIndex[n] = start, offset - start
+    segments.append(_BAND_HEADER.pack(h_cA, w_cA, h, w))
+    segments.append(blockIndex.tobytes())
+    segments.extend(blocks)
+  segments[1] = bandIndex.tobytes()
+  return b"".join(segments)
+
+
+def _shared_tile_encode(tile, _):
+  # code a tile in shared memory, the codestream is returned
+  return _tile_encode(tile)
+
+
+def _tile_structure(codestream):
+  # ArraySpec of the tile decoded from a codestream, read from its band headers
+  codestream = memoryview(codestream)
+  D, n_channels = _TILE_HEADER.unpack_from(codestream, 0)
+  n_bands = n_channels * (3 * D + 1)
+  bandIndex = np.frombuffer(codestream, dtype=_INDEX_DTYPE, count=2 * n_bands, offset=_TILE_HEADER.size).reshape(n_bands, 2)
+  structure = [None] + [[None] * 3 for _ in range(D)]
+  for (index, k, _), (offset, _) in zip(_band_keys(D, n_channels), bandIndex.tolist()):
+    h_cA, w_cA, _, _ = _BAND_HEADER.unpack_from(codestream, offset)
+    if len(index) == 1:
+      structure[0] = ArraySpec((h_cA, w_cA, n_channels), "<f8")
+    else:
+      structure[index[0]][index[1]] = ArraySpec((h_cA, w_cA, n_channels), "<f8")
+  return [structure[0]] + [tuple(details) for details in structure[1:]]
+
+
+def _tile_decode(codestream):
+  # decode the codestream of a tile from _tile_encode
+  codestream = memoryview(codestream)
+  D, n_channels = _TILE_HEADER.unpack_from(codestream, 0)
+  n_bands = n_channels * (3 * D + 1)
+  bandIndex = np.frombuffer(codestream, dtype=_INDEX_DTYPE, count=2 * n_bands, offset=_TILE_HEADER.size).reshape(n_bands, 2)
+  channels = [[] for _ in range(n_channels)]
+  for (index, k, _), (offset, _) in zip(_band_keys(D, n_channels), bandIndex.tolist()):
+    h_cA, w_cA, h, w = _BAND_HEADER.unpack_from(codestream, offset)
+    n_blocks = -(-h_cA // h) * -(-w_cA // w)
+    blockIndex = np.frombuffer(codestream, dtype=_INDEX_DTYPE, count=2 * n_blocks, offset=offset + _BAND_HEADER.size)
+    blocks = []
+    for n, (start, length) in enumerate(blockIndex.reshape(-1, 2).tolist()):
+      rows, cols = _block_shape(h_cA, w_cA, h, w, *divmod(n, -(-w_cA // w)))
+      blocks.append(_block_decode(codestream[start:start + length], rows + rows % 2, cols + cols % 2))
+    channels[k].append(_band_assemble(blocks, h_cA, w_cA, h, w))
+
+  return _tile_assemble(channels, D)
+
+
+def _block_encode(block):
+  """
+  Code a code block of even height and width in one HT cleanup pass, return BLOCK_HEADER and the MEL, VLC and MagSgn streams.
+
+  Each significant sample is coded as v = 2 * (magnitude - 1) + sign in U bits, U is the exponent bound of its quad. U is at least the bit length of v of every sample of the quad and at least kappa, the prediction from the bounds of the 3 quads above, so only the offset u = U - kappa is coded.
+  """
+  quads = _quads(np.abs(block))
+  signs = _quads(block < 0)
+  sig = quads > 0
+  rho = sig.dot(np.array([1, 2, 4, 8]))
+  significant = rho > 0
+  v = np.where(sig, 2 * (quads - 1) + signs, 0)
+  E = _bit_lengths(v).max(axis=2)
+  context = _contexts(significant)
+
+  qh, qw = rho.shape
+  pop = np.array(_POPCOUNT)[rho]
+  U = np.zeros((qh, qw), dtype=np.int64)
+  kappa = np.zeros((qh, qw), dtype=np.int64)
+  for r in range(qh):
+    if r:
+      above = np.pad(U[r - 1], 1)
+      kappa[r] = np.where(pop[r] >= 2, np.maximum(np.maximum(np.maximum(above[:-2], above[1:-1]), above[2:]) - 1, 0), 0)
+    U[r] = np.where(significant[r], np.maximum(E[r], kappa[r]), 0)
+
+  mel = _mel_encode(significant[context == 0].tolist())
+
+  # VLC fields of each quad in raster order: the code of rho unless the MEL coded the quad as insignificant,
+  # and the exponential-Golomb code of u + 1 if the quad is significant
+  T0 = np.array([_VLC_T0.get(n, (0, 0)) for n in range(16)])
+  T1 = np.array([_VLC_T1[n] for n in range(16)])
+  rhoCodes = np.where((context == 0)[..., np.newaxis], T0[rho], T1[rho])
+  u = U - kappa + 1
+  uCodes = np.stack([u, np.where(significant, 2 * _bit_lengths(u) - 1, 0)], axis=-1)
+  fields = np.stack([rhoCodes, uCodes], axis=2).reshape(-1, 2)
+  vlc = _pack(fields[:, 0], fields[:, 1])
+
+  magsgn = _pack(v[sig], np.broadcast_to(U[..., np.newaxis], sig.shape)[sig])
+
+  return _BLOCK_HEADER.pack(len(mel), len(vlc)) + mel + vlc + magsgn
+
+
+def _block_decode(payload, h=64, w=64):
+  # decode a code block from _block_encode
+  melLength, vlcLength = _BLOCK_HEADER.unpack_from(payload, 0)
+  start = _BLOCK_HEADER.size
+  mel = _MELDecoder(payload[start:start + melLength])
+  vlc = _BitReader(payload[start + melLength:start + melLength + vlcLength])
+  magsgn = payload[start + melLength + vlcLength:]
+
+  qh, qw = h // 2, w // 2
+  rho = [[0] * (qw + 2) for _ in range(qh + 1)]
+  U = [[0] * (qw + 2) for _ in range(qh + 1)]
+  for r in range(1, qh + 1):
+    rhoAbove, UAbove, rhoRow, URow = rho[r - 1], U[r - 1], rho[r], U[r]
+    for c in range(1, qw + 1):
+      if rhoRow[c - 1] or rhoAbove[c - 1] or rhoAbove[c] or rhoAbove[c + 1]:
+        q, length = _VLC_LOOKUP_T1[vlc.peek(_VLC_PEEK)]
+      elif mel.decode():
+        q, length = _VLC_LOOKUP_T0[vlc.peek(_VLC_PEEK)]
+      else:
+        continue
+      vlc.skip(length)
+      if not q:
+        continue
+      rhoRow[c] = q
+      kappa = max(UAbove[c - 1], UAbove[c], UAbove[c + 1]) - 1 if r > 1 and _POPCOUNT[q] >= 2 else 0
+      URow[c] = max(kappa, 0) + vlc.exp_golomb() - 1
+
+  rho = np.array(rho)[1:, 1:-1]
+  U = np.array(U)[1:, 1:-1]
+  sig = ((rho[..., np.newaxis] >> np.arange(4)) & 1).astype(bool)
+  v = _unpack(magsgn, np.broadcast_to(U[..., np.newaxis], sig.shape)[sig])
+  quads = np.zeros(sig.shape, dtype=np.int64)
+  quads[sig] = np.where(v & 1, -((v >> 1) + 1), (v >> 1) + 1)
+  return _unquads(quads).astype(np.float64)
+
+
+def _quads(block):
+  # (h // 2, w // 2, 4) quads of a block, the samples of a quad are ordered column by column
+  h, w = block.shape
+  return block.reshape(h // 2, 2, w // 2, 2).transpose(0, 2, 3, 1).reshape(h // 2, w // 2, 4)
+
+
+def _unquads(quads):
+  qh, qw, _ = quads.shape
+  return quads.reshape(qh, qw, 2, 2).transpose(0, 3, 1, 2).reshape(2 * qh, 2 * qw)
+
+
+def _contexts(significant):
+  # 1 for quads with a significant neighbour on the left or in the 3 quads above, 0 otherwise
+  qh, qw = significant.shape
+  neighbours = np.zeros((qh + 1, qw + 2), dtype=bool)
+  neighbours[1:, 1:-1] = significant
+  context = neighbours[1:, :-2] | neighbours[:-1, :-2] | neighbours[:-1, 1:-1] | neighbours[:-1, 2:]
+  return context.astype(np.int64)
+
+
+def _bit_lengths(x):
+  # bit length of every non-negative int of x
+  x = np.array(x, dtype=np.int64)
+  n = np.zeros(x.shape, dtype=np.int64)
+  while np.any(x):
+    n += x > 0
+    x >>= 1
+  return n
+
+
+def _pack(values, widths):
+  # concatenate the widths[k] low bits of values[k], most significant first, into bytes
+  values, widths = np.asarray(values, dtype=np.int64), np.asarray(widths, dtype=np.int64)
+  if not widths.size or not widths.max():
+    return b""
+  shifts = np.arange(widths.max() - 1, -1, -1)
+  bits = (values[:, np.newaxis] >> shifts) & 1
+  return np.packbits(bits[shifts < widths[:, np.newaxis]].astype(np.uint8)).tobytes()
+
+
+def _unpack(stream, widths):
+  # inverse of _pack, bits past the end of stream are 0
+  widths = np.asarray(widths, dtype=np.int64)
+  if not widths.size or not widths.max():
+    return np.zeros(widths.shape, dtype=np.int64)
+  bits = np.unpackbits(np.frombuffer(stream, dtype=np.uint8)).astype(np.int64)
+  bits = np.append(bits, np.zeros(max(int(widths.sum()) - len(bits), 0), dtype=np.int64))
+  positions = np.arange(widths.max())
+  starts = np.cumsum(widths) - widths
+  valid = positions < widths[:, np.newaxis]
+  taken = np.where(valid, bits[np.where(valid, starts[:, np.newaxis] + positions, 0)], 0)
+  return np.sum(taken << np.maximum(widths[:, np.newaxis] - 1 - positions, 0), axis=1)
+
+
+def _mel_encode(symbols):
+  # adaptive run-length code of binary symbols: a 1 is a run of 2 ** E zeros, a 0 followed by E bits is a shorter run and a one
+  writer = _BitWriter()
+  k = run = 0
+  for symbol in symbols:
+    if symbol:
+      writer.write(0, 1)
+      writer.write(run, _MEL_E[k])
+      k = max(k - 1, 0)
+      run = 0
+    else:
+      run += 1
+      if run == 1 << _MEL_E[k]:
+        writer.write(1, 1)
+        k = min(k + 1, len(_MEL_E) - 1)
+        run = 0
+  if run:
+    # the decoder stops before the zeros past the last symbol
+    writer.write(1, 1)
+  return writer.bytes()
+
+
+class _MELDecoder:
+  """
+  Decoder of the symbols of _mel_encode.
+  """
+
+  def __init__(self, stream):
+    self.reader = _BitReader(stream)
+    self.k = 0
+    self.zeros = 0
+    self.one = False
+
+  def decode(self):
+    if self.zeros:
+      self.zeros -= 1
+      return 0
+    if self.one:
+      self.one = False
+      return 1
+    e = _MEL_E[self.k]
+    if self.reader.read(1):
+      self.zeros = (1 << e) - 1
+      self.k = min(self.k + 1, len(_MEL_E) - 1)
+      return 0
+    run = self.reader.read(e)
+    self.k = max(self.k - 1, 0)
+    if run:
+      self.zeros = run - 1
+      self.one = True
+      return 0
+    return 1
+
+
+class _BitWriter:
+  """
+  Bits written most significant first into one python int.
+  """
+
+  def __init__(self):
+    self.value = 0
+    self.size = 0
+
+  def write(self, value, n):
+    self.value = (self.value << n) | value
+    self.size += n
+
+  def bytes(self):
+    pad = -self.size % 8
+    return (self.value << pad).to_bytes((self.size + pad) // 8, "big")
+
+
+class _BitReader:
+  """
+  Reader of the bits of _BitWriter, bits past the end of stream are 0.
+  """
+
+  def __init__(self, stream):
+    self.value = int.from_bytes(stream, "big")
+    self.size = 8 * len(stream)
+    self.pos = 0
+
+  def peek(self, n):
+    shift = self.size - self.pos - n
+    if shift >= 0:
+      return (self.value >> shift) & ((1 << n) - 1)
+    return (self.value << -shift) & ((1 << n) - 1)
+
+  def skip(self, n):
+    self.pos += n
+
+  def read(self, n):
+    bits = self.peek(n)
+    self.pos += n
+    return bits
+
+  def exp_golomb(self):
+    # a value x >= 1 coded as bit_length(x) - 1 zeros and the bits of x
+    zeros = 0
+    while not self.read(1):
+      zeros += 1
+      if self.pos >= self.size:
+        # the bits past the end are all 0, the code never ends
+        raise ValueError("Truncated or corrupt VLC stream.")
+    return (1 << zeros) | self.read(zeros)
@@ -1,5 +1,3 @@
-from multiprocessing import Pool
-
 from ..base import Codec
 from ..config import read_config
 from ..utils.lut import dht2lut
@@ -83,7 +81,7 @@ class HuffmanCodec(Codec):
         inputs = [[x, lut] for x, lut in zip(X, self.luts)]
       else:
         inputs = [[x, []] for x in X]
-      with Pool(min(self.task_number, self.max_pool_size)) as p:
+      with self.pool(min(self.task_number, self.max_pool_size)) as p:
         X = p.starmap(_encode, inputs)
     else:
       if self.use_lut:
@@ -106,7 +104,7 @@ class HuffmanCodec(Codec):
     if self.accelerated:
       self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate decoding.")
       inputs = [[x, lut] for x, lut in zip(X, self.luts)]
-      with Pool(min(self.task_number, self.max_pool_size)) as p:
+      with self.pool(min(self.task_number, self.max_pool_size)) as p:
         X = p.map(_decode, inputs)
     else:
       X = [_decode(x, lut) for x, lut in zip(X, self.luts)]
@@ -0,0 +1,385 @@
+__all__ = [
+	"MQEncoder",
+	"MQBatchEncoder",
+	"MQDecoder"
+]
+
+import numpy as np
+
+from fpeg.config import read_config
+
+config = read_config()
+
+mq_table = config.get("jpeg2000", "mq_table")
+
+# Probability estimation table and initial context states of the MQ coder as
+# immutable tuples of python ints, so that no copy is needed per code block.
+PETTable, CXTable = mq_table
+_NMPS = tuple(int(x) for x in PETTable[:, 0])
+_NLPS = tuple(int(x) for x in PETTable[:, 1])
+_SWITCH = tuple(int(x) for x in PETTable[:, 2])
+_QE = tuple(int(x) for x in PETTable[:, 3])
+_INITIAL_INDEX = bytes(int(cx[0]) for cx in CXTable)
+_INITIAL_MPS = bytes(int(cx[1]) for cx in CXTable)
+
+# the same tables as arrays for MQBatchEncoder
+_NMPS_ARRAY = np.array(_NMPS, dtype=np.int64)
+_NLPS_ARRAY = np.array(_NLPS, dtype=np.int64)
+_SWITCH_ARRAY = np.array(_SWITCH, dtype=np.int64)
+_QE_ARRAY = np.array(_QE, dtype=np.int64)
+
+
+class MQEncoder:
+	"""
+	MQ arithmetic encoder.
+
+	MQEncoder keeps its registers in plain python ints and its context states in a bytearray, and writes bytes into a preallocated bytearray. It produces exactly the same stream as _MQencode in ebcot_codec.py, which is kept as the reference implementation.
+
+	Registers
+	---------
+	A: interval length, C: lower bound register, t: down-counter, T: temporary byte buffer, L: current code byte number.
+	"""
+
+	def __init__(self, size=4096):
+		"""
+		Init an encoder whose output buffer is preallocated with size bytes, the buffer grows when it is full.
+		"""
+		self.index = bytearray(_INITIAL_INDEX)
+		self.mps = bytearray(_INITIAL_MPS)
+		self.buffer = bytearray(size)
+		self.restart()
+
+	def reset(self):
+		"""
+		Reset the context states and the registers for a new code block.
+		"""
+		self.index[:] = _INITIAL_INDEX
+		self.mps[:] = _INITIAL_MPS
+		self.restart()
+
+	def restart(self):
+		"""
+		Reset the registers for a new codeword, the context states are kept.
+		"""
+		self.A = 0x8000
+		self.C = 0
+		self.t = 12
+		self.T = 0
+		self.L = -1
+
+	def encode(self, symbol, cx):
+		"""
+		Encode one symbol with context label cx.
+		"""
+		index = self.index[cx]
+		p = _QE[index]
+		A = self.A - p
+		C = self.C
+		if symbol == self.mps[cx]:
+			if A >= 0x8000:
+				self.A = A
+				self.C = C + p
+				return
+			if A < p:
+				A = p
+			else:
+				C += p
+			self.index[cx] = _NMPS[index]
+		else:
+			if A < p:
+				C += p
+			else:
+				A = p
+			self.mps[cx] ^= _SWITCH[index]
+			self.index[cx] = _NLPS[index]
+
+		t = self.t
+		while A < 0x8000:
+			shift = min(16 - A.bit_length(), t)
+			A <<= shift
+			C <<= shift
+			t -= shift
+			if t == 0:
+				self.C = C
+				self._transferbyte()
+				C, t = self.C, self.t
+		self.A, self.C, self.t = A, C, t
+
+	def encode_symbols(self, D, CX):
+		"""
+		Encode a sequence of symbols D with context labels CX.
+
+		The per-symbol loop runs on local variables, use it when the symbols are already materialized.
+		"""
+		index, mps = self.index, self.mps
+		A, C, t = self.A, self.C, self.t
+		for symbol, cx in zip(D, CX):
+			i = index[cx]
+			p = _QE[i]
+			A -= p
+			if symbol == mps[cx]:
+				if A >= 0x8000:
+					C += p
+					continue
+				if A < p:
+					A = p
+				else:
+					C += p
+				index[cx] = _NMPS[i]
+			else:
+				if A < p:
+					C += p
+				else:
+					A = p
+				mps[cx] ^= _SWITCH[i]
+				index[cx] = _NLPS[i]
+
+			while A < 0x8000:
+				shift = min(16 - A.bit_length(), t)
+				A <<= shift
+				C <<= shift
+				t -= shift
+				if t == 0:
+					self.C = C
+					self._transferbyte()
+					C, t = self.C, self.t
+		self.A, self.C, self.t = A, C, t
+
+	def flush(self):
+		"""
+		Terminate the codeword and return the coded bytes.
+		"""
+		nbits = 27 - 15 - self.t
+		self.C <<= self.t
+		while nbits > 0:
+			self._transferbyte()
+			nbits -= self.t
+			self.C <<= self.t
+		self._transferbyte()
+
+		return bytes(self.buffer[:self.L])
+
+	def _transferbyte(self):
+		# carry of C is transferred to T unless T is 0xFF, in which case a bit is stuffed
+		C, T = self.C, self.T
+		if T == 0xFF:
+			self._putbyte()
+			self.T = (C >> 20) & 0xFF
+			self.C = C & 0xFFFFF
+			self.t = 7
+		else:
+			T += (C >> 27) & 1
+			C ^= 0x8000000
+			self.T = T
+			self._putbyte()
+			if T == 0xFF:
+				self.T = (C >> 20) & 0xFF
+				self.C = C & 0xFFFFF
+				self.t = 7
+			else:
+				self.T = (C >> 19) & 0xFF
+				self.C = C & 0x807FFFF
+				self.t = 8
+
+	def _putbyte(self):
+		# the first call only primes T, following calls write T to the buffer
+		if self.L >= 0:
+			if self.L == len(self.buffer):
+				self.buffer.extend(bytes(len(self.buffer) + 1))
+			self.buffer[self.L] = self.T
+		self.L += 1
+
+
+class MQBatchEncoder:
+	"""
+	MQ arithmetic encoders of a batch of codewords coded in lockstep.
+
+	The registers, context states and output buffers of all codewords are numpy arrays indexed by codeword. Each call codes one step, such as one symbol, in each codeword of a subset ks, given as an array of distinct codeword numbers, with a few array operations for the whole subset. Every codeword gets exactly the same stream as from MQEncoder.
+	"""
+
+	def __init__(self, n, size=4096):
+		"""
+		Init n encoders whose output buffers are preallocated with size bytes each, the buffers grow when one is full.
+		"""
+		self.index = np.tile(np.frombuffer(_INITIAL_INDEX, dtype=np.uint8).astype(np.int64), (n, 1))
+		self.mps = np.tile(np.frombuffer(_INITIAL_MPS, dtype=np.uint8).astype(np.int64), (n, 1))
+		self.buffer = np.zeros((n, size), dtype=np.uint8)
+		self.A = np.full(n, 0x8000, dtype=np.int64)
+		self.C = np.zeros(n, dtype=np.int64)
+		self.t = np.full(n, 12, dtype=np.int64)
+		self.T = np.zeros(n, dtype=np.int64)
+		self.L = np.full(n, -1, dtype=np.int64)
+
+	def restart(self, ks):
+		"""
+		Reset the registers of codewords ks for new codewords, the context states are kept.
+		"""
+		self.A[ks] = 0x8000
+		self.C[ks] = 0
+		self.t[ks] = 12
+		self.T[ks] = 0
+		self.L[ks] = -1
+
+	def encode(self, ks, symbols, cxs):
+		"""
+		Encode symbols[k] with context label cxs[k] in codeword ks[k].
+		"""
+		index = self.index[ks, cxs]
+		p = _QE_ARRAY[index]
+		mps = self.mps[ks, cxs]
+		A = self.A[ks] - p
+		isMps = symbols == mps
+		# the sub-intervals are exchanged when the MPS one would be the smaller
+		exchange = A < p
+		renormalize = ~isMps | (A < 0x8000)
+		self.C[ks] += np.where(isMps != exchange, p, 0)
+		self.A[ks] = np.where(isMps == exchange, p, A)
+		self.index[ks, cxs] = np.where(renormalize, np.where(isMps, _NMPS_ARRAY[index], _NLPS_ARRAY[index]), index)
+		self.mps[ks, cxs] = np.where(isMps, mps, mps ^ _SWITCH_ARRAY[index])
+		self._renormalize(ks[renormalize])
+
+	def flush(self, ks):
+		"""
+		Terminate codewords ks and return their coded bytes as a list.
+		"""
+		nbits = 27 - 15 - self.t[ks]
+		self.C[ks] <<= self.t[ks]
+		left = ks[nbits > 0]
+		while left.size:
+			self._transferbyte(left)
+			nbits[nbits > 0] -= self.t[left]
+			self.C[left] <<= self.t[left]
+			left = ks[nbits > 0]
+		self._transferbyte(ks)
+
+		return [self.buffer[k, :self.L[k]].tobytes() for k in ks.tolist()]
+
+	def _renormalize(self, ks):
+		# double A and C of codewords ks until A is at least 0x8000, a byte is transferred whenever t runs out
+		while ks.size:
+			A, t = self.A[ks], self.t[ks]
+			shift = np.minimum(16 - np.frexp(A)[1], t)
+			self.A[ks] = A << shift
+			self.C[ks] <<= shift
+			t = t - shift
+			self.t[ks] = t
+			if not t.all():
+				self._transferbyte(ks[t == 0])
+			ks = ks[self.A[ks] < 0x8000]
+
+	def _transferbyte(self, ks):
+		# same as MQEncoder._transferbyte for codewords ks
+		C, T = self.C[ks], self.T[ks]
+		stuffed = T == 0xFF
+		T = np.where(stuffed, T, T + ((C >> 27) & 1))
+		C = np.where(stuffed, C, C ^ 0x8000000)
+		self.T[ks] = T
+		self._putbyte(ks)
+		full = T == 0xFF
+		self.T[ks] = np.where(full, (C >> 20) & 0xFF, (C >> 19) & 0xFF)
+		self.C[ks] = np.where(full, C & 0xFFFFF, C & 0x807FFFF)
+		self.t[ks] = np.where(full, 7, 8)
+
+	def _putbyte(self, ks):
+		# the first call only primes T, following calls write T to the buffer
+		L = self.L[ks]
+		if L.size and L.max() >= self.buffer.shape[1]:
+			self.buffer = np.concatenate([self.buffer, np.zeros_like(self.buffer)], axis=1)
+		written = L >= 0
+		self.buffer[ks[written], L[written]] = self.T[ks[written]]
+		self.L[ks] = L + 1
+
+
+class MQDecoder:
+	"""
+	MQ arithmetic decoder.
+
+	MQDecoder is the counterpart of MQEncoder and decodes the same symbols as _MQ_decode in ebcot_codec.py. The stream can be any bytes-like object, bytes past its end are read as 0xFF.
+	"""
+
+	def __init__(self, stream=b""):
+		self.index = bytearray(_INITIAL_INDEX)
+		self.mps = bytearray(_INITIAL_MPS)
+		self.start(stream)
+
+	def reset(self, stream=b""):
+		"""
+		Reset the context states and start decoding stream of a new code block.
+		"""
+		self.index[:] = _INITIAL_INDEX
+		self.mps[:] = _INITIAL_MPS
+		self.start(stream)
+
+	def start(self, stream):
+		"""
+		Start decoding a new codeword, the context states are kept.
+		"""
+		self.stream = stream
+		self.A = 0
+		self.C = 0
+		self.t = 0
+		self.T = 0
+		self.L = 0
+		self._fill_lsb()
+		self.C <<= self.t
+		self._fill_lsb()
+		self.C <<= 7
+		self.t -= 7
+		self.A = 0x8000
+
+	def decode(self, cx):
+		"""
+		Decode one symbol with context label cx.
+		"""
+		index = self.index[cx]
+		p = _QE[index]
+		mps = self.mps[cx]
+		A = self.A - p
+		C = self.C
+		expected = mps if A >= p else 1 - mps
+		active = (C >> 8) & 0xFFFF
+		if active < p:
+			symbol = 1 - expected
+			A = p
+		else:
+			symbol = expected
+			C = (C & 0xFF) | ((active - p) << 8)
+		if A < 0x8000:
+			if symbol == mps:
+				self.index[cx] = _NMPS[index]
+			else:
+				self.mps[cx] = mps ^ _SWITCH[index]
+				self.index[cx] = _NLPS[index]
+			t = self.t
+			while A < 0x8000:
+				if t == 0:
+					self.C = C
+					self._fill_lsb()
+					C, t = self.C, self.t
+				shift = min(16 - A.bit_length(), t)
+				A <<= shift
+				C = (C << shift) & 0xFFFFFF
+				t -= shift
+			self.t = t
+		self.A, self.C = A, C
+		return symbol
+
+	def decode_symbols(self, CX):
+		"""
+		Decode one symbol for each context label in CX and return them as a list.
+		"""
+		decode = self.decode
+		return [decode(cx) for cx in CX]
+
+	def _fill_lsb(self):
+		# bytes past the end of stream or after a marker are read as 0xFF
+		self.t = 8
+		L = self.L
+		if L == len(self.stream) or (self.T == 0xFF and self.stream[L] > 0x8F):
+			self.C += 0xFF
+		else:
+			if self.T == 0xFF:
+				self.t = 7
+			self.T = self.stream[L]
+			self.L = L + 1
+			self.C += self.T << (8 - self.t)
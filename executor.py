@@ -0,0 +1,84 @@
+__all__ = [
+  "Executor"
+]
+
+import multiprocessing
+
+from .config import read_config
+
+
+config = read_config()
+
+max_pool_size = config.get("accelerate", "codec_max_pool_size")
+
+
+class Executor:
+  """
+  Persistent subprocess pool shared by the accelerated pipes of a pipeline.
+
+  Opening a pool in every accelerated call makes each worker import numpy, cv2, pywt and the config again. An executor starts its workers once, on first use, and keeps them until it is shut down. With the forkserver start method the fpeg modules are imported once by the server and every worker is forked from it.
+
+  Executor can be used as a context manager, it is shut down when the context exits.
+  """
+
+  def __init__(self,
+               processes=max_pool_size,
+               start_method="forkserver",
+               preload=("fpeg.codec", "fpeg.transformer", "fpeg.utils")):
+    """
+    Init an executor, the workers are not started until the pool is used.
+
+    Explicit Attributes
+    -------------------
+    processes: int, optional
+      Number of workers, None for the number of cpus.
+    start_method: str, optional
+      Start method of the workers. Falls back to the default start method of the platform if it is not available.
+    preload: tuple of str, optional
+      Modules imported by the forkserver before forking workers.
+    """
+    self.processes = processes
+    self.start_method = start_method
+    self.preload = tuple(preload)
+
+    self._pool = None
+
+  @property
+  def pool(self):
+    """
+    The multiprocessing pool, started on first access.
+    """
+    if self._pool is None:
+      if self.start_method in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context(self.start_method)
+      else:
+        context = multiprocessing.get_context()
+      if context.get_start_method() == "forkserver":
+        context.set_forkserver_preload(list(self.preload))
+      self._pool = context.Pool(self.processes)
+
+    return self._pool
+
+  def map(self, func, iterable, chunksize=None):
+    return self.pool.map(func, iterable, chunksize)
+
+  def starmap(self, func, iterable, chunksize=None):
+    return self.pool.starmap(func, iterable, chunksize)
+
+  def shutdown(self):
+    """
+    Stop the workers after they finish their tasks. The executor can be used again, a new pool is started then.
+    """
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.shutdown()
+
+  def __repr__(self):
+    return "Executor with {} processes started by {}".format(self.processes, self.start_method)
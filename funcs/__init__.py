@@ -2,12 +2,36 @@ __all__ = [
   "cat_arrays_2d",
   "dcps_array_3d",
   "parse_marker",
+  "quantization_steps",
+  "synthesis_norms",
   "mq_table",
   "dwt_coeffs",
+  "SharedArrays",
+  "shared_starmap",
+  "call_shared",
+  "spec_like",
+  "ArraySpec",
+  "write_into",
+  "window_tiles",
+  "tile_window",
+  "band_windows",
+  "window_blocks",
 ]
 
 from .funcs import cat_arrays_2d
 from .funcs import dcps_array_3d
 from .jpeg_funcs import parse_marker
+from .jpeg_funcs import quantization_steps
+from .jpeg_funcs import synthesis_norms
 from .jpeg_funcs import mq_table
 from .jpeg_funcs import dwt_coeffs
+from .shared import SharedArrays
+from .shared import shared_starmap
+from .shared import call_shared
+from .shared import spec_like
+from .shared import ArraySpec
+from .shared import write_into
+from .roi import window_tiles
+from .roi import tile_window
+from .roi import band_windows
+from .roi import window_blocks
@@ -1,5 +1,7 @@
 __all__ = [
   "parse_marker",
+  "quantization_steps",
+  "synthesis_norms",
   "mq_table",
   "dwt_coeffs",
 ]
@@ -9,6 +11,42 @@ def parse_marker(QCD):
   return int(QCD[:5], 2), int(QCD[5:], 2)
 
 
+def quantization_steps(QCD, D):
+  """
+  Quantization steps delta_b of the D resolution levels, the LL band and the coarsest level use the first one.
+  """
+  epsilon_b, mu_b = parse_marker(QCD)
+  return [2 ** -(epsilon_b + i - D) * (1 + mu_b / (2 ** 11)) for i in range(D)]
+
+
+def synthesis_norms(wavelet, D):
+  """
+  L2 norms of the synthesis basis functions of the bands of a D level 2D wavelet transform, [LL, (LH, HL, HH) of every level from the coarsest] as the coefficients of wavedec2.
+
+  A coefficient error e of a band adds (e * norm) ** 2 to the squared error of the reconstructed image.
+  """
+  import numpy as np
+  from pywt import Wavelet
+
+  wavelet = Wavelet(wavelet)
+
+  def norm(level, high):
+    # iterate the low pass synthesis filter up from level 1, the last one is high pass for a detail band
+    basis = np.ones(1)
+    for i in range(level):
+      taps = wavelet.rec_hi if high and i == level - 1 else wavelet.rec_lo
+      filt = np.zeros(2 ** i * (len(taps) - 1) + 1)
+      filt[::2 ** i] = taps
+      basis = np.convolve(basis, filt)
+    return np.sqrt(np.sum(np.square(basis)))
+
+  norms = [norm(D, False) ** 2]
+  for level in range(D, 0, -1):
+    low, high = norm(level, False), norm(level, True)
+    norms.append((low * high, high * low, high * high))
+  return norms
+
+
 def mq_table():
   import numpy as np
 
@@ -0,0 +1,54 @@
+__all__ = [
+  "window_tiles",
+  "tile_window",
+  "band_windows",
+  "window_blocks"
+]
+
+from pywt import Wavelet
+
+
+def window_tiles(window, tile_shape, block_shape):
+  """
+  Rows and columns of the tiles that overlap window.
+
+  window is (y0, x0, y1, x1) in pixels of the image, y1 and x1 are excluded. The image is split into block_shape tiles of tile_shape, tile (i, j) is the (i * block_shape[1] + j)-th tile.
+  """
+  y0, x0, y1, x1 = window
+  rows = range(y0 // tile_shape[0], min(-(-y1 // tile_shape[0]), block_shape[0]))
+  cols = range(x0 // tile_shape[1], min(-(-x1 // tile_shape[1]), block_shape[1]))
+  return rows, cols
+
+
+def tile_window(window, tile_shape, i, j):
+  """
+  Part of window in tile (i, j), in pixels of the tile.
+  """
+  y0, x0, y1, x1 = window
+  top, left = i * tile_shape[0], j * tile_shape[1]
+  return max(y0 - top, 0), max(x0 - left, 0), min(y1 - top, tile_shape[0]), min(x1 - left, tile_shape[1])
+
+
+def band_windows(window, D, wavelet="bior2.2"):
+  """
+  Windows of the coefficients that the pixels of window in a tile are synthesized from.
+
+  Returns a window for every item of the tile the wavelet transform produces, the LL band first and then the details of each level, coarsest level first. A sample n of the synthesis of a level depends on the coefficients from n // 2 to (n + rec_len - 2) // 2 of the level, so the window grows by the filter support at every level and may exceed the band.
+  """
+  rec_len = Wavelet(wavelet).rec_len
+  y0, x0, y1, x1 = window
+  windows = []
+  for _ in range(D):
+    y0, x0 = y0 // 2, x0 // 2
+    y1, x1 = (y1 + rec_len - 3) // 2 + 1, (x1 + rec_len - 3) // 2 + 1
+    windows.append((y0, x0, y1, x1))
+
+  return [windows[-1]] + windows[::-1]
+
+
+def window_blocks(window, h, w, h_num, w_num):
+  """
+  Rows and columns of the h * w code blocks of a band with h_num * w_num code blocks that overlap window.
+  """
+  y0, x0, y1, x1 = window
+  return range(y0 // h, min(-(-y1 // h), h_num)), range(x0 // w, min(-(-x1 // w), w_num))
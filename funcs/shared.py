@@ -0,0 +1,151 @@
+__all__ = [
+  "ArraySpec",
+  "SharedArrays",
+  "call_shared",
+  "shared_starmap",
+  "spec_like",
+  "write_into"
+]
+
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Shape and dtype of an array, and its byte offset in a shared memory block.
+ArraySpec = namedtuple("ArraySpec", ["shape", "dtype", "offset"], defaults=[0])
+
+_ALIGNMENT = 64
+
+
+class SharedArrays:
+  """
+  Arrays nested in lists and tuples, e.g. a list of tiles or coefficient pyramids, stored in one shared memory block.
+
+  A worker attaches to the arrays of one element through a descriptor, a picklable tuple of the block name and the layout of the element, so no array data goes through pickle. The block is unlinked when the SharedArrays is closed, use it as a context manager.
+  """
+
+  def __init__(self, structure):
+    """
+    Allocate a block for structure, nested lists and tuples whose leaves are ArraySpec.
+    """
+    self.layout, size = _layout(structure, 0)
+    self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    self.arrays = _views(self.shm.buf, self.layout)
+
+  @classmethod
+  def copy(cls, arrays):
+    """
+    Allocate a block like arrays and copy arrays into it.
+    """
+    shared = cls(spec_like(arrays))
+    _fill(shared.arrays, arrays)
+    return shared
+
+  def descriptor(self, *index):
+    """
+    Descriptor of the element at index, e.g. descriptor(k) for the k-th tile.
+    """
+    layout = self.layout
+    for i in index:
+      layout = layout[i]
+    return self.shm.name, layout
+
+  def copy_out(self):
+    """
+    Return the arrays copied out of the block, they stay valid after the block is closed.
+    """
+    return _map(np.array, self.arrays)
+
+  def close(self):
+    self.arrays = None
+    self.shm.close()
+    self.shm.unlink()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+def spec_like(arrays, dtype=None):
+  """
+  Structure of ArraySpec with the nesting and shapes of arrays, and their dtypes unless dtype is given.
+  """
+  return _map(lambda x: ArraySpec(np.shape(x), np.dtype(dtype or np.asarray(x).dtype).str), arrays)
+
+
+def call_shared(func, src, dst, *args):
+  """
+  Entry of a worker: call func(src_arrays, dst_arrays, *args) on the arrays of descriptors src and dst and return its result.
+
+  func writes its output into dst_arrays, dst can be None if func returns its output instead. The arrays must not be kept after func returns, the blocks are detached then.
+  """
+  src_shm = shared_memory.SharedMemory(name=src[0])
+  dst_shm = None if dst is None else shared_memory.SharedMemory(name=dst[0])
+  try:
+    src_arrays = _views(src_shm.buf, src[1])
+    dst_arrays = None if dst is None else _views(dst_shm.buf, dst[1])
+    result = func(src_arrays, dst_arrays, *args)
+  finally:
+    src_arrays = dst_arrays = None
+    src_shm.close()
+    if dst_shm is not None:
+      dst_shm.close()
+
+  return result
+
+
+def shared_starmap(pool, func, X, structures, *args):
+  """
+  Map func over the elements of X in pool with shared memory transport.
+
+  Every worker calls func(x, out, *args), x is an element of X and out is allocated by structures, the structure of ArraySpec of every output element. Return the list of outputs.
+  """
+  with SharedArrays.copy(X) as src, SharedArrays(structures) as dst:
+    inputs = [[func, src.descriptor(k), dst.descriptor(k)] + list(args) for k in range(len(X))]
+    pool.starmap(call_shared, inputs)
+    return dst.copy_out()
+
+
+def write_into(x, out, func, *args):
+  """
+  Kernel of shared_starmap for functions returning new arrays: write func(x, *args) into out.
+  """
+  _fill(out, func(x, *args))
+
+
+def _map(func, arrays):
+  # apply func to every array, keeping the lists and tuples
+  if isinstance(arrays, (list, tuple)) and not isinstance(arrays, ArraySpec):
+    return type(arrays)(_map(func, x) for x in arrays)
+  return func(arrays)
+
+
+def _fill(out, arrays):
+  # copy arrays into out of the same structure
+  if isinstance(out, (list, tuple)):
+    for o, x in zip(out, arrays):
+      _fill(o, x)
+  else:
+    out[...] = arrays
+
+
+def _layout(structure, offset):
+  # assign aligned offsets to the ArraySpec of structure, return the layout and the end offset
+  if isinstance(structure, ArraySpec):
+    shape = tuple(int(n) for n in structure.shape)
+    size = int(np.prod(shape)) * np.dtype(structure.dtype).itemsize
+    return ArraySpec(shape, structure.dtype, offset), offset + -(-size // _ALIGNMENT) * _ALIGNMENT
+
+  layout = []
+  for x in structure:
+    x, offset = _layout(x, offset)
+    layout.append(x)
+  return type(structure)(layout), offset
+
+
+def _views(buf, layout):
+  return _map(lambda spec: np.ndarray(spec.shape, dtype=spec.dtype, buffer=buf, offset=spec.offset), layout)
@@ -1,4 +1,5 @@
 from fpeg.pipeline import Pipeline
+from fpeg.executor import Executor
 from fpeg.codec import EBCOTCodec
 from fpeg.transformer import DWTransformer
 from fpeg.utils import *
@@ -27,7 +28,8 @@ def jpeg2000_compress(args):
                           "quantizer0": {"mode": "quantify", "irreversible": True, "D": args.level},
                           "ebcot codec0": {"mode": "encode", "accelerated": args.accelerated, "tile_shape": args.tile_shape},
                           "writer0": {"path": args.output, "binary": True}
-                        })
+                        },
+                        executor=Executor() if args.accelerated else None)
   else:
     pipeline = Pipeline([
                         ("reader0", Reader()),
@@ -49,8 +51,10 @@ def jpeg2000_compress(args):
                           "quantizer0": {"mode": "quantify", "irreversible": False, "D": args.level},
                           "ebcot codec0": {"mode": "encode", "accelerated": args.accelerated, "tile_shape": args.tile_shape},
                           "writer0": {"path": args.output, "binary": False}
-                        })
-  pipeline.recv(args.input)
+                        },
+                        executor=Executor() if args.accelerated else None)
+  with pipeline:
+    pipeline.recv(args.input)
   print(pipeline.get_log())
 
 
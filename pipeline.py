@@ -20,9 +20,12 @@ class Pipeline:
                params={},
                testers={},
                monitor=Monitor(),
-               formatter=Formatter(fmt=time_format)):
+               formatter=Formatter(fmt=time_format),
+               executor=None):
     """
     Init pipeline.
+
+    executor is an optional fpeg.executor.Executor shared by all accelerated pipes. It is shut down by shutdown or when the pipeline is used as a context manager and the context exits.
     """
     self.steps = steps
 
@@ -31,6 +34,7 @@ class Pipeline:
     self.testers = testers
     self.monitor = monitor
     self.formatter = formatter
+    self.executor = executor
 
     self.names = []
     self.pipes = []
@@ -86,7 +90,8 @@ class Pipeline:
                                **{
                                "name": self.names[i],
                                "monitor": self.monitor,
-                               "formatter": self.formatter
+                               "formatter": self.formatter,
+                               "executor": self.executor
                                })
 
     # Now pipes' attributes are setted.
@@ -126,6 +131,19 @@ class Pipeline:
       for loc, params in sub_params:
         self.testers[name][loc].set_params(**params)
 
+  def shutdown(self):
+    """
+    Shut down the shared executor.
+    """
+    if self.executor is not None:
+      self.executor.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.shutdown()
+
   def get_log(self):
     """
     Return log of last receiving.
@@ -0,0 +1,33 @@
+import time
+
+import numpy as np
+
+from fpeg.codec import ebcot_jit
+from fpeg.codec.ebcot_codec import _bit_planes, _block_encode, _block_payload, _block_decode
+
+
+def blocks(n_blocks=8, seed=0):
+  """
+  Bit-planes and signs of a few laplacian code blocks.
+  """
+  rng = np.random.default_rng(seed)
+  return [_bit_planes(np.round(rng.laplace(0, 16, (64, 64))).astype(np.int64))[:2] for _ in range(n_blocks)]
+
+
+def timed(func):
+  start = time.perf_counter()
+  result = func()
+  return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+  planes = blocks()
+  # the first call compiles the kernels, or loads them from the disk cache
+  ebcot_jit.warm_up()
+
+  for backend in ["python", "jit"] if ebcot_jit.available else ["python"]:
+    coded, encode_time = timed(lambda: [_block_encode(bitPlane, signs, "HL", backend=backend) for bitPlane, signs in planes])
+    payloads = [_block_payload(block) for block in coded]
+    _, decode_time = timed(lambda: [_block_decode(payload, 0, len(payload), "HL", backend=backend) for payload in payloads])
+    print("{:6} encode: {:8.2f} blocks/s  decode: {:8.2f} blocks/s  bytes: {}".format(
+      backend, len(planes) / encode_time, len(planes) / decode_time, sum(len(payload) for payload in payloads)))
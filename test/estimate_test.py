@@ -0,0 +1,40 @@
+import cv2
+import numpy as np
+
+from fpeg.codec import EBCOTCodec
+from fpeg.transformer import DWTransformer
+from fpeg.utils import Quantizer
+
+# largest relative error allowed between the estimated and the real size of a codestream
+TOLERANCE = 0.06
+
+
+def quantized_tiles(QCD, path="penguim.jpg", size=128, D=3):
+  """
+  Tiles of the top left size * size pixels of an image, transformed and quantized as by the lossy pipeline of jpeg.py.
+  """
+  image = cv2.imread(path)[:size, :size].astype(np.float64) - 128
+  tiles = DWTransformer(mode="forward", lossy=True, D=D).recv([image], accelerated=False).sended_
+  return Quantizer(mode="quantify", irreversible=True, D=D, QCD=QCD).recv(tiles, accelerated=False).sended_
+
+
+def test_estimate_ratio(D=3):
+  ratios = []
+  for QCD in ["0000000000000000", "0001000000000000", "0010000000000000"]:
+    tiles = quantized_tiles(QCD, D=D)
+    for params in [{}, {"terminate": True}, {"bypass": 1}, {"bypass": 2, "terminate": True}]:
+      for code_block in [(32, 32), (64, 64)]:
+        codec = EBCOTCodec(D=D, QCD=QCD, code_block=code_block, backend="jit", **params)
+        real = codec.recv(tiles, accelerated=False).sended_
+        codec = EBCOTCodec(mode="estimate", D=D, QCD=QCD, code_block=code_block, **params)
+        estimates = codec.recv(tiles, accelerated=False).sended_
+        for codestream, (estimate, _) in zip(real, estimates):
+          ratio = estimate / len(codestream)
+          assert abs(ratio - 1) < TOLERANCE, "QCD {} {} {}: estimated {} bytes for {}".format(QCD, params, code_block, estimate, len(codestream))
+          ratios.append(ratio)
+
+  return min(ratios), max(ratios)
+
+
+if __name__ == "__main__":
+  print("estimate / real size in [{:.3f}, {:.3f}]".format(*test_estimate_ratio()))
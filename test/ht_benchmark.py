@@ -0,0 +1,41 @@
+import time
+
+import cv2
+import numpy as np
+import pywt
+
+from fpeg.codec.ebcot_codec import _tile_code, _tile_pack, _tile_decode as ebcot_decode
+from fpeg.codec.ht_codec import _tile_encode as ht_encode, _tile_decode as ht_decode
+from fpeg.funcs import cat_arrays_2d
+
+
+def quantized_tile(path="penguim.jpg", size=128, D=3, step=2):
+  """
+  Quantized wavelet pyramid of the top left size * size pixels of an image, in the layout of Quantizer.
+  """
+  image = cv2.imread(path)[:size, :size].astype(np.float64) - 128
+  coeffs = [pywt.wavedec2(image[:, :, k], "bior2.2", level=D) for k in range(3)]
+  tile = [np.round(cat_arrays_2d([c[0] for c in coeffs]) / step).astype(np.int64)]
+  for i in range(1, D + 1):
+    tile.append(tuple(np.round(cat_arrays_2d([c[i][n] for c in coeffs]) / step).astype(np.int64) for n in range(3)))
+
+  return tile
+
+
+def timed(func, *args):
+  start = time.perf_counter()
+  result = func(*args)
+  return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+  D = 3
+  tile = quantized_tile(D=D)
+  pixels = tile[0].shape[0] * tile[0].shape[1] * 4 ** D
+
+  for name, encode, decode in [("EBCOT", lambda x: _tile_pack(D, x[0].shape[2], _tile_code(x, D)), ebcot_decode), ("HT", ht_encode, ht_decode)]:
+    codestream, encode_time = timed(encode, tile)
+    decoded, decode_time = timed(decode, codestream)
+    lossless = np.array_equal(decoded[0], tile[0]) and all(np.array_equal(u, v) for x, y in zip(decoded[1:], tile[1:]) for u, v in zip(x, y))
+    print("{:5} {:7d} bytes  encode: {:8.0f} pixels/s  decode: {:8.0f} pixels/s  lossless: {}".format(
+      name, len(codestream), pixels / encode_time, pixels / decode_time, lossless))
@@ -0,0 +1,72 @@
+import numpy as np
+import pywt
+
+from fpeg.codec import HTCodec
+from fpeg.codec.ht_codec import _BLOCK_HEADER, _block_encode, _block_decode, _tile_encode, _tile_decode
+from fpeg.funcs import cat_arrays_2d
+
+
+def random_tile(shape, D=2, scale=40, seed=0):
+  """
+  Rounded wavelet pyramid of 3 channels of noise, in the layout of Quantizer.
+  """
+  rng = np.random.default_rng(seed)
+  coeffs = [pywt.wavedec2(rng.normal(size=shape) * scale, "bior2.2", level=D) for _ in range(3)]
+  tile = [np.round(cat_arrays_2d([c[0] for c in coeffs])).astype(np.int64)]
+  for i in range(1, D + 1):
+    tile.append(tuple(np.round(cat_arrays_2d([c[i][n] for c in coeffs])).astype(np.int64) for n in range(3)))
+
+  return tile
+
+
+def tiles_equal(x, y):
+  return all(np.array_equal(a, b) for a, b in zip([x[0]] + [c for level in x[1:] for c in level], [y[0]] + [c for level in y[1:] for c in level]))
+
+
+def test_odd_shapes():
+  # bands of odd height and width, and edge code blocks cut to them
+  for shape, D, h, w in [((45, 37), 2, 64, 64), ((75, 53), 3, 16, 16), ((33, 64), 2, 8, 12)]:
+    tile = random_tile(shape, D)
+    assert tiles_equal(_tile_decode(_tile_encode(tile, h, w)), tile), "tile {} with code blocks {}".format(shape, (h, w))
+
+
+def test_all_zero():
+  tile = random_tile((40, 30), 2, scale=0)
+  assert tiles_equal(_tile_decode(_tile_encode(tile)), tile)
+  tile[1] = tuple(np.zeros_like(band) for band in tile[1])
+  assert tiles_equal(_tile_decode(_tile_encode(tile, 8, 8)), tile)
+  block = np.zeros((6, 10), dtype=np.int64)
+  assert np.array_equal(_block_decode(_block_encode(block), 6, 10), block)
+
+
+def test_codec():
+  X = [random_tile((45, 37), 2, seed=seed) for seed in range(2)]
+  bitcodes = HTCodec(mode="encode").recv(X, accelerated=False).sended_
+  Y = HTCodec(mode="decode").recv(bitcodes, accelerated=False).sended_
+  assert all(tiles_equal(x, y) for x, y in zip(X, Y))
+
+
+def test_truncated_vlc():
+  # a VLC stream cut short must be reported, not read past its end
+  block = np.round(np.random.default_rng(1).normal(size=(16, 16)) * 20).astype(np.int64)
+  payload = _block_encode(block)
+  melLength, vlcLength = _BLOCK_HEADER.unpack_from(payload, 0)
+  start = _BLOCK_HEADER.size
+  mel = payload[start:start + melLength]
+  vlc = payload[start + melLength:start + melLength + vlcLength]
+  magsgn = payload[start + melLength + vlcLength:]
+  for length in [0, vlcLength // 2]:
+    truncated = _BLOCK_HEADER.pack(melLength, length) + mel + vlc[:length] + magsgn
+    try:
+      _block_decode(truncated, 16, 16)
+    except ValueError:
+      continue
+    raise AssertionError("a VLC stream of {} of {} bytes was decoded".format(length, vlcLength))
+
+
+if __name__ == "__main__":
+  test_odd_shapes()
+  test_all_zero()
+  test_codec()
+  test_truncated_vlc()
+  print("HT round trips passed")
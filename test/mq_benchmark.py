@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+
+from fpeg.codec.ebcot_codec import _bit_planes, _embeddedBlockEncoder, _MQencode, _MQ_decode
+from fpeg.codec.mq_coder import MQEncoder, MQDecoder
+
+
+def symbols(n_blocks=4, seed=0):
+  """
+  Context labels and decisions of a few laplacian code blocks.
+  """
+  rng = np.random.default_rng(seed)
+  CXs, Ds = [], []
+  for _ in range(n_blocks):
+    block = rng.laplace(0, 16, (64, 64)).astype(np.int64)
+    bitPlane, signs, _ = _bit_planes(block)
+    CX, D, _ = _embeddedBlockEncoder(bitPlane, signs, "HL")
+    CXs.append(CX)
+    Ds.append(D)
+
+  return CXs, Ds
+
+
+def rate(func, n_symbols):
+  start = time.perf_counter()
+  func()
+  return n_symbols / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+  CXs, Ds = symbols()
+  n_symbols = sum(len(CX) for CX in CXs)
+  streams = [_MQencode(CX, D).stream for CX, D in zip(CXs, Ds)]
+
+  def reference_encode():
+    for CX, D in zip(CXs, Ds):
+      _MQencode(CX, D)
+
+  def fast_encode():
+    encoder = MQEncoder()
+    for CX, D in zip(CXs, Ds):
+      encoder.reset()
+      encoder.encode_symbols(D[:, 0].tolist(), CX[:, 0].tolist())
+      encoder.flush()
+
+  def reference_decode():
+    for CX, stream in zip(CXs, streams):
+      _MQ_decode(list(stream), CX)
+
+  def fast_decode():
+    decoder = MQDecoder()
+    for CX, stream in zip(CXs, streams):
+      decoder.reset(bytes(stream))
+      decoder.decode_symbols(CX[:, 0].tolist())
+
+  print("{} symbols".format(n_symbols))
+  print("reference encode: {:.0f} symbols/s".format(rate(reference_encode, n_symbols)))
+  print("fast encode:      {:.0f} symbols/s".format(rate(fast_encode, n_symbols)))
+  print("reference decode: {:.0f} symbols/s".format(rate(reference_decode, n_symbols)))
+  print("fast decode:      {:.0f} symbols/s".format(rate(fast_decode, n_symbols)))
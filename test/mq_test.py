@@ -0,0 +1,66 @@
+import numpy as np
+
+from fpeg.codec import ebcot_jit
+from fpeg.codec.ebcot_codec import _MQencode, _tile_code, _lockstep_code
+from fpeg.codec.mq_coder import MQEncoder, MQBatchEncoder
+
+from mq_benchmark import symbols
+
+
+def random_tile(shape=(40, 36), D=2, scale=16, seed=0):
+  """
+  Tile of laplacian coefficients in the layout of Quantizer, with 3 channels.
+  """
+  rng = np.random.default_rng(seed)
+  band = lambda h, w: np.round(rng.laplace(0, scale, (h, w, 3))).astype(np.int64)
+  h, w = shape
+  tile = []
+  for i in range(D, 0, -1):
+    tile.append(tuple(band(-(-h // 2 ** i), -(-w // 2 ** i)) for _ in range(3)))
+
+  return [band(-(-h // 2 ** D), -(-w // 2 ** D))] + tile
+
+
+def test_mq_coders():
+  # the fast and the lockstep MQ coders give the bytes of the reference one
+  CXs, Ds = symbols()
+  references = [_MQencode(CX, D).stream.astype(np.uint8).tobytes() for CX, D in zip(CXs, Ds)]
+
+  encoder = MQEncoder()
+  for CX, D, reference in zip(CXs, Ds, references):
+    encoder.reset()
+    encoder.encode_symbols(D[:, 0].tolist(), CX[:, 0].tolist())
+    assert encoder.flush() == reference
+    encoder.reset()
+    for d, cx in zip(D[:, 0].tolist(), CX[:, 0].tolist()):
+      encoder.encode(d, cx)
+    assert encoder.flush() == reference
+
+  batch = MQBatchEncoder(len(CXs))
+  for step in range(max(len(CX) for CX in CXs)):
+    ks = np.array([k for k, CX in enumerate(CXs) if step < len(CX)])
+    batch.encode(ks, np.array([Ds[k][step, 0] for k in ks]), np.array([CXs[k][step, 0] for k in ks]))
+  assert batch.flush(np.arange(len(CXs))) == references
+
+
+def test_backends():
+  # every engine gives the same code blocks, truncation points and codestream, with and without bypass and terminate
+  tiles = [random_tile(seed=seed) for seed in range(2)]
+  backends = ["python", "jit"] if ebcot_jit.available else ["python"]
+  for params in [{}, {"terminate": True}, {"bypass": 1}, {"bypass": 2, "terminate": True}]:
+    for truncation in [False, True]:
+      reference = [_tile_code(tile, 2, 16, 16, truncation=truncation, **params) for tile in tiles]
+      if not params:
+        assert [_tile_code(tile, 2, 16, 16, "reference", truncation) for tile in tiles] == reference
+      for backend in backends:
+        for fused in [True, False]:
+          coded = [_tile_code(tile, 2, 16, 16, truncation=truncation, fused=fused, backend=backend, **params) for tile in tiles]
+          assert coded == reference, "{} {} fused={} truncation={}".format(backend, params, fused, truncation)
+      lockstep = _lockstep_code(tiles, 2, 16, 16, truncation, **params)
+      assert [bands for _, _, bands in lockstep] == reference, "lockstep {} truncation={}".format(params, truncation)
+
+
+if __name__ == "__main__":
+  test_mq_coders()
+  test_backends()
+  print("MQ coders and backends give the same bytes")
@@ -3,11 +3,12 @@ __all__ = [
 ]
 
 import numpy as np
-from pywt import wavedec2, Wavelet, waverec2
+from pywt import wavedec2, wavedecn_shapes, Wavelet, waverec2
 
 from ..base import Transformer
 from ..config import read_config
 from ..funcs.funcs import cat_arrays_2d, dcps_array_3d
+from ..funcs.shared import ArraySpec, shared_starmap, write_into
 
 config = read_config()
 
@@ -28,6 +29,7 @@ class DWTransformer(Transformer):
 	             mode="forward",
 	             lossy=True,
 	             D=D,
+	             reduce=0,
 	             accelerated=False):
 		"""
 		Init and set attributes of a discrete wavelet transformer.
@@ -40,8 +42,10 @@ class DWTransformer(Transformer):
 		  Mode of the codec, must in ["encode", "decode"].
 		lossy: bool, optional
       Whether the transform is loss or lossless.
+		reduce: int, optional
+		  Number of the finest resolution levels skipped in backward transform, the output is 2 ** reduce times smaller.
 		accelerated: bool, optional
-      Whether the process would be accelerated by subprocess pool.
+      Whether the process would be accelerated by subprocess pool. Tiles and coefficients are passed to the pool through shared memory.
 
 		Implicit Attributes
 		-------------------
@@ -56,6 +60,7 @@ class DWTransformer(Transformer):
 		self.mode = mode
 		self.D = D
 		self.lossy = lossy
+		self.reduce = reduce
 		self.accelerated = accelerated
 
 		self.db97_coeffs, self.lg53_coeffs = dwt_coeffs[0], dwt_coeffs[1]
@@ -78,29 +83,13 @@ class DWTransformer(Transformer):
 			wavelet = 'bior2.2'
 			# wavelet = Wavelet('LG53', self.lg53_coeffs)
 
-		coeffs = []
-		for x in X:
-			channel0_coeff = wavedec2(x[:, :, 0], wavelet, level=self.D)
-			channel1_coeff = wavedec2(x[:, :, 1], wavelet, level=self.D)
-			channel2_coeff = wavedec2(x[:, :, 2], wavelet, level=self.D)
-			a_coeff = cat_arrays_2d([channel0_coeff[0],
-			                         channel1_coeff[0],
-			                         channel2_coeff[0]])
-
-			coeff = [a_coeff]
-			for i in range(1, self.D + 1):
-				h_coeff = cat_arrays_2d([channel0_coeff[i][0],
-				                         channel1_coeff[i][0],
-				                         channel2_coeff[i][0]])
-				v_coeff = cat_arrays_2d([channel0_coeff[i][1],
-				                         channel1_coeff[i][1],
-				                         channel2_coeff[i][1]])
-				d_coeff = cat_arrays_2d([channel0_coeff[i][2],
-				                         channel1_coeff[i][2],
-				                         channel2_coeff[i][2]])
-				coeff.append((h_coeff, v_coeff, d_coeff))
-
-			coeffs.append(coeff)
+		if self.accelerated:
+			self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate forward transform.")
+			structures = [_coeffs_spec(x.shape, wavelet, self.D) for x in X]
+			with self.pool(min(self.task_number, self.max_pool_size)) as p:
+				coeffs = shared_starmap(p, write_into, X, structures, _forward, wavelet, self.D)
+		else:
+			coeffs = [_forward(x, wavelet, self.D) for x in X]
 
 		return coeffs
 
@@ -119,31 +108,91 @@ class DWTransformer(Transformer):
 		else:
 			wavelet = 'bior2.2'
 
-		tiles = []
-		for x in X:
-			channel0_a_coeff, channel1_a_coeff, channel2_a_coeff = dcps_array_3d(x[0])
-
-			channel0_coeff = [channel0_a_coeff]
-			channel1_coeff = [channel1_a_coeff]
-			channel2_coeff = [channel2_a_coeff]
-
-			for i in range(1, len(x)):
-				if i < self.D + 1:
-					channel0_h_coeff, channel1_h_coeff, channel2_h_coeff = dcps_array_3d(x[i][0])
-					channel0_v_coeff, channel1_v_coeff, channel2_v_coeff = dcps_array_3d(x[i][1])
-					channel0_d_coeff, channel1_d_coeff, channel2_d_coeff = dcps_array_3d(x[i][2])
-				else:
-					channel0_h_coeff, channel1_h_coeff, channel2_h_coeff = dcps_array_3d(np.zeros_like(x[i][0]))
-					channel0_v_coeff, channel1_v_coeff, channel2_v_coeff = dcps_array_3d(np.zeros_like(x[i][1]))
-					channel0_d_coeff, channel1_d_coeff, channel2_d_coeff = dcps_array_3d(np.zeros_like(x[i][2]))
-
-				channel0_coeff.append((channel0_h_coeff, channel0_v_coeff, channel0_d_coeff))
-				channel1_coeff.append((channel1_h_coeff, channel1_v_coeff, channel1_d_coeff))
-				channel2_coeff.append((channel2_h_coeff, channel2_v_coeff, channel2_d_coeff))
-
-			channel0 = waverec2(channel0_coeff, wavelet)
-			channel1 = waverec2(channel1_coeff, wavelet)
-			channel2 = waverec2(channel2_coeff, wavelet)
-			tiles.append(cat_arrays_2d([channel0, channel1, channel2]))
+		try:
+			self.reduce = params["reduce"]
+		except KeyError:
+			pass
+
+		# the LL band of level reduce is reconstructed from the coarser levels only
+		X = [x[:self.D - self.reduce + 1] for x in X]
+		if self.accelerated:
+			self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate backward transform.")
+			structures = [_tile_spec(x, wavelet) for x in X]
+			with self.pool(min(self.task_number, self.max_pool_size)) as p:
+				tiles = shared_starmap(p, write_into, X, structures, _backward, wavelet, self.D, self.reduce)
+		else:
+			tiles = [_backward(x, wavelet, self.D, self.reduce) for x in X]
 
 		return tiles
+
+
+def _forward(x, wavelet, D):
+	channel0_coeff = wavedec2(x[:, :, 0], wavelet, level=D)
+	channel1_coeff = wavedec2(x[:, :, 1], wavelet, level=D)
+	channel2_coeff = wavedec2(x[:, :, 2], wavelet, level=D)
+	a_coeff = cat_arrays_2d([channel0_coeff[0],
+	                         channel1_coeff[0],
+	                         channel2_coeff[0]])
+
+	coeff = [a_coeff]
+	for i in range(1, D + 1):
+		h_coeff = cat_arrays_2d([channel0_coeff[i][0],
+		                         channel1_coeff[i][0],
+		                         channel2_coeff[i][0]])
+		v_coeff = cat_arrays_2d([channel0_coeff[i][1],
+		                         channel1_coeff[i][1],
+		                         channel2_coeff[i][1]])
+		d_coeff = cat_arrays_2d([channel0_coeff[i][2],
+		                         channel1_coeff[i][2],
+		                         channel2_coeff[i][2]])
+		coeff.append((h_coeff, v_coeff, d_coeff))
+
+	return coeff
+
+
+def _backward(x, wavelet, D, reduce=0):
+	channel0_a_coeff, channel1_a_coeff, channel2_a_coeff = dcps_array_3d(x[0])
+
+	channel0_coeff = [channel0_a_coeff]
+	channel1_coeff = [channel1_a_coeff]
+	channel2_coeff = [channel2_a_coeff]
+
+	for i in range(1, len(x)):
+		if i < D + 1:
+			channel0_h_coeff, channel1_h_coeff, channel2_h_coeff = dcps_array_3d(x[i][0])
+			channel0_v_coeff, channel1_v_coeff, channel2_v_coeff = dcps_array_3d(x[i][1])
+			channel0_d_coeff, channel1_d_coeff, channel2_d_coeff = dcps_array_3d(x[i][2])
+		else:
+			channel0_h_coeff, channel1_h_coeff, channel2_h_coeff = dcps_array_3d(np.zeros_like(x[i][0]))
+			channel0_v_coeff, channel1_v_coeff, channel2_v_coeff = dcps_array_3d(np.zeros_like(x[i][1]))
+			channel0_d_coeff, channel1_d_coeff, channel2_d_coeff = dcps_array_3d(np.zeros_like(x[i][2]))
+
+		channel0_coeff.append((channel0_h_coeff, channel0_v_coeff, channel0_d_coeff))
+		channel1_coeff.append((channel1_h_coeff, channel1_v_coeff, channel1_d_coeff))
+		channel2_coeff.append((channel2_h_coeff, channel2_v_coeff, channel2_d_coeff))
+
+	channel0 = waverec2(channel0_coeff, wavelet)
+	channel1 = waverec2(channel1_coeff, wavelet)
+	channel2 = waverec2(channel2_coeff, wavelet)
+
+	# the low-pass gain of each skipped level is 2
+	return cat_arrays_2d([channel0, channel1, channel2]) / 2 ** reduce
+
+
+def _coeffs_spec(shape, wavelet, D):
+	# shapes of the coefficients _forward returns for a tile of shape
+	shapes = wavedecn_shapes(shape[:2], wavelet, level=D)
+	spec = [ArraySpec(shapes[0] + shape[2:], "<f8")]
+	for details in shapes[1:]:
+		spec.append(tuple(ArraySpec(details[key] + shape[2:], "<f8") for key in ["da", "ad", "dd"]))
+
+	return spec
+
+
+def _tile_spec(x, wavelet):
+	# shape of the tile _backward returns for coefficients x, each level doubles the finest band and trims the filter overlap
+	if len(x) == 1:
+		return ArraySpec(x[0].shape, "<f8")
+	rec_len = Wavelet(wavelet).rec_len
+	h, w, n_channels = x[-1][0].shape
+	return ArraySpec((2 * h - rec_len + 2, 2 * w - rec_len + 2, n_channels), "<f8")
@@ -68,7 +68,11 @@ class Reader(Pipe):
       self.logs[-1] += self.formatter.error(msg)
       raise ValueError(msg)
 
-    self.sended_ = [X.astype(int)]
+    # binary files may hold an image array or the list of codestreams written by Writer
+    if isinstance(X, np.ndarray):
+      X = [X.astype(int)]
+
+    self.sended_ = X
 
     return self
 
@@ -101,8 +105,8 @@ class Writer(Pipe):
     self.logs[-1] += self.formatter.message("Receiving data.")
     self.received_ = X
 
-    X[0] = X[0].astype(np.uint8)
     if not self.binary:
+      X[0] = X[0].astype(np.uint8)
       cv2.imwrite(self.path, X[0])
     else:
       self.logs[-1] += self.formatter.message("Writing binary file.")
@@ -2,13 +2,11 @@ __all__ = [
 	"Quantizer"
 ]
 
-from multiprocessing import Pool
-
 import numpy as np
 
 from ..base import Pipe
 from ..config import read_config
-from ..funcs import parse_marker
+from ..funcs import parse_marker, quantization_steps, shared_starmap, spec_like, write_into
 
 config = read_config()
 
@@ -34,7 +32,8 @@ class Quantizer(Pipe):
 							 D=D,
 							 QCD=QCD,
 							 delta_vb=delta_vb,
-							 reserve_bits=reserve_bits):
+							 reserve_bits=reserve_bits,
+							 reduce=0):
 		"""
 		Init and set attributes of a quantizer.
 
@@ -47,13 +46,15 @@ class Quantizer(Pipe):
 		irreversible: bool, optional
 			Whether the transform is lossy or lossless.
 		accelerated: bool, optional
-			Whether the process would be accelerated by subprocess pool.
+			Whether the process would be accelerated by subprocess pool. Tiles are passed to the pool through shared memory.
 		D: int, optional
 			Number of resolution layers.
 		QCD: str, optional
 			Quantization default used to specify epsilon_b and mu_b of subband with lowest resolution.
 		delta_vb: float, optional
 			Used in dequantization, ranges from 0 to 1.
+		reduce: int, optional
+			Number of the finest resolution levels skipped in dequantization, dequantized tiles keep the LL band and the first D - reduce levels.
 
 		Implicit Attributes
 		-------------------
@@ -76,6 +77,7 @@ class Quantizer(Pipe):
 		self.QCD = QCD
 		self.delta_vb = delta_vb
 		self.reserve_bits = reserve_bits
+		self.reduce = reduce
 
 		self.epsilon_b, self.mu_b = parse_marker(self.QCD)
 		self.min_task_number = min_task_number
@@ -114,50 +116,53 @@ class Quantizer(Pipe):
 
 		self.epsilon_b, self.mu_b = parse_marker(self.QCD)
 
-		delta_bs = []
-		for i in range(self.D):
-			delta_bs.append(2 ** -(self.epsilon_b + i - self.D) * (1 + self.mu_b / (2 ** 11)))
+		delta_bs = quantization_steps(self.QCD, self.D)
 
 		# print(delta_bs)
 		if self.mode == "quantify":
 			if self.irreversible:
 				if self.accelerated:
 					self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate quantify.")
-					inputs = [[x, delta_bs] for x in X]
-					with Pool(min(self.task_number, self.max_pool_size)) as p:
-						X = p.starmap(_quantize, inputs)
+					with self.pool(min(self.task_number, self.max_pool_size)) as p:
+						X = shared_starmap(p, write_into, X, spec_like(X, np.int64), _quantize, delta_bs)
 				else:
 					X = [_quantize(x, delta_bs) for x in X]
 			else:
 				if self.accelerated:
 					self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate quantify.")
-					inputs = [[x, self.reserve_bits, False] for x in X]
-					with Pool(min(self.task_number, self.max_pool_size)) as p:
-						X = p.starmap(_scale, inputs)
+					with self.pool(min(self.task_number, self.max_pool_size)) as p:
+						X = shared_starmap(p, write_into, X, spec_like(X, np.int64), _scale, self.reserve_bits, False)
 				else:
 					X = [_scale(x, self.reserve_bits, False) for x in X]
 
 		elif self.mode == "dequantify":
 			try:
-				self.D = params["delta_vb"]
+				self.delta_vb = params["delta_vb"]
 				self.logs[-1] += self.formatter.message("\"delta_vb\" is specified as {}.".format(self.delta_vb))
 			except KeyError:
 				self.logs[-1] += self.formatter.warning("\"delta_vb\" is not specified, now set to {}.".format(self.delta_vb))
 
+			try:
+				self.reduce = params["reduce"]
+				self.logs[-1] += self.formatter.message("\"reduce\" is specified as {}.".format(self.reduce))
+			except KeyError:
+				pass
+
+			# levels finer than D - reduce are dropped, tiles decoded with reduce already lack them
+			X = [x[:self.D - self.reduce + 1] for x in X]
+
 			if self.irreversible:
 				if self.accelerated:
 					self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate dequantify.")
-					inputs = [[x, delta_bs, self.delta_vb] for x in X]
-					with Pool(min(self.task_number, self.max_pool_size)) as p:
-						X = p.starmap(_dequantize, inputs)
+					with self.pool(min(self.task_number, self.max_pool_size)) as p:
+						X = shared_starmap(p, write_into, X, spec_like(X, np.float64), _dequantize, delta_bs, self.delta_vb)
 				else:
 					X = [_dequantize(x, delta_bs, self.delta_vb) for x in X]
 			else:
 				if self.accelerated:
 					self.logs[-1] += self.formatter.message("Using multiprocess pool to accelerate dequantify.")
-					inputs = [[x, self.reserve_bits, True] for x in X]
-					with Pool(min(self.task_number, self.max_pool_size)) as p:
-						X = p.starmap(_scale, inputs)
+					with self.pool(min(self.task_number, self.max_pool_size)) as p:
+						X = shared_starmap(p, write_into, X, spec_like(X, np.float64), _scale, self.reserve_bits, True)
 				else:
 					X = [_scale(x, self.reserve_bits, True) for x in X]
 
@@ -6,6 +6,7 @@ import numpy as np
 
 from ..base import Pipe
 from ..config import read_config
+from ..funcs import window_tiles
 
 
 config = read_config()
@@ -22,7 +23,9 @@ class Spliter(Pipe):
                name="Spliter",
                mode="split",
                tile_shape=tile_shape,
-               block_shape=()):
+               block_shape=(),
+               reduce=0,
+               window=None):
     """
     Init and set attributes of a spliter.
 
@@ -36,6 +39,10 @@ class Spliter(Pipe):
       Shape of tiles that spliter tries to split.
     block_shape: tuple of int, optional
       Shape used to concatenate tiles together.
+    reduce: int, optional
+      Number of resolution levels the tiles to recover are reduced by. Reduced tiles carry a few extra rows and columns of the boundary extension of the wavelet transform, which are cropped so that tiles of tile_shape become ceil(tile_shape / 2 ** reduce) large.
+    window: tuple of int, optional
+      Region (y0, x0, y1, x1) of the image to recover, y1 and x1 excluded, None for the whole image. The tiles to recover are the tiles of an image of block_shape tiles that overlap window, e.g. the tiles EBCOTCodec decodes with the same window, and only window is kept. With reduce, window is in pixels of the full image and is reduced with the tiles.
     """
     super().__init__()
 
@@ -43,6 +50,8 @@ class Spliter(Pipe):
     self.mode = mode
     self.tile_shape = tile_shape
     self.block_shape = block_shape
+    self.reduce = reduce
+    self.window = window
 
   def recv(self, X, **params):
     self.logs.append("")
@@ -90,17 +99,37 @@ class Spliter(Pipe):
         self.logs[-1] += self.formatter.error(msg)
         raise ValueError(msg)
 
-      self.logs[-1] += self.formatter.message("Concatenating tiles with shape {}.".format(self.block_shape))
+      try:
+        self.reduce = params["reduce"]
+        self.logs[-1] += self.formatter.message("\"reduce\" is specified as {}.".format(self.reduce))
+      except KeyError:
+        pass
+
+      try:
+        self.window = params["window"]
+        self.logs[-1] += self.formatter.message("\"window\" is specified as {}.".format(self.window))
+      except KeyError:
+        pass
+
+      if self.reduce:
+        X = _crop_reduced(X, self.tile_shape, self.reduce)
+
+      block_shape = self.block_shape
+      if self.window is not None:
+        rows, cols = window_tiles(self.window, self.tile_shape, self.block_shape)
+        block_shape = (len(rows), len(cols))
+
+      self.logs[-1] += self.formatter.message("Concatenating tiles with shape {}.".format(block_shape))
 
       n_channels = X[0].shape[2]
       image = []
       for i in range(n_channels):
         channel_tiles = [tile[:, :, i] for tile in X]
         channel = []
-        for k in range(self.block_shape[0]):
+        for k in range(block_shape[0]):
           row_block = []
-          for l in range(self.block_shape[1]):
-            row_block.append(channel_tiles[k * self.block_shape[1] + l])
+          for l in range(block_shape[1]):
+            row_block.append(channel_tiles[k * block_shape[1] + l])
           channel.append(row_block)
 
         image.append(np.block(channel))
@@ -108,6 +137,8 @@ class Spliter(Pipe):
       image = np.array(image)
       image = np.swapaxes(image, 0, 1)
       image = np.swapaxes(image, 1, 2)
+      if self.window is not None:
+        image = _crop_window(image, self.window, self.tile_shape, rows[0], cols[0], self.reduce)
       self.sended_ = [image]
     else:
       msg = "Invalid attribute %s for spliter %s. Spliter.mode should be set to \"split\" or \"recover\"." % (self.mode, self)
@@ -115,3 +146,23 @@ class Spliter(Pipe):
       raise AttributeError(msg)
 
     return self
+
+
+def _crop_reduced(X, tile_shape, reduce):
+  # the first tile is a full tile unless the image is a single smaller tile, its extra rows and columns
+  # over ceil(tile_shape / 2 ** reduce) are cropped from every tile, the larger half of them from the start
+  extras = [max(X[0].shape[i] - -(-tile_shape[i] // 2 ** reduce), 0) for i in range(2)]
+  (top, left), (bottom, right) = [extra - extra // 2 for extra in extras], [extra // 2 for extra in extras]
+
+  return [tile[top:tile.shape[0] - bottom, left:tile.shape[1] - right] for tile in X]
+
+
+def _crop_window(image, window, tile_shape, row, col, reduce=0):
+  # image is concatenated from the tiles overlapping window, the first of which is tile (row, col)
+  # window and tile_shape are reduced to the pixels of tiles reduced by reduce levels
+  scale = 2 ** reduce
+  y0, x0 = window[0] // scale, window[1] // scale
+  y1, x1 = -(-window[2] // scale), -(-window[3] // scale)
+  top, left = row * -(-tile_shape[0] // scale), col * -(-tile_shape[1] // scale)
+
+  return image[y0 - top:y1 - top, x0 - left:x1 - left]